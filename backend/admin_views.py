@@ -0,0 +1,137 @@
+import time
+import threading
+from collections import OrderedDict
+
+from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import inspect as sa_inspect, func, text, Text
+from sqlalchemy.dialects.mysql import LONGTEXT, MEDIUMTEXT
+from sqlalchemy.orm import defer
+
+# --- Админка для больших таблиц (submission, comment) ---
+# Стандартный ModelView на каждой странице делает точный COUNT(*), запрос с OFFSET и загружает
+# LONGTEXT целиком. Здесь: число строк без фильтров — оценка из статистики таблицы (MySQL),
+# страницы — по ключу (WHERE pk < граница ORDER BY pk), текстовые колонки отложены (defer),
+# а в списке показывается только начало текста (SUBSTR в том же запросе).
+TEXT_PREVIEW_CHARS = 200
+TEXT_COLUMN_TYPES = (Text, LONGTEXT, MEDIUMTEXT) # Типы MySQL не наследуются от Text
+ROW_ESTIMATE_TTL_SECONDS = 60
+MAX_PAGE_BOUNDARIES = 1000
+
+
+class LargeTableModelView(ModelView):
+    """
+    ModelView для таблиц с миллионами строк. Сортировка — только по первичному ключу,
+    фильтры задаются в подклассах явно и только по индексированным колонкам (column_filters),
+    полнотекстовый поиск отключен.
+    """
+    column_display_pk = True
+    page_size = 50
+    can_set_page_size = False
+    column_searchable_list = ()
+
+    def __init__(self, model, session, **kwargs):
+        mapper = sa_inspect(model)
+        self._pk_column = mapper.primary_key[0]
+        self._pk_name = mapper.get_property_by_column(self._pk_column).key
+        self._text_columns = [column_property.key for column_property in mapper.column_attrs
+                              if isinstance(column_property.columns[0].type, TEXT_COLUMN_TYPES)]
+        # (фильтры, направление, размер страницы, номер страницы) -> pk последней строки предыдущей страницы
+        self._page_boundaries = OrderedDict()
+        self._row_estimate = (None, 0.0)
+        self._cache_lock = threading.Lock()
+        super().__init__(model, session, **kwargs)
+        self.column_formatters = {**{name: self._text_preview_formatter for name in self._text_columns},
+                                  **(self.column_formatters or {})}
+
+    def scaffold_sortable_columns(self):
+        return {self._pk_name: self._pk_column}
+
+    def get_query(self):
+        query = super().get_query()
+        if self._text_columns:
+            query = query.options(*[defer(getattr(self.model, name)) for name in self._text_columns])
+        return query
+
+    @staticmethod
+    def _text_preview_formatter(view, context, model, name):
+        preview = getattr(model, '_text_previews', {}).get(name)
+        if preview is not None and len(preview) >= TEXT_PREVIEW_CHARS:
+            preview += '…'
+        return preview
+
+    def estimated_row_count(self):
+        """
+        Оценка числа строк таблицы: TABLE_ROWS из information_schema для MySQL (без сканирования),
+        для остальных СУБД — точный COUNT. Значение кешируется на ROW_ESTIMATE_TTL_SECONDS.
+        """
+        estimate, computed_at = self._row_estimate
+        if estimate is not None and time.time() - computed_at < ROW_ESTIMATE_TTL_SECONDS:
+            return estimate
+        if self.session.get_bind().dialect.name == 'mysql':
+            estimate = self.session.execute(
+                text("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                     "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name"),
+                {"table_name": self.model.__table__.name}).scalar()
+        else:
+            estimate = self.session.query(func.count(self._pk_column)).scalar()
+        self._row_estimate = (int(estimate or 0), time.time())
+        return self._row_estimate[0]
+
+    def _page_boundary(self, boundary_key, page, query, descending, page_size):
+        """
+        Граница страницы page (pk последней строки предыдущей страницы). При последовательном
+        листании берется из кеша; при переходе сразу на дальнюю страницу ищется одним запросом
+        только по pk (по индексу, без чтения строк таблицы).
+        """
+        if page <= 0:
+            return None
+        with self._cache_lock:
+            if boundary_key in self._page_boundaries:
+                self._page_boundaries.move_to_end(boundary_key)
+                return self._page_boundaries[boundary_key]
+        order = self._pk_column.desc() if descending else self._pk_column.asc()
+        boundary = query.with_entities(self._pk_column).order_by(order).offset(page * page_size - 1).limit(1).scalar()
+        if boundary is not None:
+            self._remember_boundary(boundary_key, boundary)
+        return boundary
+
+    def _remember_boundary(self, boundary_key, boundary):
+        with self._cache_lock:
+            self._page_boundaries[boundary_key] = boundary
+            self._page_boundaries.move_to_end(boundary_key)
+            while len(self._page_boundaries) > MAX_PAGE_BOUNDARIES:
+                self._page_boundaries.popitem(last=False)
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        """Страница записей (pk по убыванию по умолчанию) и число строк (оценка, если фильтров нет)."""
+        page_size = page_size or self.page_size
+        query = self.get_query()
+        count_query = None
+        if filters and self._filters:
+            query, count_query, _, _ = self._apply_filters(query, self.get_count_query(), {}, {}, filters)
+        # С фильтром по индексированной колонке точный COUNT — проход по диапазону индекса
+        count = count_query.scalar() if count_query is not None else self.estimated_row_count()
+
+        descending = bool(sort_desc) if sort_column is not None else True
+        filters_key = tuple((index, str(value)) for index, _, value in filters or ())
+        boundary_key = (filters_key, descending, page_size, page)
+        boundary = self._page_boundary(boundary_key, page, query, descending, page_size)
+        if page > 0 and boundary is None:
+            return count, [] # Страница за пределами таблицы
+        if boundary is not None:
+            query = query.filter(self._pk_column < boundary if descending else self._pk_column > boundary)
+        query = query.order_by(self._pk_column.desc() if descending else self._pk_column.asc()).limit(page_size)
+        if not execute:
+            return count, query
+
+        previews = [func.substr(getattr(self.model, name), 1, TEXT_PREVIEW_CHARS) for name in self._text_columns]
+        data = []
+        for row in (query.add_columns(*previews).all() if previews else query.all()):
+            model = row[0] if previews else row
+            if previews:
+                model._text_previews = dict(zip(self._text_columns, row[1:]))
+            data.append(model)
+        if len(data) == page_size:
+            self._remember_boundary((filters_key, descending, page_size, page + 1),
+                                    getattr(data[-1], self._pk_name))
+        return count, data
@@ -1,2 +1,3 @@
 calculated_metrics_storage = {} 
-structure_with_metrics_cache = {}
\ No newline at end of file
+structure_with_metrics_cache = {}
+structure_cache_times = {} # Ключ structure_with_metrics_cache -> время расчета (сверяется с course_data_change)
\ No newline at end of file
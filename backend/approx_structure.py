@@ -0,0 +1,120 @@
+import math
+import threading
+
+from sqlalchemy import func
+
+from .models import db, StepDailyRollup
+from .rollups import calculate_course_structure_window, course_step_ids, ensure_rollups, CONFIDENCE_Z
+from .structure_metrics import calculate_course_structure, DISCRIMINATION_GROUP_SHARE
+from .parallel import get_metrics_workers
+from .instrumentation import span
+
+# --- Быстрая оценка метрик структуры (?approx=1) ---
+# Уникальные пользователи и доли по ним — из HyperLogLog дневных агрегатов (step_daily_rollup),
+# skip_rate / completion_index / discrimination_index — по выборке учащихся (user_id % modulus == 0).
+# Точный расчет запускается в фоне и по завершении попадает в обычный кеш /steps/structure.
+APPROX_SAMPLE_MODULUS = 10          # Выборка ~10% учащихся
+APPROX_MIN_SUBMISSIONS = 200_000    # Курс меньше — оценка не нужна, сразу точный расчет
+
+SAMPLED_FIELDS = ("skip_rate", "skip_rate_numerator_r", "skip_rate_denominator_t",
+                  "completion_index", "completion_numerator_r", "completion_denominator_t",
+                  "discrimination_index")
+
+_exact_jobs = {} # course_id -> поток точного расчета
+_exact_jobs_lock = threading.Lock()
+
+
+def course_submissions_total(course_id):
+    """Число сабмишенов курса по дневным агрегатам (без сканирования submission)."""
+    step_ids = course_step_ids(course_id)
+    if not step_ids:
+        return 0
+    ensure_rollups(step_ids)
+    total = db.session.query(func.sum(StepDailyRollup.submissions_count))\
+        .filter(StepDailyRollup.step_id.in_(step_ids)).scalar()
+    return int(total or 0)
+
+
+def proportion_bound(value, sample_size):
+    """
+    Полуширина ~95% интервала доли, оцененной по выборке из sample_size наблюдений
+    (интервал Агрести–Коулла: не вырождается в 0 при долях 0 и 1 на малых выборках).
+    """
+    if value is None or not sample_size:
+        return None
+    adjusted_size = sample_size + CONFIDENCE_Z ** 2
+    adjusted_value = (value * sample_size + CONFIDENCE_Z ** 2 / 2) / adjusted_size
+    return CONFIDENCE_Z * math.sqrt(adjusted_value * (1 - adjusted_value) / adjusted_size)
+
+
+def discrimination_bound(sample_size):
+    """
+    Консервативная полуширина интервала для D = (UG - LG) / n: доли верных ответов в группах
+    по 27% учащихся, дисперсия каждой не больше 1/(4n). Размер урока оценивается числом пытавшихся на шаге.
+    """
+    group_size = math.floor(sample_size * DISCRIMINATION_GROUP_SHARE) if sample_size else 0
+    if group_size < 1:
+        return None
+    return CONFIDENCE_Z * math.sqrt(2 * 0.25 / group_size)
+
+
+def calculate_course_structure_approx(course_id, sample_modulus=APPROX_SAMPLE_MODULUS):
+    """
+    Оценка метрик шагов ОДНОГО курса (формат — как у calculate_course_structure) с полями
+    "approximate": True и "error_bounds" — полуширина ~95% интервала для каждой оцененной метрики.
+    Поля *_numerator_r / *_denominator_t — счетчики ВЫБОРКИ учащихся.
+    """
+    with span("structure.approx", log=True, course_id=course_id) as approx_span:
+        results_list = calculate_course_structure_window(course_id, with_error_bounds=True)
+        sampled_steps = {step_data["step_id"]: step_data
+                         for step_data in calculate_course_structure(course_id, user_sample_modulus=sample_modulus)}
+        for step_data in results_list:
+            sampled = sampled_steps.get(step_data["step_id"], {})
+            for field in SAMPLED_FIELDS:
+                step_data[field] = sampled.get(field)
+            step_data["approximate"] = True
+            step_data["sample_share"] = 1.0 / sample_modulus
+            step_data["error_bounds"].update({
+                "skip_rate": proportion_bound(step_data["skip_rate"], step_data["skip_rate_numerator_r"]),
+                "completion_index": proportion_bound(step_data["completion_index"], step_data["completion_denominator_t"]),
+                "discrimination_index": discrimination_bound(step_data["completion_denominator_t"])
+                                        if step_data["discrimination_index"] is not None else None,
+            })
+        approx_span["rows"] = len(results_list)
+    return results_list
+
+
+def exact_structure_running(course_id):
+    with _exact_jobs_lock:
+        return course_id in _exact_jobs
+
+
+def start_exact_structure(app, course_ids, on_result):
+    """
+    Запускает точный расчет курсов в фоновом потоке (курсы, которые уже считаются, пропускаются).
+    on_result(course_id, results_list) вызывается для каждого курса внутри app context.
+    Возвращает список курсов, поставленных в расчет.
+    """
+    with _exact_jobs_lock:
+        new_course_ids = [course_id for course_id in course_ids if course_id not in _exact_jobs]
+        if not new_course_ids:
+            return []
+        worker = threading.Thread(target=_run_exact_structure, args=(app, new_course_ids, on_result),
+                                  name=f"exact-structure-{new_course_ids[0]}", daemon=True)
+        for course_id in new_course_ids:
+            _exact_jobs[course_id] = worker
+    worker.start()
+    return new_course_ids
+
+
+def _run_exact_structure(app, course_ids, on_result):
+    with app.app_context():
+        for course_id in course_ids:
+            try:
+                print(f"--- Фоновый точный расчет структуры курса ID={course_id} ---")
+                on_result(course_id, calculate_course_structure(course_id, max_workers=get_metrics_workers()))
+            except Exception as e:
+                print(f"!!! Ошибка фонового расчета структуры (курс {course_id}): {e}")
+            finally:
+                with _exact_jobs_lock:
+                    _exact_jobs.pop(course_id, None)
@@ -0,0 +1,169 @@
+import glob
+import os
+import threading
+
+import numpy as np
+
+from .file_cache import load_cache_from_file, save_cache_to_file, benchmark_index_filepath, benchmark_course_filepath
+
+# --- Межкурсовой индекс распределений метрик шагов ---
+# Для каждой метрики и каждого step_type хранятся значения всех шагов всех курсов
+# (по курсам, чтобы пересчет курса заменял только его значения). Перцентильный ранг шага
+# считается по отсортированному объединенному массиву (np.searchsorted) — без загрузки
+# метрик структуры других курсов во время запроса.
+# На диске у каждого курса свой файл значений (cache/benchmark/course_<id>.json): пересчет курса
+# перезаписывает только его файл. Индекс собирается из файлов при первом обращении в процессе, а затем
+# файлы, измененные другими процессами (воркеры, calculate-metrics), перечитываются по mtime.
+BENCHMARK_METRICS = (
+    "difficulty_index", "success_rate", "discrimination_index", "skip_rate", "completion_index",
+    "avg_attempts_per_passed", "comment_rate", "usefulness_index", "comment_count",
+    "all_users_attempted", "passed_users_sub", "views", "unique_views",
+    "avg_completion_time_filtered_seconds", "solve_time_p50_seconds", "solve_time_p75_seconds", "solve_time_p90_seconds",
+)
+MIN_BENCHMARK_VALUES = 5 # При меньшем числе шагов такого типа ранг не считается (None)
+
+_index = None         # {metric: {step_type: {course_id (str): [значения]}}}
+_sorted_values = {}   # (metric, step_type) -> отсортированный массив значений всех курсов
+_file_mtimes = {}     # путь файла значений -> mtime, с которым он загружен в _index
+_index_lock = threading.Lock()
+
+
+def _file_mtime(filepath):
+    try:
+        return os.path.getmtime(filepath)
+    except OSError:
+        return None
+
+
+def _load_index():
+    """
+    Индекс, сверенный с файлами на диске (вызывается под _index_lock). Новые и измененные файлы
+    курсов перечитываются; при изменении прежнего единого файла или удалении файла курса индекс
+    собирается заново.
+    """
+    global _index
+    legacy_filepath = benchmark_index_filepath() # Прежний единый файл (до файлов по курсам)
+    legacy_mtime = _file_mtime(legacy_filepath)
+    course_mtimes = {filepath: _file_mtime(filepath) for filepath in glob.glob(benchmark_course_filepath('*'))}
+    course_mtimes = {filepath: mtime for filepath, mtime in course_mtimes.items() if mtime is not None}
+    if (_index is None or legacy_mtime != _file_mtimes.get(legacy_filepath)
+            or any(filepath != legacy_filepath and filepath not in course_mtimes for filepath in _file_mtimes)):
+        legacy_index = load_cache_from_file(legacy_filepath)
+        _index = legacy_index if isinstance(legacy_index, dict) else {}
+        _file_mtimes.clear()
+        _file_mtimes[legacy_filepath] = legacy_mtime
+        _sorted_values.clear()
+    for filepath in sorted(course_mtimes):
+        if _file_mtimes.get(filepath) != course_mtimes[filepath]:
+            course_key = os.path.basename(filepath)[len("course_"):-len(".json")]
+            course_values = load_cache_from_file(filepath)
+            if isinstance(course_values, dict):
+                _replace_course_values(_index, course_key, course_values)
+            _file_mtimes[filepath] = course_mtimes[filepath]
+            _sorted_values.clear()
+    return _index
+
+
+def _replace_course_values(index, course_key, course_values):
+    for metric_types in index.values():
+        for type_courses in metric_types.values():
+            type_courses.pop(course_key, None)
+    for metric, type_values in course_values.items():
+        for step_type, values in type_values.items():
+            index.setdefault(metric, {}).setdefault(step_type, {})[course_key] = values
+
+
+def _course_values(results_list):
+    """{metric: {step_type: [значения]}} для шагов одного курса (None пропускаются)."""
+    values = {}
+    for step_data in results_list:
+        step_type = step_data.get("step_type") or "unknown"
+        for metric in BENCHMARK_METRICS:
+            value = step_data.get(metric)
+            if value is not None:
+                values.setdefault(metric, {}).setdefault(step_type, []).append(value)
+    return values
+
+
+def update_benchmark_index(course_id, results_list, save=True):
+    """
+    Заменяет значения курса в индексе (вызывается при каждом пересчете метрик структуры курса).
+    На диск пишется только файл этого курса — сохранение не зависит от числа курсов в индексе.
+    """
+    course_values = _course_values(results_list)
+    with _index_lock:
+        _replace_course_values(_load_index(), str(course_id), course_values)
+        _sorted_values.clear()
+        if save:
+            filepath = benchmark_course_filepath(course_id)
+            save_cache_to_file(course_values, filepath)
+            _file_mtimes[filepath] = _file_mtime(filepath) # Собственная запись не перечитывается
+
+
+def benchmark_has_course(course_id):
+    with _index_lock:
+        index = _load_index()
+        course_key = str(course_id)
+        return any(course_key in type_courses for metric_types in index.values() for type_courses in metric_types.values())
+
+
+def _sorted_distribution(metric, step_type):
+    """Вызывается после _load_index() (под _index_lock)."""
+    key = (metric, step_type)
+    if key not in _sorted_values:
+        type_courses = _index.get(metric, {}).get(step_type, {})
+        values = [value for course_values in type_courses.values() for value in course_values]
+        _sorted_values[key] = np.sort(np.array(values, dtype=np.float64))
+    return _sorted_values[key]
+
+
+def percentile_ranks(results_list):
+    """
+    Перцентильные ранги (0-100, середина группы равных значений) метрик шагов среди шагов того же
+    step_type всех курсов. Возвращает список словарей {metric: ранг} в порядке results_list.
+    """
+    with _index_lock:
+        _load_index()
+        ranks = [{} for _ in results_list]
+        steps_by_type = {}
+        for position, step_data in enumerate(results_list):
+            steps_by_type.setdefault(step_data.get("step_type") or "unknown", []).append(position)
+        # Для ответа ?metrics= ранги — только по полям, которые есть в шагах
+        present_metrics = [metric for metric in BENCHMARK_METRICS if results_list and metric in results_list[0]]
+        for step_type, positions in steps_by_type.items():
+            for metric in present_metrics:
+                distribution = _sorted_distribution(metric, step_type)
+                values = np.array([np.nan if results_list[position].get(metric) is None else results_list[position][metric]
+                                   for position in positions], dtype=np.float64)
+                if len(distribution) < MIN_BENCHMARK_VALUES:
+                    metric_ranks = [None] * len(positions)
+                else:
+                    below = np.searchsorted(distribution, values, side='left')
+                    not_above = np.searchsorted(distribution, values, side='right')
+                    metric_ranks = [None if np.isnan(value) else round(float(rank), 1) for value, rank in
+                                    zip(values.tolist(), 100.0 * (below + not_above) / (2 * len(distribution)))]
+                for position, rank in zip(positions, metric_ranks):
+                    ranks[position][metric] = rank
+    return ranks
+
+
+def annotate_percentile_ranks(results_list):
+    """Копии словарей шагов с полем "percentile_ranks" (кеш курса не изменяется)."""
+    return [{**step_data, "percentile_ranks": ranks} for step_data, ranks in zip(results_list, percentile_ranks(results_list))]
+
+
+def benchmark_summary(metric, step_type=None, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    """Квантили распределения метрики по всем курсам (для одного step_type или по каждому)."""
+    with _index_lock:
+        index = _load_index()
+        step_types = [step_type] if step_type else sorted(index.get(metric, {}))
+        summary = {}
+        for current_type in step_types:
+            distribution = _sorted_distribution(metric, current_type)
+            summary[current_type] = {
+                "values": len(distribution),
+                "courses": len(index.get(metric, {}).get(current_type, {})),
+                "quantiles": {f"p{round(q * 100)}": float(np.quantile(distribution, q)) for q in quantiles}
+                             if len(distribution) else {},
+            }
+    return summary
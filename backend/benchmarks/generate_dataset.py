@@ -0,0 +1,297 @@
+"""
+Генератор синтетических данных курса в формате выгрузки Stepik.
+
+Для каждого курса создается папка course_<course_id> с файлами, которые читает
+backend/seed_database.py (те же колонки и их порядок):
+    learners.csv, structure.csv, submissions.csv, comments.csv, AdditionalInfo.xlsx
+
+Запуск (из корня репозитория):
+python -m backend.benchmarks.generate_dataset backend/benchmarks/data/demo --courses 2 --learners 5000
+python -m backend.benchmarks.generate_dataset backend/benchmarks/data/demo --target-submissions 1000000
+
+Модель поведения учащегося:
+- часть учащихся (initial_dropoff) не отправляет ни одного решения;
+- остальные проходят шаги по порядку и на каждом шаге уходят с вероятностью dropoff
+  (геометрическая кривая удержания);
+- на шаге с заданием (step_cost > 0) учащийся пропускает задание с вероятностью skip_rate,
+  иначе делает в среднем attempts попыток; последняя попытка верна с вероятностью solve_rate.
+"""
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+DATASET_INFO_FILE = 'dataset.json' # Параметры и фактический объем набора данных
+START_TIMESTAMP = 1672531200 # 2023-01-01 00:00:00 UTC
+ENROLLMENT_PERIOD_SECONDS = 180 * 24 * 3600
+
+STEP_TYPES = ['choice', 'number', 'string', 'code', 'sorting']
+LAST_NAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов']
+FIRST_NAMES = ['Александр', 'Мария', 'Дмитрий', 'Анна', 'Сергей', 'Елена', 'Иван', 'Ольга']
+COMMENT_TEXTS = [
+    'Не понимаю, почему ответ не принимается',
+    'Спасибо, отличный шаг!',
+    'В условии опечатка во втором предложении',
+    'Подскажите, пожалуйста, в каком формате вводить ответ?',
+    'Решил с третьей попытки, помог комментарий выше',
+    'Проверьте тесты: мое решение работает локально',
+]
+TEACHER_REPLY_TEXTS = [
+    'Обратите внимание на граничные случаи.',
+    'Спасибо, исправили условие.',
+    'Ответ вводится целым числом без пробелов.',
+]
+
+DEFAULT_PARAMS = {
+    "courses": 1,
+    "modules": 3,            # модулей в курсе
+    "lessons": 3,            # уроков в модуле
+    "steps": 5,              # шагов в уроке (первый шаг урока — теоретический, без заданий)
+    "learners": 200,         # учащихся на курс
+    "attempts": 1.8,         # среднее число попыток на задание
+    "dropoff": 0.03,         # вероятность уйти с курса на каждом шаге
+    "initial_dropoff": 0.1,  # доля учащихся без единой попытки
+    "skip_rate": 0.05,       # вероятность пропустить задание, дойдя до него
+    "solve_rate": 0.85,      # вероятность, что последняя попытка верная
+    "comment_rate": 0.01,    # вероятность комментария учащегося на достигнутом шаге
+    "teacher_reply_rate": 0.3,
+    "teachers": 2,           # преподавателей на курс (есть только в comments.csv)
+    "learner_overlap": 0.5,  # доля учащихся курса, общих с предыдущим курсом
+    "seed": 42,
+}
+
+
+def expected_submissions_per_learner(params):
+    """Ожидаемое число отправок на одного учащегося курса (для подбора --target-submissions)."""
+    steps_per_lesson = params["steps"]
+    step_count = params["modules"] * params["lessons"] * steps_per_lesson
+    survival = (1 - params["dropoff"]) ** np.arange(step_count)
+    is_task = np.arange(step_count) % steps_per_lesson != 0 if steps_per_lesson > 1 else np.ones(step_count, dtype=bool)
+    reached_tasks = survival[is_task].sum()
+    return (1 - params["initial_dropoff"]) * reached_tasks * (1 - params["skip_rate"]) * params["attempts"]
+
+
+def learners_for_target(target_submissions, params):
+    """Число учащихся на курс, при котором всего будет около target_submissions отправок."""
+    per_learner = expected_submissions_per_learner(params) * params["courses"]
+    return max(1, int(round(target_submissions / per_learner)))
+
+
+def _write_csv(path, header, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def _name(user_id):
+    return LAST_NAMES[user_id % len(LAST_NAMES)], FIRST_NAMES[(user_id // 3) % len(FIRST_NAMES)]
+
+
+def _build_structure(course_id, params):
+    """Список шагов курса: (module_id, module_pos, lesson_id, lesson_pos, step_id, step_pos, step_type, step_cost)."""
+    steps = []
+    for module_pos in range(1, params["modules"] + 1):
+        module_id = course_id * 100 + module_pos
+        for lesson_pos in range(1, params["lessons"] + 1):
+            lesson_id = module_id * 100 + lesson_pos
+            for step_pos in range(1, params["steps"] + 1):
+                step_id = lesson_id * 100 + step_pos
+                if step_pos == 1 and params["steps"] > 1:
+                    step_type, step_cost = 'text', 0
+                else:
+                    step_type = STEP_TYPES[(step_id + lesson_pos) % len(STEP_TYPES)]
+                    step_cost = 2 if step_type == 'code' else 1
+                steps.append((module_id, module_pos, lesson_id, lesson_pos, step_id, step_pos, step_type, step_cost))
+    return steps
+
+
+def _write_additional_info(path, course_id, steps, unique_views, passed, rng):
+    """AdditionalInfo.xlsx: 8 строк шапки отчета, далее по строке на шаг (индексы колонок — как в import_additional_info)."""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Steps')
+    sheet.append([f'Отчет по шагам курса {course_id}'])
+    sheet.append(['Синтетические данные (backend.benchmarks.generate_dataset)'])
+    for _ in range(5):
+        sheet.append([])
+    sheet.append(['module_position', 'module_id', 'lesson_position', 'lesson_id', 'step_position', 'step_id',
+                  'step_type', 'step_cost', 'step_title_short', 'step_title_full', 'lesson_title', 'module_title',
+                  'comments', 'views', 'unique_views', 'passed'])
+    for i, (module_id, module_pos, lesson_id, lesson_pos, step_id, step_pos, step_type, step_cost) in enumerate(steps):
+        views = int(unique_views[i] * (1 + rng.random() * 0.6))
+        sheet.append([module_pos, module_id, lesson_pos, lesson_id, step_pos, step_id, step_type, step_cost,
+                      f'Шаг {module_pos}.{lesson_pos}.{step_pos}',
+                      f'Модуль {module_pos}, урок {lesson_pos}, шаг {step_pos} ({step_type})',
+                      f'Урок {module_pos}.{lesson_pos}', f'Модуль {module_pos}',
+                      0, views, int(unique_views[i]), int(passed[i])])
+    workbook.save(path)
+
+
+def generate_course(course_dir, course_id, learner_ids, teacher_ids, params, rng, id_counters):
+    """Пишет файлы одного курса. Возвращает фактические объемы данных."""
+    os.makedirs(course_dir, exist_ok=True)
+    steps = _build_structure(course_id, params)
+    learner_count = len(learner_ids)
+
+    # --- learners.csv ---
+    joined = START_TIMESTAMP + rng.integers(0, ENROLLMENT_PERIOD_SECONDS, learner_count)
+    last_login = joined + rng.integers(0, 90 * 24 * 3600, learner_count)
+    _write_csv(os.path.join(course_dir, 'learners.csv'),
+               ['user_id', 'last_name', 'first_name', 'last_login', 'date_joined'],
+               ((int(user_id), *_name(int(user_id)), int(last_login[i]), int(joined[i]))
+                for i, user_id in enumerate(learner_ids)))
+
+    # --- structure.csv ---
+    _write_csv(os.path.join(course_dir, 'structure.csv'),
+               ['course_id', 'module_id', 'module_position', 'lesson_id', 'lesson_position',
+                'step_id', 'step_position', 'step_type', 'step_cost'],
+               ((course_id, *step) for step in steps))
+
+    # --- Кривая удержания: сколько шагов по порядку прошел каждый учащийся ---
+    if params["dropoff"] > 0:
+        reached = np.minimum(rng.geometric(params["dropoff"], learner_count), len(steps))
+    else:
+        reached = np.full(learner_count, len(steps))
+    reached[rng.random(learner_count) < params["initial_dropoff"]] = 0
+    clock = joined.astype(np.int64) # "Часы" учащегося: время его последнего действия
+
+    submissions_path = os.path.join(course_dir, 'submissions.csv')
+    _write_csv(submissions_path, ['submission_id', 'step_id', 'user_id', 'last_name', 'first_name',
+                                  'attempt_time', 'submission_time', 'status', 'score'], [])
+    comment_rows = []
+    unique_views = np.zeros(len(steps), dtype=np.int64)
+    passed = np.zeros(len(steps), dtype=np.int64)
+    submissions_count = 0
+
+    for position, (_, _, _, _, step_id, _, _, step_cost) in enumerate(steps):
+        reaching = np.nonzero(reached > position)[0]
+        unique_views[position] = len(reaching)
+        if not len(reaching):
+            continue
+        clock[reaching] += rng.exponential(3600, len(reaching)).astype(np.int64) + 30
+
+        if step_cost > 0:
+            attempting = reaching[rng.random(len(reaching)) >= params["skip_rate"]]
+            if len(attempting):
+                attempt_counts = rng.geometric(1 / max(params["attempts"], 1.0), len(attempting))
+                solved = rng.random(len(attempting)) < params["solve_rate"]
+                passed[position] = int(solved.sum())
+
+                learner_index = np.repeat(attempting, attempt_counts)
+                group_starts = np.cumsum(attempt_counts) - attempt_counts
+                attempt_number = np.arange(len(learner_index)) - np.repeat(group_starts, attempt_counts)
+                is_last = attempt_number == np.repeat(attempt_counts - 1, attempt_counts)
+                is_correct = is_last & np.repeat(solved, attempt_counts)
+
+                # Попытки одного учащегося идут друг за другом с паузами ~2 минуты
+                think_seconds = rng.exponential(120, len(learner_index)).astype(np.int64) + 5
+                elapsed = np.cumsum(think_seconds)
+                offsets = elapsed - np.repeat(elapsed[group_starts] - think_seconds[group_starts], attempt_counts)
+                submission_time = clock[learner_index] + offsets
+                attempt_time = submission_time - np.minimum(think_seconds, rng.integers(5, 60, len(learner_index)))
+                clock[attempting] += offsets[group_starts + attempt_counts - 1]
+
+                user_ids = learner_ids[learner_index]
+                first_id = id_counters["submission"]
+                id_counters["submission"] += len(learner_index)
+                last_names = np.array(LAST_NAMES)[user_ids % len(LAST_NAMES)]
+                first_names = np.array(FIRST_NAMES)[(user_ids // 3) % len(FIRST_NAMES)]
+                pd.DataFrame({
+                    "submission_id": np.arange(first_id, first_id + len(learner_index)),
+                    "step_id": step_id, "user_id": user_ids,
+                    "last_name": last_names, "first_name": first_names,
+                    "attempt_time": attempt_time, "submission_time": submission_time,
+                    "status": np.where(is_correct, 'correct', 'wrong'),
+                    "score": np.where(is_correct, '1.0', '0.0'),
+                }).to_csv(submissions_path, mode='a', header=False, index=False)
+                submissions_count += len(learner_index)
+
+        # --- Комментарии учащихся и ответы преподавателей ---
+        commenting = reaching[rng.random(len(reaching)) < params["comment_rate"]]
+        for learner_pos in commenting:
+            user_id = int(learner_ids[learner_pos])
+            comment_id = id_counters["comment"]; id_counters["comment"] += 1
+            comment_time = int(clock[learner_pos]) + int(rng.integers(10, 600))
+            deleted = '1' if rng.random() < 0.02 else '0'
+            comment_rows.append((comment_id, user_id, *_name(user_id), step_id, 0, comment_time, deleted,
+                                 comment_id, COMMENT_TEXTS[comment_id % len(COMMENT_TEXTS)]))
+            if len(teacher_ids) and rng.random() < params["teacher_reply_rate"]:
+                teacher_id = int(teacher_ids[comment_id % len(teacher_ids)])
+                reply_id = id_counters["comment"]; id_counters["comment"] += 1
+                comment_rows.append((reply_id, teacher_id, *_name(teacher_id), step_id, comment_id,
+                                     comment_time + int(rng.integers(600, 86400)), '0', comment_id,
+                                     TEACHER_REPLY_TEXTS[reply_id % len(TEACHER_REPLY_TEXTS)]))
+
+    _write_csv(os.path.join(course_dir, 'comments.csv'),
+               ['comment_id', 'user_id', 'last_name', 'first_name', 'step_id', 'parent_comment_id',
+                'time', 'deleted', 'thread', 'text'], comment_rows)
+    _write_additional_info(os.path.join(course_dir, 'AdditionalInfo.xlsx'), course_id, steps, unique_views, passed, rng)
+
+    return {"course_id": course_id, "learners": learner_count, "steps": len(steps),
+            "submissions": submissions_count, "comments": len(comment_rows)}
+
+
+def generate_dataset(output_dir, **overrides):
+    """
+    Генерирует набор данных из params["courses"] курсов в output_dir/course_<id>.
+    Параметры — как в DEFAULT_PARAMS; target_submissions подбирает число учащихся.
+    Возвращает сводку (она же сохраняется в output_dir/dataset.json).
+    """
+    params = dict(DEFAULT_PARAMS)
+    target_submissions = overrides.pop('target_submissions', None)
+    params.update({key: value for key, value in overrides.items() if value is not None})
+    if target_submissions:
+        params["learners"] = learners_for_target(target_submissions, params)
+
+    rng = np.random.default_rng(params["seed"])
+    os.makedirs(output_dir, exist_ok=True)
+    id_counters = {"submission": 1, "comment": 1}
+    learner_count = params["learners"]
+    overlap_shift = max(1, int(round(learner_count * (1 - params["learner_overlap"]))))
+    print(f"--- Генерация данных: курсов={params['courses']}, учащихся на курс={learner_count}, папка={output_dir} ---")
+
+    courses = []
+    for course_index in range(params["courses"]):
+        course_id = course_index + 1
+        # Пул учащихся курса частично пересекается с пулом предыдущего курса
+        learner_ids = np.arange(learner_count, dtype=np.int64) + 100000 + course_index * overlap_shift
+        teacher_ids = np.arange(params["teachers"], dtype=np.int64) + 10 + course_index * params["teachers"]
+        course_summary = generate_course(os.path.join(output_dir, f'course_{course_id}'), course_id,
+                                         learner_ids, teacher_ids, params, rng, id_counters)
+        print(f"    ... Курс {course_id}: шагов={course_summary['steps']}, "
+              f"отправок={course_summary['submissions']}, комментариев={course_summary['comments']}")
+        courses.append(course_summary)
+
+    summary = {
+        "params": params,
+        "target_submissions": target_submissions,
+        "courses": courses,
+        "submissions": sum(course["submissions"] for course in courses),
+        "comments": sum(course["comments"] for course in courses),
+    }
+    with open(os.path.join(output_dir, DATASET_INFO_FILE), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"--- Готово: всего отправок={summary['submissions']}, комментариев={summary['comments']} ---")
+    return summary
+
+
+def course_folders(output_dir):
+    """Папки курсов набора данных в порядке course_id."""
+    with open(os.path.join(output_dir, DATASET_INFO_FILE), encoding='utf-8') as f:
+        summary = json.load(f)
+    return [os.path.join(output_dir, f"course_{course['course_id']}") for course in summary["courses"]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic Stepik-format course dataset.')
+    parser.add_argument('output_dir', type=str, help='Папка для набора данных')
+    parser.add_argument('--target-submissions', type=int, default=None, help='Подобрать число учащихся под объем отправок')
+    for param_name, default in DEFAULT_PARAMS.items():
+        parser.add_argument(f"--{param_name.replace('_', '-')}", type=type(default), default=None,
+                            help=f'По умолчанию {default}')
+    args = vars(parser.parse_args())
+    generate_dataset(args.pop('output_dir'), **args)
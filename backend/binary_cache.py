@@ -0,0 +1,209 @@
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from .file_cache import CACHE_DIR, load_cache_from_file
+
+# --- Компактный файловый кеш структуры курса (.bin) ---
+# Список словарей шагов хранится по колонкам: целые — int64 (None — INT_NULL), дробные — float64
+# (None — NaN), строки — номера int32 в таблице уникальных строк (None — -1). Значения, не
+# подходящие ни под один тип колонки (смесь int/float, вложенные структуры), хранятся как JSON-строки
+# в той же таблице. Файл читается через mmap: процессы делят страницы файла в page cache, а срез
+# по полям (?metrics=) декодирует только нужные колонки и только встреченные в них строки.
+#
+# Формат: MAGIC, версия и длина заголовка (struct HEADER_FORMAT), заголовок JSON
+# {"rows", "fields": [{"name", "kind", "offset"}], "strings": {"count", "offsets", "data"}},
+# затем колонки (выровнены по 8 байт), смещения строк (uint64, count + 1) и байты строк UTF-8.
+MAGIC = b'SMCB'
+FORMAT_VERSION = 1
+HEADER_FORMAT = '<4sII'
+INT_NULL = np.iinfo(np.int64).min
+STRING_NULL = -1
+COLUMN_DTYPES = {"int": np.dtype('<i8'), "float": np.dtype('<f8'), "str": np.dtype('<i4'), "json": np.dtype('<i4')}
+
+
+def _column_kind(values):
+    """Тип колонки по значениям: int, float, str или json (универсальный, без потери типа значений)."""
+    present = [value for value in values if value is not None]
+    if all(type(value) is int and INT_NULL < value <= np.iinfo(np.int64).max for value in present):
+        return "int"
+    if all(type(value) is float and not math.isnan(value) for value in present):
+        return "float"
+    if all(type(value) is str for value in present):
+        return "str"
+    return "json"
+
+
+def _align(position):
+    return (position + 7) // 8 * 8
+
+
+def encode_structure(results_list):
+    """Байты .bin для списка словарей шагов (порядок полей — как в первом шаге, затем новые)."""
+    names = list(dict.fromkeys(name for step_data in results_list for name in step_data))
+    strings, string_ids = [], {}
+
+    def intern(text):
+        if text not in string_ids:
+            string_ids[text] = len(strings)
+            strings.append(text)
+        return string_ids[text]
+
+    fields, columns = [], []
+    for name in names:
+        values = [step_data.get(name) for step_data in results_list]
+        kind = _column_kind(values)
+        if kind == "int":
+            column = np.array([INT_NULL if value is None else value for value in values], dtype=COLUMN_DTYPES[kind])
+        elif kind == "float":
+            column = np.array([np.nan if value is None else value for value in values], dtype=COLUMN_DTYPES[kind])
+        elif kind == "str":
+            column = np.array([STRING_NULL if value is None else intern(value) for value in values], dtype=COLUMN_DTYPES[kind])
+        else:
+            column = np.array([STRING_NULL if value is None else intern(json.dumps(value, ensure_ascii=False))
+                               for value in values], dtype=COLUMN_DTYPES[kind])
+        fields.append({"name": name, "kind": kind})
+        columns.append(column)
+    encoded_strings = [text.encode('utf-8') for text in strings]
+    string_offsets = np.zeros(len(encoded_strings) + 1, dtype='<u8')
+    string_offsets[1:] = np.cumsum([len(data) for data in encoded_strings], dtype='<u8')
+
+    # Смещения зависят от длины заголовка, а заголовок — от смещений: место под заголовок берется
+    # с запасом на удлинение записи каждого смещения
+    def build_header(data_start):
+        position = data_start
+        for field, column in zip(fields, columns):
+            field["offset"] = position
+            position = _align(position + column.nbytes)
+        strings_header = {"count": len(strings), "offsets": position, "data": position + string_offsets.nbytes}
+        return json.dumps({"rows": len(results_list), "fields": fields, "strings": strings_header},
+                          ensure_ascii=False).encode('utf-8'), position
+
+    prefix_size = struct.calcsize(HEADER_FORMAT)
+    header, _ = build_header(0)
+    data_start = _align(prefix_size + len(header) + 16 * (len(fields) + 2))
+    header, strings_start = build_header(data_start)
+    assert prefix_size + len(header) <= data_start
+
+    parts = [struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, len(header)), header]
+    position = prefix_size + len(header)
+    for field, column in zip(fields, columns):
+        parts.append(b'\0' * (field["offset"] - position))
+        parts.append(column.tobytes())
+        position = field["offset"] + column.nbytes
+    parts.append(b'\0' * (strings_start - position))
+    parts.append(string_offsets.tobytes())
+    parts.extend(encoded_strings)
+    return b''.join(parts)
+
+
+def _read_header(buffer):
+    prefix_size = struct.calcsize(HEADER_FORMAT)
+    magic, version, header_size = struct.unpack_from(HEADER_FORMAT, buffer, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f"Неизвестный формат файла кеша (magic={magic!r}, версия {version})")
+    return json.loads(bytes(buffer[prefix_size:prefix_size + header_size]).decode('utf-8'))
+
+
+def decode_structure(buffer, fields=None):
+    """
+    Список словарей шагов из байтов .bin (bytes или mmap). fields — предикат имени поля:
+    читаются только колонки, для которых он истинен (None — все поля).
+    """
+    header = _read_header(buffer)
+    rows = header["rows"]
+    strings_header = header["strings"]
+    string_offsets = np.frombuffer(buffer, dtype='<u8', count=strings_header["count"] + 1,
+                                   offset=strings_header["offsets"]).tolist()
+    strings = {}
+
+    def string_at(index):
+        if index not in strings:
+            start = strings_header["data"] + string_offsets[index]
+            strings[index] = bytes(buffer[start:strings_header["data"] + string_offsets[index + 1]]).decode('utf-8')
+        return strings[index]
+
+    names, columns = [], []
+    for field in header["fields"]:
+        if fields is not None and not fields(field["name"]):
+            continue
+        kind = field["kind"]
+        values = np.frombuffer(buffer, dtype=COLUMN_DTYPES[kind], count=rows, offset=field["offset"]).tolist()
+        if kind == "int":
+            values = [None if value == INT_NULL else value for value in values]
+        elif kind == "float":
+            values = [None if value != value else value for value in values] # NaN != NaN
+        elif kind == "str":
+            values = [None if value == STRING_NULL else string_at(value) for value in values]
+        else:
+            values = [None if value == STRING_NULL else json.loads(string_at(value)) for value in values]
+        names.append(field["name"])
+        columns.append(values)
+    return [dict(zip(names, row_values)) for row_values in zip(*columns)] if columns else [{} for _ in range(rows)]
+
+
+def save_structure_cache(results_list, filepath):
+    """
+    Сохраняет список шагов в .bin. Файл пишется во временный и подменяется атомарно (os.replace),
+    поэтому процессы, уже отобразившие старый файл в память, дочитывают его без ошибок.
+    """
+    try:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        temp_filepath = f"{filepath}.{os.getpid()}.tmp"
+        with open(temp_filepath, 'wb') as f:
+            f.write(encode_structure(results_list))
+        os.replace(temp_filepath, filepath)
+        print(f"--- КЕШ: Данные успешно сохранены в файл {filepath} ---")
+    except (IOError, TypeError, ValueError) as e:
+        print(f"!!! ОШИБКА КЕША: Не удалось сохранить данные в файл {filepath}. Ошибка: {e}")
+
+
+def load_structure_cache(filepath, fields=None):
+    """
+    Список шагов из .bin через mmap (None, если файла нет; поврежденный файл удаляется).
+    fields — предикат имени поля для чтения только части колонок (см. decode_structure).
+    """
+    if not os.path.exists(filepath):
+        return None
+    try:
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            data = decode_structure(buffer, fields)
+        print(f"--- КЕШ: Данные успешно загружены из файла {filepath} ---")
+        return data
+    except (ValueError, IOError, struct.error, UnicodeDecodeError, IndexError) as e:
+        print(f"!!! ОШИБКА КЕША: Не удалось прочитать файл {filepath}. Ошибка: {e}")
+        try:
+            os.remove(filepath)
+            print(f"--- КЕШ: Поврежденный файл кеша {filepath} удален. ---")
+        except OSError as remove_err:
+            print(f"!!! ОШИБКА КЕША: Не удалось удалить поврежденный файл {filepath}. Ошибка: {remove_err}")
+        return None
+
+
+def convert_json_cache(json_filepath, remove_json=False):
+    """Переводит JSON-кеш структуры курса в .bin рядом с ним. Возвращает путь к .bin или None."""
+    data = load_cache_from_file(json_filepath)
+    if not isinstance(data, list):
+        print(f"!!! КЕШ: {json_filepath} не содержит списка шагов, пропуск.")
+        return None
+    bin_filepath = os.path.splitext(json_filepath)[0] + '.bin'
+    save_structure_cache(data, bin_filepath)
+    if remove_json:
+        os.remove(json_filepath)
+    return bin_filepath
+
+
+def convert_cache_dir(cache_dir=CACHE_DIR, remove_json=False):
+    """Переводит все JSON-кеши структуры курсов (structure_cache_metrics_*.json) в .bin. Возвращает [(json, bin, байт до, байт после)]."""
+    converted = []
+    for json_filepath in sorted(glob.glob(os.path.join(cache_dir, 'structure_cache_metrics_*.json'))):
+        json_size = os.path.getsize(json_filepath)
+        bin_filepath = convert_json_cache(json_filepath, remove_json)
+        if bin_filepath is not None:
+            converted.append((json_filepath, bin_filepath, json_size, os.path.getsize(bin_filepath)))
+    return converted
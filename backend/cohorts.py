@@ -0,0 +1,174 @@
+import math
+from datetime import timedelta
+
+import numpy as np
+
+from sqlalchemy import func
+
+from .models import db, Submission, Learner, enrollment_table
+from .structure_metrics import query_course_steps
+from .pairsets import PairSet, lookup_per_user
+from .instrumentation import span
+
+# --- Когорты по дате зачисления: матрица когорта × шаг ---
+# Все когорты курса считаются за один проход по сабмишенам: пары (user, step) из PairSet
+# раскладываются по когортам через индекс когорты пользователя (np.add.at),
+# поэтому стоимость не зависит от числа когорт.
+# Импорт (seed_database.py) не знает времени зачисления и оставляет enrollment_date пустым. Для basis=enrollment
+# вместо него берется первый сабмишен учащегося в курсе, затем Learner.data_joined (регистрация на платформе);
+# сколько учащихся отнесено к когортам по каждому запасному источнику — поле "enrollment_fallbacks" результата.
+COHORT_PERIODS = ('week', 'month')
+COHORT_BASES = ('enrollment', 'joined') # enrollment_date (с запасными источниками, см. выше) или Learner.data_joined
+
+
+def cohort_start(moment, period):
+    """Начало когорты (понедельник недели или 1-е число месяца) для даты/времени."""
+    day = moment.date() if hasattr(moment, 'date') else moment
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    return day.replace(day=1)
+
+
+def cohort_label(start, period):
+    if period == 'week':
+        iso_year, iso_week, _ = start.isocalendar()
+        return f"{iso_year}-W{iso_week:02d}"
+    return start.strftime('%Y-%m')
+
+
+def completion_thresholds(total_submittable_steps):
+    """Пороги диапазонов результативности (как в calculate_course_completion)."""
+    return (math.ceil(total_submittable_steps * 0.80), math.ceil(total_submittable_steps * 0.50),
+            math.ceil(total_submittable_steps * 0.25))
+
+
+def _ratio(numerator, denominator):
+    """Поэлементное деление; None там, где знаменатель 0."""
+    return [float(n) / d if d > 0 else None for n, d in zip(numerator.tolist(), denominator.tolist())]
+
+
+def calculate_course_cohorts(course_id, period='week', basis='enrollment'):
+    """
+    Матрица когорта × шаг для ОДНОГО курса. Для каждой когорты:
+    - learners и диапазоны результативности (доля учащихся по числу верно решенных оцениваемых шагов);
+    - по шагам (массивы в порядке "steps"): attempted, passed, success_rate = passed / attempted,
+      reached_share — доля когорты, дошедшая до шага (есть попытка на этом или более позднем шаге),
+      dropoff_rate — доля пытавшихся, после шага не пытавшихся ничего дальше (как completion_index).
+    """
+    if period not in COHORT_PERIODS:
+        raise ValueError(f"period должен быть одним из {COHORT_PERIODS}")
+    if basis not in COHORT_BASES:
+        raise ValueError(f"basis должен быть одним из {COHORT_BASES}")
+
+    with span("cohorts.course", log=True, course_id=course_id, period=period) as cohort_span:
+        all_steps = query_course_steps(course_id)
+        step_ids = [step.step_id for step in all_steps]
+        step_positions = {step_id: index for index, step_id in enumerate(step_ids)}
+        submittable_step_ids = [step.step_id for step in all_steps if step.step_cost is not None and step.step_cost > 0]
+        result = {"course_id": course_id, "period": period, "basis": basis,
+                  "steps": step_ids, "total_submittable_steps": len(submittable_step_ids), "cohorts": []}
+        if not step_ids:
+            return result
+
+        # 1. Учащиеся курса и их когорты
+        enrolled = db.session.query(Learner.user_id, enrollment_table.c.enrollment_date, Learner.data_joined)\
+            .join(enrollment_table, Learner.user_id == enrollment_table.c.learner_id)\
+            .filter(enrollment_table.c.course_id == course_id, Learner.is_learner == True).all()
+        first_submissions = {}
+        if basis == 'enrollment' and any(enrollment_date is None for _, enrollment_date, _ in enrolled):
+            first_submissions = dict(db.session.query(Submission.user_id, func.min(Submission.submission_time))
+                                     .filter(Submission.step_id.in_(step_ids)).group_by(Submission.user_id).all())
+            result["enrollment_fallbacks"] = {"first_submission": 0, "data_joined": 0}
+        learner_starts = {}
+        for user_id, enrollment_date, data_joined in enrolled:
+            if basis == 'joined':
+                moment = data_joined
+            elif enrollment_date is not None:
+                moment = enrollment_date
+            elif first_submissions.get(user_id) is not None:
+                moment = first_submissions[user_id]
+                result["enrollment_fallbacks"]["first_submission"] += 1
+            else:
+                moment = data_joined
+                result["enrollment_fallbacks"]["data_joined"] += moment is not None
+            if moment is not None:
+                learner_starts[user_id] = cohort_start(moment, period)
+        cohort_starts = sorted(set(learner_starts.values()))
+        if not cohort_starts:
+            return result
+        cohort_index_of = {start: index for index, start in enumerate(cohort_starts)}
+        learner_keys = np.array(sorted(learner_starts), dtype=np.int64)
+        learner_cohorts = np.array([cohort_index_of[learner_starts[user_id]] for user_id in learner_keys.tolist()], dtype=np.int64)
+        cohort_count, step_count = len(cohort_starts), len(step_ids)
+        cohort_sizes = np.bincount(learner_cohorts, minlength=cohort_count)
+
+        # 2. Один запрос сабмишенов курса -> множества пар (user, step)
+        submissions = db.session.query(Submission.user_id, Submission.step_id, Submission.status)\
+            .filter(Submission.step_id.in_(step_ids)).all()
+        attempted_pairs = PairSet.from_pairs((user_id, step_id) for user_id, step_id, _ in submissions)
+        correct_pairs = PairSet.from_pairs((user_id, step_id) for user_id, step_id, status in submissions if status == 'correct')
+        cohort_span["rows"] = len(submissions)
+
+        def cohort_step_matrix(pairs, weights=None):
+            """Счетчик пар по (когорта, позиция шага); пары учащихся вне когорт не учитываются."""
+            matrix = np.zeros((cohort_count, step_count), dtype=np.int64)
+            cohorts = lookup_per_user(pairs.user_ids, learner_keys, learner_cohorts)
+            positions = np.array([step_positions[step_id] for step_id in pairs.step_ids.tolist()], dtype=np.int64)
+            in_cohort = cohorts >= 0
+            if weights is not None:
+                in_cohort &= weights
+            np.add.at(matrix, (cohorts[in_cohort], positions[in_cohort]), 1)
+            return matrix
+
+        attempted = cohort_step_matrix(attempted_pairs)
+        passed = cohort_step_matrix(correct_pairs)
+
+        # 3. Самый дальний начатый шаг каждого пользователя -> отток и доля дошедших
+        attempted_user_ids, furthest_attempted_index = attempted_pairs.furthest_per_user(step_positions)
+        pair_furthest = lookup_per_user(attempted_pairs.user_ids, attempted_user_ids, furthest_attempted_index)
+        pair_positions = np.array([step_positions[step_id] for step_id in attempted_pairs.step_ids.tolist()], dtype=np.int64)
+        stopped = cohort_step_matrix(attempted_pairs, weights=pair_furthest <= pair_positions)
+        stopped[:, -1] = 0 # После последнего шага уходить некуда (как в completion_index)
+
+        user_cohorts = lookup_per_user(attempted_user_ids, learner_keys, learner_cohorts)
+        furthest_counts = np.zeros((cohort_count, step_count), dtype=np.int64)
+        np.add.at(furthest_counts, (user_cohorts[user_cohorts >= 0], furthest_attempted_index[user_cohorts >= 0]), 1)
+        reached = np.cumsum(furthest_counts[:, ::-1], axis=1)[:, ::-1] # Дошедшие до шага k: самый дальний >= k
+
+        # 4. Диапазоны результативности по числу верно решенных оцениваемых шагов
+        submittable_set = set(submittable_step_ids)
+        solved_counts = {}
+        for user_id, step_id in zip(correct_pairs.user_ids.tolist(), correct_pairs.step_ids.tolist()):
+            if step_id in submittable_set:
+                solved_counts[user_id] = solved_counts.get(user_id, 0) + 1
+        threshold_80, threshold_50, threshold_25 = completion_thresholds(len(submittable_step_ids))
+        range_counts = np.zeros((cohort_count, 4), dtype=np.int64)
+        for user_id, cohort_index in zip(learner_keys.tolist(), learner_cohorts.tolist()):
+            solved = solved_counts.get(user_id, 0)
+            if len(submittable_step_ids) == 0: range_index = 3
+            elif solved >= threshold_80: range_index = 0
+            elif solved >= threshold_50: range_index = 1
+            elif solved >= threshold_25: range_index = 2
+            else: range_index = 3
+            range_counts[cohort_index, range_index] += 1
+
+        for cohort_index, start in enumerate(cohort_starts):
+            size = int(cohort_sizes[cohort_index])
+            ranges = {}
+            for range_index, (range_key, threshold) in enumerate((("gte_80", threshold_80), ("gte_50_lt_80", threshold_50),
+                                                                 ("gte_25_lt_50", threshold_25), ("lt_25", threshold_25))):
+                count = int(range_counts[cohort_index, range_index])
+                ranges[range_key] = {"threshold_steps": int(threshold), "count": count,
+                                     "percentage": float(count / size) if size > 0 else 0.0}
+            result["cohorts"].append({
+                "cohort": cohort_label(start, period),
+                "start_date": start.isoformat(),
+                "learners": size,
+                "ranges": ranges,
+                "attempted": attempted[cohort_index].tolist(),
+                "passed": passed[cohort_index].tolist(),
+                "success_rate": _ratio(passed[cohort_index], attempted[cohort_index]),
+                "reached_share": [float(n) / size if size > 0 else None for n in reached[cohort_index].tolist()],
+                "dropoff_rate": _ratio(stopped[cohort_index], attempted[cohort_index]),
+            })
+    return result
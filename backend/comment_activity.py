@@ -0,0 +1,164 @@
+from collections import defaultdict
+
+from sqlalchemy import insert
+
+from .models import db, Comment, Learner, StepCommentRollup
+from .sketches import KLLSketch
+from .rollups import course_step_ids, ROLLUP_STEP_CHUNK
+from .instrumentation import span
+from .db_routing import pin_primary
+
+# --- Активность в обсуждениях шагов (step_comment_rollup) ---
+# Доля комментариев преподавателей, ветки без ответа, доля удаленных и задержка первого ответа
+# преподавателя на ветку учащегося. Дневные строки пересчитываются для шагов, затронутых импортом
+# комментариев (ветка может получить ответ спустя дни), а метрики за период — сумма строк
+# и объединение KLL-скетчей задержки, без чтения comment.
+ACTIVITY_COUNT_FIELDS = ("teacher_comments", "learner_comments", "deleted_comments", "threads_count",
+                         "learner_threads", "unanswered_threads", "teacher_answered_threads")
+RESPONSE_QUANTILES = (0.5, 0.9)
+
+
+def _thread_roots(comments):
+    """{comment_id: id корня ветки}; ответ с отсутствующим (не импортированным) родителем считается корнем."""
+    roots = {}
+    for comment_id in comments:
+        path = []
+        current = comment_id
+        while current not in roots:
+            parent_id = comments[current]["parent_comment_id"]
+            if parent_id is None or parent_id not in comments or parent_id in path or parent_id == current:
+                roots[current] = current
+                break
+            path.append(current)
+            current = parent_id
+        for visited in path:
+            roots[visited] = roots[current]
+    return roots
+
+
+def _activity_rollups(step_ids):
+    """{(step_id, day): поля агрегата} по всем комментариям шагов step_ids."""
+    rows = db.session.query(Comment.comment_id, Comment.step_id, Comment.parent_comment_id, Comment.time,
+                            Comment.deleted, Learner.is_learner)\
+        .outerjoin(Learner, Learner.user_id == Comment.user_id)\
+        .filter(Comment.step_id.in_(step_ids)).all()
+    comments = {row.comment_id: {"step_id": row.step_id, "parent_comment_id": row.parent_comment_id, "time": row.time,
+                                 "deleted": bool(row.deleted), "is_teacher": row.is_learner is False} for row in rows}
+    roots = _thread_roots(comments)
+    rollups = defaultdict(lambda: dict.fromkeys(ACTIVITY_COUNT_FIELDS, 0))
+    response_seconds = defaultdict(list)
+
+    replies = defaultdict(list)
+    for comment_id, comment in comments.items():
+        if roots[comment_id] != comment_id:
+            replies[roots[comment_id]].append(comment)
+        if comment["time"] is None:
+            continue
+        day_rollup = rollups[(comment["step_id"], comment["time"].date())]
+        day_rollup["teacher_comments" if comment["is_teacher"] else "learner_comments"] += 1
+        day_rollup["deleted_comments"] += comment["deleted"]
+
+    for root_id in set(roots.values()):
+        root = comments[root_id]
+        if root["time"] is None:
+            continue
+        key = (root["step_id"], root["time"].date())
+        day_rollup = rollups[key]
+        day_rollup["threads_count"] += 1
+        thread_replies = replies.get(root_id, [])
+        day_rollup["unanswered_threads"] += not thread_replies
+        if root["is_teacher"]:
+            continue
+        day_rollup["learner_threads"] += 1
+        teacher_times = [reply["time"] for reply in thread_replies
+                         if reply["is_teacher"] and reply["time"] is not None and reply["time"] >= root["time"]]
+        if teacher_times:
+            day_rollup["teacher_answered_threads"] += 1
+            response_seconds[key].append((min(teacher_times) - root["time"]).total_seconds())
+
+    for key, day_rollup in rollups.items():
+        seconds = response_seconds.get(key)
+        day_rollup["teacher_response_sketch"] = KLLSketch.from_values(seconds).to_bytes() if seconds else None
+    return rollups
+
+
+def refresh_comment_activity(step_ids):
+    """Пересчитывает дневные агрегаты обсуждений шагов step_ids (удаляет старые строки и записывает новые)."""
+    step_ids = sorted({step_id for step_id in step_ids if step_id is not None})
+    pin_primary(db.session) # Пересчет читает основную БД: агрегаты по отстающей реплике были бы устаревшими
+    with span("comment_activity.refresh", log=True, steps=len(step_ids)) as refresh_span:
+        rows_written = 0
+        for chunk_start in range(0, len(step_ids), ROLLUP_STEP_CHUNK):
+            chunk = step_ids[chunk_start:chunk_start + ROLLUP_STEP_CHUNK]
+            rollups = _activity_rollups(chunk)
+            db.session.query(StepCommentRollup).filter(StepCommentRollup.step_id.in_(chunk)).delete(synchronize_session=False)
+            if rollups:
+                db.session.execute(insert(StepCommentRollup), [
+                    {"step_id": step_id, "day": day, **values} for (step_id, day), values in sorted(rollups.items())])
+            db.session.commit()
+            rows_written += len(rollups)
+        refresh_span["rows"] = rows_written
+    return rows_written
+
+
+def ensure_comment_activity(step_ids):
+    """Строит агрегаты, если для шагов их еще нет совсем (например, БД заполнена до появления таблицы)."""
+    if db.session.query(StepCommentRollup.step_id).filter(StepCommentRollup.step_id.in_(step_ids)).first() is None:
+        if db.session.query(Comment.comment_id).filter(Comment.step_id.in_(step_ids)).first() is not None:
+            print(f"--- Агрегаты обсуждений для {len(step_ids)} шагов не найдены, построение... ---")
+            refresh_comment_activity(step_ids)
+
+
+def _activity_metrics(totals, response_sketch):
+    """Производные метрики из сумм счетчиков и скетча задержки ответа."""
+    comments_total = totals["teacher_comments"] + totals["learner_comments"]
+    response_quantiles = response_sketch.quantiles(RESPONSE_QUANTILES) # None, если ответов преподавателей нет
+    return {
+        **totals,
+        "comments_count": comments_total,
+        "teacher_comment_share": totals["teacher_comments"] / comments_total if comments_total else None,
+        "deleted_comment_ratio": totals["deleted_comments"] / comments_total if comments_total else None,
+        "unanswered_thread_share": totals["unanswered_threads"] / totals["threads_count"] if totals["threads_count"] else None,
+        "teacher_answered_share": (totals["teacher_answered_threads"] / totals["learner_threads"]
+                                   if totals["learner_threads"] else None),
+        "teacher_response_median_seconds": response_quantiles[0],
+        "teacher_response_p90_seconds": response_quantiles[1],
+    }
+
+
+def course_comment_activity(course_id, date_from=None, date_to=None):
+    """
+    Метрики обсуждений по шагам курса и по курсу в целом за период [date_from, date_to]
+    (комментарии — по дню написания, ветки — по дню корневого комментария).
+    """
+    step_ids = course_step_ids(course_id)
+    result = {"course_id": course_id, "course": None, "steps": []}
+    if not step_ids:
+        return result
+    with span("comment_activity.course", log=True, course_id=course_id) as activity_span:
+        ensure_comment_activity(step_ids)
+        rollup_query = db.session.query(StepCommentRollup).filter(StepCommentRollup.step_id.in_(step_ids))
+        if date_from is not None:
+            rollup_query = rollup_query.filter(StepCommentRollup.day >= date_from)
+        if date_to is not None:
+            rollup_query = rollup_query.filter(StepCommentRollup.day <= date_to)
+        rollups = rollup_query.all()
+        activity_span["rows"] = len(rollups)
+
+        step_totals, step_sketches = {}, {}
+        for rollup in rollups:
+            totals = step_totals.setdefault(rollup.step_id, dict.fromkeys(ACTIVITY_COUNT_FIELDS, 0))
+            for field in ACTIVITY_COUNT_FIELDS:
+                totals[field] += getattr(rollup, field) or 0
+            sketch = step_sketches.setdefault(rollup.step_id, KLLSketch())
+            if rollup.teacher_response_sketch:
+                sketch.merge(KLLSketch.from_bytes(rollup.teacher_response_sketch))
+
+        course_totals, course_sketch = dict.fromkeys(ACTIVITY_COUNT_FIELDS, 0), KLLSketch()
+        for step_id in sorted(step_totals):
+            for field in ACTIVITY_COUNT_FIELDS:
+                course_totals[field] += step_totals[step_id][field]
+            course_sketch.merge(step_sketches[step_id])
+            result["steps"].append({"step_id": step_id, **_activity_metrics(step_totals[step_id], step_sketches[step_id])})
+        result["course"] = _activity_metrics(course_totals, course_sketch)
+    return result
@@ -0,0 +1,159 @@
+import re
+import html
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, distinct, case, insert, or_
+
+from .models import db, Comment, CommentTerm, Learner
+from .instrumentation import span
+
+# --- Поиск по тексту комментариев (инвертированный индекс comment_term) ---
+# Текст разбивается на слова (буквы/цифры, нижний регистр, ё -> е); для каждого слова комментария
+# хранится строка (term, comment_id, step_id, time). Поиск — диапазон по первичному ключу (term, ...)
+# для каждого слова запроса и GROUP BY comment_id: найдены комментарии, где есть ВСЕ слова запроса.
+# Фильтры по шагам/курсу и дате проверяются на строках индекса, текст читается только для страницы.
+TERM_PATTERN = re.compile(r'[0-9a-zа-яё]+')
+QUERY_TERM_PATTERN = re.compile(r'([0-9a-zа-яё]+)(\*?)') # "слово*" — поиск по префиксу
+WORD_CHARS = '0-9a-zа-яё'
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64 # Длина колонки comment_term.term; более длинные слова обрезаются
+MAX_QUERY_TERMS = 8
+INDEX_COMMENT_CHUNK = 2000
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+SNIPPET_CONTEXT_CHARS = 80
+
+
+def _normalize(text):
+    return text.lower().replace('ё', 'е')
+
+
+def comment_terms(text):
+    """Множество слов текста для индекса (короче MIN_TERM_LENGTH — пропускаются)."""
+    if not text:
+        return set()
+    return {term[:MAX_TERM_LENGTH] for term in TERM_PATTERN.findall(_normalize(text)) if len(term) >= MIN_TERM_LENGTH}
+
+
+def parse_query(query_text):
+    """[(слово, по_префиксу)] из строки запроса; повторы и слишком короткие слова отбрасываются."""
+    terms = []
+    for term, star in QUERY_TERM_PATTERN.findall(_normalize(query_text or '')):
+        if len(term) >= MIN_TERM_LENGTH and (term[:MAX_TERM_LENGTH], bool(star)) not in terms:
+            terms.append((term[:MAX_TERM_LENGTH], bool(star)))
+    return terms[:MAX_QUERY_TERMS]
+
+
+def index_comments(comment_ids):
+    """Пересобирает строки индекса для комментариев comment_ids (после импорта/обновления)."""
+    comment_ids = sorted(set(comment_ids))
+    rows_written = 0
+    with span("comment_search.index", log=True, comments=len(comment_ids)) as index_span:
+        for chunk_start in range(0, len(comment_ids), INDEX_COMMENT_CHUNK):
+            chunk = comment_ids[chunk_start:chunk_start + INDEX_COMMENT_CHUNK]
+            comments = db.session.query(Comment.comment_id, Comment.step_id, Comment.time, Comment.text_clear)\
+                .filter(Comment.comment_id.in_(chunk)).all()
+            values = [{"term": term, "comment_id": comment.comment_id, "step_id": comment.step_id, "time": comment.time}
+                      for comment in comments for term in comment_terms(comment.text_clear)]
+            db.session.query(CommentTerm).filter(CommentTerm.comment_id.in_(chunk)).delete(synchronize_session=False)
+            if values:
+                db.session.execute(insert(CommentTerm), values)
+            db.session.commit()
+            rows_written += len(values)
+        index_span["rows"] = rows_written
+    return rows_written
+
+
+def rebuild_comment_index():
+    """Индекс по всем комментариям."""
+    return index_comments([row.comment_id for row in db.session.query(Comment.comment_id).all()])
+
+
+def _term_condition(term, prefix):
+    return CommentTerm.term.like(f"{term}%") if prefix else CommentTerm.term == term
+
+
+def _matches_query(terms, step_ids=None, date_from=None, date_to=None):
+    """Запрос (comment_id, step_id) комментариев, содержащих все слова terms, с учетом фильтров."""
+    term_conditions = [_term_condition(term, prefix) for term, prefix in terms]
+    # Номер слова запроса, которому соответствует строка индекса: префикс может совпасть с несколькими словами
+    term_number = case(*[(condition, number) for number, condition in enumerate(term_conditions)])
+    match_query = db.session.query(CommentTerm.comment_id.label('comment_id'), func.min(CommentTerm.step_id).label('step_id'))\
+        .filter(or_(*term_conditions))
+    if step_ids is not None:
+        match_query = match_query.filter(CommentTerm.step_id.in_(step_ids))
+    if date_from is not None:
+        match_query = match_query.filter(CommentTerm.time >= datetime.combine(date_from, datetime.min.time()))
+    if date_to is not None:
+        match_query = match_query.filter(CommentTerm.time < datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+    return match_query.group_by(CommentTerm.comment_id).having(func.count(distinct(term_number)) == len(terms))
+
+
+def step_match_counts(terms, step_ids=None, date_from=None, date_to=None):
+    """{step_id: число найденных комментариев} — только по индексу, без чтения текста."""
+    matches = _matches_query(terms, step_ids, date_from, date_to).subquery()
+    rows = db.session.query(matches.c.step_id, func.count(matches.c.comment_id)).group_by(matches.c.step_id).all()
+    return {step_id: count for step_id, count in rows}
+
+
+def highlight_snippet(text, terms, context_chars=SNIPPET_CONTEXT_CHARS):
+    """
+    Фрагмент текста вокруг первого совпадения (HTML-экранированный), совпадения обернуты в <mark>.
+    Совпадения ищутся по тексту с ё -> е, длина строки при этом не меняется.
+    """
+    if not text:
+        return ""
+    alternatives = [re.escape(term) + (f'[{WORD_CHARS}]*' if prefix else f'(?![{WORD_CHARS}])') for term, prefix in terms]
+    pattern = re.compile(f"(?<![{WORD_CHARS}])(?:{'|'.join(alternatives)})", re.IGNORECASE)
+    searchable = text.replace('ё', 'е').replace('Ё', 'Е')
+    first_match = pattern.search(searchable)
+    start = max(0, first_match.start() - context_chars) if first_match else 0
+    end = min(len(text), (first_match.end() if first_match else 0) + context_chars)
+
+    parts, position = [], start
+    for match in pattern.finditer(searchable, start, end):
+        if match.end() > end:
+            break
+        parts.append(html.escape(text[position:match.start()]))
+        parts.append(f"<mark>{html.escape(text[match.start():match.end()])}</mark>")
+        position = match.end()
+    parts.append(html.escape(text[position:end]))
+    return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(text) else "")
+
+
+def search_comments(query_text, step_ids=None, date_from=None, date_to=None, limit=SEARCH_PAGE_SIZE, before_id=None,
+                    with_step_counts=True):
+    """
+    Комментарии, содержащие все слова запроса, от новых к старым (по comment_id), страницами по ключу:
+    следующая страница — before_id=next_before_id. with_step_counts — добавить число найденных по шагам.
+    """
+    terms = parse_query(query_text)
+    if not terms:
+        raise ValueError("Запрос не содержит слов для поиска")
+    with span("comment_search.search", log=True, terms=len(terms)) as search_span:
+        match_query = _matches_query(terms, step_ids, date_from, date_to)
+        if before_id is not None:
+            match_query = match_query.filter(CommentTerm.comment_id < before_id)
+        page_ids = [row.comment_id for row in match_query.order_by(CommentTerm.comment_id.desc()).limit(limit + 1).all()]
+        next_before_id = page_ids[limit - 1] if len(page_ids) > limit else None
+        page_ids = page_ids[:limit]
+
+        comments = db.session.query(Comment, Learner.first_name, Learner.last_name, Learner.is_learner)\
+            .outerjoin(Learner, Learner.user_id == Comment.user_id)\
+            .filter(Comment.comment_id.in_(page_ids)).order_by(Comment.comment_id.desc()).all() if page_ids else []
+        items = [{
+            "comment_id": comment.comment_id, "step_id": comment.step_id, "user_id": comment.user_id,
+            "first_name": first_name, "last_name": last_name, "is_learner": is_learner,
+            "parent_comment_id": comment.parent_comment_id, "deleted": comment.deleted,
+            "time": comment.time.isoformat() if comment.time else None,
+            "snippet": highlight_snippet(comment.text_clear, terms),
+        } for comment, first_name, last_name, is_learner in comments]
+        search_span["rows"] = len(items)
+
+        result = {"terms": [term + ("*" if prefix else "") for term, prefix in terms], "items": items,
+                  "next_before_id": next_before_id}
+        if with_step_counts:
+            step_counts = step_match_counts(terms, step_ids, date_from, date_to)
+            result["total"] = sum(step_counts.values())
+            result["step_counts"] = {str(step_id): count for step_id, count in sorted(step_counts.items(), key=lambda item: -item[1])}
+    return result
@@ -0,0 +1,85 @@
+from sqlalchemy import select, literal, func
+from sqlalchemy.orm import aliased
+
+from .models import db, Comment, Learner
+from .instrumentation import span
+
+# --- Обсуждение шага: деревья комментариев ---
+# Страница корневых комментариев шага выбирается по ключу (comment_id), затем все ответы
+# этих веток на любую глубину читаются одним рекурсивным CTE — без запроса на каждый уровень
+# ответов (ленивые Comment.replies) и без чтения всех комментариев шага.
+THREADS_PAGE_SIZE = 20
+MAX_THREADS_PAGE_SIZE = 100
+MAX_THREAD_DEPTH = 100 # Защита от циклов parent_comment_id в данных
+
+
+def _root_comments_query(step_id):
+    """
+    Корни веток шага: комментарии без родителя, а также ответы, родитель которых не импортирован
+    (иначе они не попали бы ни в одну ветку).
+    """
+    parent = aliased(Comment)
+    return db.session.query(Comment.comment_id)\
+        .outerjoin(parent, parent.comment_id == Comment.parent_comment_id)\
+        .filter(Comment.step_id == step_id, parent.comment_id.is_(None))
+
+
+def _thread_rows(root_ids):
+    """Все комментарии веток root_ids одним рекурсивным запросом: (Comment, root_id, depth, имя, фамилия, is_learner)."""
+    tree = select(Comment.comment_id, Comment.comment_id.label('root_id'), literal(0).label('depth'))\
+        .where(Comment.comment_id.in_(root_ids))\
+        .cte('thread_tree', recursive=True)
+    reply = aliased(Comment)
+    tree = tree.union_all(
+        select(reply.comment_id, tree.c.root_id, tree.c.depth + 1)
+        .where(reply.parent_comment_id == tree.c.comment_id, tree.c.depth < MAX_THREAD_DEPTH))
+    return db.session.query(Comment, tree.c.root_id, tree.c.depth, Learner.first_name, Learner.last_name, Learner.is_learner)\
+        .join(tree, tree.c.comment_id == Comment.comment_id)\
+        .outerjoin(Learner, Learner.user_id == Comment.user_id)\
+        .order_by(Comment.comment_id).all()
+
+
+def _comment_node(comment, depth, first_name, last_name, is_learner):
+    return {
+        "comment_id": comment.comment_id, "parent_comment_id": comment.parent_comment_id, "depth": depth,
+        "user_id": comment.user_id, "first_name": first_name, "last_name": last_name, "is_learner": is_learner,
+        "time": comment.time.isoformat() if comment.time else None, "deleted": comment.deleted,
+        "text": comment.text_clear, "reply_count": 0, "descendant_count": 0, "replies": [],
+    }
+
+
+def _count_descendants(node):
+    node["reply_count"] = len(node["replies"])
+    node["descendant_count"] = sum(1 + _count_descendants(reply) for reply in node["replies"])
+    return node["descendant_count"]
+
+
+def step_comment_threads(step_id, limit=THREADS_PAGE_SIZE, before_root_id=None):
+    """
+    Ветки обсуждения шага от новых к старым (по comment_id корня), ответы внутри ветки — по порядку.
+    Следующая страница — before_root_id=next_before_root_id. Возвращает словарь с total_threads и items.
+    """
+    with span("comment_threads.step", log=True, step_id=step_id) as threads_span:
+        roots_query = _root_comments_query(step_id)
+        total_threads = roots_query.with_entities(func.count(Comment.comment_id)).scalar()
+        if before_root_id is not None:
+            roots_query = roots_query.filter(Comment.comment_id < before_root_id)
+        root_ids = [row.comment_id for row in roots_query.order_by(Comment.comment_id.desc()).limit(limit + 1).all()]
+        next_before_root_id = root_ids[limit - 1] if len(root_ids) > limit else None
+        root_ids = root_ids[:limit]
+
+        rows = _thread_rows(root_ids) if root_ids else []
+        threads_span["rows"] = len(rows)
+        nodes = {}
+        for comment, root_id, depth, first_name, last_name, is_learner in rows:
+            if comment.comment_id in nodes: # Комментарий достижим по двум путям только при цикле в данных
+                continue
+            nodes[comment.comment_id] = _comment_node(comment, depth, first_name, last_name, is_learner)
+        for node in nodes.values():
+            parent = nodes.get(node["parent_comment_id"]) if node["depth"] > 0 else None
+            if parent is not None:
+                parent["replies"].append(node)
+        threads = [nodes[root_id] for root_id in root_ids if root_id in nodes]
+        for thread in threads:
+            _count_descendants(thread)
+    return {"step_id": step_id, "total_threads": total_threads, "items": threads, "next_before_root_id": next_before_root_id}
@@ -0,0 +1,83 @@
+import os
+
+from flask import current_app, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
+
+# --- Подключения к БД: параметры пула и чтение с реплики ---
+# Основная БД (SQLALCHEMY_DATABASE_URI) принимает запись: импорт (seed_database.py), агрегаты, версии
+# структуры. Если задан DATABASE_REPLICA_URI, SELECT-запросы GET-запросов /api/metrics уходят на реплику
+# (bind "replica"), пока сессия ничего не записала: после первой записи (или pin_primary) все запросы
+# сессии идут в основную БД, чтобы читать собственные изменения без отставания реплики.
+# Без реплики (локально) все запросы идут в основную БД.
+REPLICA_BIND_KEY = "replica"
+READ_REPLICA_KEY = "read_replica" # Ключи session.info
+PRIMARY_PINNED_KEY = "primary_pinned"
+STREAM_CHUNK_ROWS = 10000
+DEFAULT_POOL_RECYCLE_SECONDS = 3600 # Меньше wait_timeout MySQL по умолчанию (8 ч)
+
+
+def engine_options_from_env(environ=os.environ):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS из окружения: DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE (сек, по умолчанию 3600), DB_POOL_PRE_PING (по умолчанию включен, 0 — выключить).
+    Не заданные размеры пула остаются значениями SQLAlchemy по умолчанию.
+    """
+    options = {
+        "pool_pre_ping": environ.get('DB_POOL_PRE_PING', '1') != '0',
+        "pool_recycle": int(environ.get('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE_SECONDS)),
+    }
+    for name, option in (('DB_POOL_SIZE', 'pool_size'), ('DB_MAX_OVERFLOW', 'max_overflow'), ('DB_POOL_TIMEOUT', 'pool_timeout')):
+        if environ.get(name):
+            options[option] = int(environ[name])
+    return options
+
+
+def configure_database(app, database_uri, replica_uri=None, environ=os.environ):
+    """Настройки БД приложения: основная БД, реплика для чтения (или None) и параметры пула из окружения."""
+    engine_options = engine_options_from_env(environ)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    app.config['DATABASE_REPLICA_URI'] = replica_uri
+    # Параметры пула Flask-SQLAlchemy не применяет к bind'ам, заданным строкой — передаются явно
+    app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND_KEY: {"url": replica_uri, **engine_options}} if replica_uri else {}
+    # Серверный курсор для больших выборок (stream_results_query), DB_STREAM_RESULTS=0 — выключить
+    app.config['DB_STREAM_RESULTS'] = environ.get('DB_STREAM_RESULTS', '1') != '0'
+
+
+def read_database_uri():
+    """URI для процессов-воркеров, которые только читают (расчет метрик по запросу): реплика, если она задана."""
+    return current_app.config.get('DATABASE_REPLICA_URI') or current_app.config['SQLALCHEMY_DATABASE_URI']
+
+
+class RoutingSession(Session):
+    """Сессия Flask-SQLAlchemy, которая направляет SELECT на реплику (см. описание модуля)."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get(READ_REPLICA_KEY) and not self.info.get(PRIMARY_PINNED_KEY):
+            if self._flushing or isinstance(clause, UpdateBase):
+                self.info[PRIMARY_PINNED_KEY] = True
+            elif isinstance(clause, Select) and REPLICA_BIND_KEY in self._db.engines:
+                return self._db.engines[REPLICA_BIND_KEY]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def use_read_replica(session):
+    """Чтение сессии — с реплики (до первой записи). Вызывается для GET-запросов метрик."""
+    session.info[READ_REPLICA_KEY] = True
+
+
+def pin_primary(session):
+    """Все дальнейшие запросы сессии — в основную БД (чтение перед записью, которому нельзя отставать)."""
+    session.info[PRIMARY_PINNED_KEY] = True
+
+
+def stream_results_query(query, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Большая выборка через серверный курсор (если включен DB_STREAM_RESULTS): драйвер отдает строки
+    порциями по chunk_rows, а не буферизует весь результат перед построением строк SQLAlchemy.
+    """
+    if has_app_context() and current_app.config.get('DB_STREAM_RESULTS'):
+        return query.yield_per(chunk_rows)
+    return query
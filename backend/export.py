@@ -0,0 +1,99 @@
+import csv
+import io
+import os
+import tempfile
+
+from openpyxl import Workbook
+
+# --- Выгрузка метрик в CSV/XLSX ---
+# Строки подаются генератором и сразу пишутся в ответ: CSV — порциями через генератор Response,
+# XLSX — через write-only книгу openpyxl (строки уходят во временный файл, а не в память),
+# затем файл отдается кусками. Память не зависит от числа строк.
+EXPORT_FORMATS = {
+    "csv": "text/csv", # Flask добавит "; charset=utf-8"
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+COMPLETION_RANGES = ("gte_80", "gte_50_lt_80", "gte_25_lt_50", "lt_25")
+EXPORT_COLUMNS = {
+    # Поля шага в /steps/structure (structure_metrics.build_step_data), в том же порядке
+    "structure": (
+        "step_id", "step_position", "step_type", "step_cost", "lesson_id", "lesson_position",
+        "module_id", "module_position", "module_title", "course_id", "course_title",
+        "step_title_short", "step_title_full", "views", "unique_views", "passed_users_sub", "all_users_attempted",
+        "difficulty_index", "success_rate", "skip_rate_numerator_r", "skip_rate_denominator_t",
+        "discrimination_index", "skip_rate", "completion_index", "completion_numerator_r", "completion_denominator_t",
+        "avg_attempts_per_passed", "comment_count", "comment_rate", "usefulness_index",
+        "avg_completion_time_filtered_seconds", "solve_time_p50_seconds", "solve_time_p75_seconds", "solve_time_p90_seconds",
+    ),
+    # Диапазоны результативности развернуты в колонки <диапазон>_count/_percentage/_threshold_steps
+    "completion_rates": ("course_id", "course_title", "total_learners_on_course", "total_submittable_steps") + tuple(
+        f"{range_key}_{field}" for range_key in COMPLETION_RANGES for field in ("count", "percentage", "threshold_steps")
+    ) + ("message", "error"),
+    "teachers": ("user_id", "first_name", "last_name", "last_login", "data_joined"),
+    "learner_progress": ("learner_id", "first_name", "last_name", "is_learner", "steps_attempted", "steps_solved",
+                         "score_sum", "attempts", "first_activity", "last_activity"),
+}
+CSV_FLUSH_ROWS = 500
+FILE_CHUNK_BYTES = 64 * 1024
+
+
+def resolve_columns(dataset, columns_arg=None):
+    """Колонки выгрузки из ?columns=a,b,c (по умолчанию — все колонки набора); ValueError для неизвестных."""
+    available = EXPORT_COLUMNS[dataset]
+    if not columns_arg:
+        return list(available)
+    columns = [column.strip() for column in columns_arg.split(',') if column.strip()]
+    unknown = [column for column in columns if column not in available]
+    if unknown or not columns:
+        raise ValueError(f"Неизвестные колонки: {', '.join(unknown) or '(пусто)'}. Доступны: {', '.join(available)}")
+    return columns
+
+
+def flatten_completion_rates(course_data):
+    """Строка выгрузки из результата calculate_course_completion (диапазоны — в отдельные колонки)."""
+    row = {key: course_data.get(key) for key in ("course_id", "course_title", "total_learners_on_course",
+                                                 "total_submittable_steps", "message", "error")}
+    for range_key in COMPLETION_RANGES:
+        range_data = (course_data.get("ranges") or {}).get(range_key) or {}
+        for field in ("count", "percentage", "threshold_steps"):
+            row[f"{range_key}_{field}"] = range_data.get(field)
+    return row
+
+
+def csv_stream(rows, columns):
+    """Генератор CSV (UTF-8 с BOM — чтобы Excel верно открыл кириллицу)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for row_number, row in enumerate(rows, start=1):
+        writer.writerow(["" if row.get(column) is None else row.get(column) for column in columns])
+        if row_number % CSV_FLUSH_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def xlsx_stream(rows, columns, sheet_title):
+    """
+    Генератор XLSX: строки пишутся write-only книгой openpyxl во временный файл,
+    который затем отдается кусками и удаляется.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=sheet_title[:31]) # Ограничение Excel на длину имени листа
+    sheet.append(columns)
+    for row in rows:
+        sheet.append([row.get(column) for column in columns])
+    file_descriptor, filepath = tempfile.mkstemp(suffix='.xlsx')
+    os.close(file_descriptor)
+    try:
+        workbook.save(filepath)
+        with open(filepath, 'rb') as f:
+            while True:
+                chunk = f.read(FILE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(filepath)
@@ -0,0 +1,68 @@
+import json
+import os
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache') # Папка для кеша рядом с этим файлом
+STRUCTURE_CACHE_FILE = os.path.join(CACHE_DIR, 'structure_cache.json')
+STRUCTURE_CACHE_KEY = 'all_steps_data' # Ключ для in-memory кеша
+TEACHERS_CACHE_FILE = os.path.join(CACHE_DIR, 'teachers_cache.json')
+COMPLETION_RATES_CACHE_FILE = os.path.join(CACHE_DIR, 'completion_rates_cache.json')
+
+# --- Функции для работы с файловым кешем ---
+def load_cache_from_file(filepath):
+    """Загружает данные из JSON-файла, если он существует."""
+    if os.path.exists(filepath):
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+                print(f"--- КЕШ: Данные успешно загружены из файла {filepath} ---")
+                return data
+        except (json.JSONDecodeError, IOError, FileNotFoundError) as e:
+            print(f"!!! ОШИБКА КЕША: Не удалось прочитать или декодировать файл {filepath}. Ошибка: {e}")
+            # Если файл поврежден, лучше его удалить, чтобы пересчитать
+            try:
+                os.remove(filepath)
+                print(f"--- КЕШ: Поврежденный файл кеша {filepath} удален. ---")
+            except OSError as remove_err:
+                 print(f"!!! ОШИБКА КЕША: Не удалось удалить поврежденный файл {filepath}. Ошибка: {remove_err}")
+            return None # Возвращаем None, чтобы данные пересчитались
+    return None # Файла нет
+
+def save_cache_to_file(data, filepath):
+    """
+    Сохраняет данные в JSON-файл, создавая директорию при необходимости. Файл пишется во временный
+    и подменяется атомарно: другой процесс не прочитает недописанный файл (и не удалит его как поврежденный).
+    """
+    try:
+        # Убедимся, что директория существует
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        temp_filepath = f"{filepath}.{os.getpid()}.tmp"
+        with open(temp_filepath, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':')) # Без отступов: файлы кеша читает только код
+        os.replace(temp_filepath, filepath)
+        print(f"--- КЕШ: Данные успешно сохранены в файл {filepath} ---")
+    except (IOError, TypeError) as e:
+        print(f"!!! ОШИБКА КЕША: Не удалось сохранить данные в файл {filepath}. Ошибка: {e}")
+
+def structure_cache_filepath(course_id, params_key="", extension="bin"):
+    """
+    Путь к файловому кешу метрик структуры ОДНОГО курса (params_key — набор параметров метрик, '' — по умолчанию).
+    extension="bin" — компактный формат binary_cache, "json" — прежний формат (читается, если .bin еще нет).
+    """
+    suffix = f"_{params_key}" if params_key else ""
+    return os.path.join(CACHE_DIR, f"structure_cache_metrics_{course_id}{suffix}.{extension}")
+
+def cohorts_cache_filepath(course_id, period, basis):
+    """Путь к файловому кешу матрицы когорта × шаг курса."""
+    return os.path.join(CACHE_DIR, f"cohorts_cache_{course_id}_{period}_{basis}.json")
+
+def benchmark_index_filepath():
+    """Путь к прежнему единому файлу межкурсового индекса (benchmarking; читается для еще не пересчитанных курсов)."""
+    return os.path.join(CACHE_DIR, "benchmark_index.json")
+
+def benchmark_course_filepath(course_id):
+    """Путь к значениям метрик шагов ОДНОГО курса в межкурсовом индексе (benchmarking; '*' — шаблон для glob)."""
+    return os.path.join(CACHE_DIR, "benchmark", f"course_{course_id}.json")
+
+def funnel_cache_filepath(course_id):
+    """Путь к файловому кешу воронки курса."""
+    return os.path.join(CACHE_DIR, f"funnel_cache_{course_id}.json")
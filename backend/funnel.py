@@ -0,0 +1,88 @@
+import numpy as np
+
+from .models import db, Submission, enrollment_table
+from .structure_metrics import query_course_steps
+from .pairsets import PairSet
+from .instrumentation import span
+
+# --- Воронка курса: сколько учащихся доходит до каждого шага ---
+# Для каждого пользователя хватает двух чисел — индексов самого дальнего начатого и самого дальнего
+# решенного шага в порядке курса. Число дошедших до шага k = число пользователей с индексом >= k:
+# гистограмма индексов (np.bincount) и накопленная сумма с конца — один проход по компактному массиву.
+FUNNEL_GROUPS = ('step', 'lesson', 'module')
+
+
+def _survival(furthest_index, step_count):
+    """Число пользователей, у которых самый дальний индекс >= k, для k = 0..step_count-1."""
+    counts = np.bincount(furthest_index, minlength=step_count)
+    return np.cumsum(counts[::-1])[::-1]
+
+
+def _group_funnel(steps, reached, solved, key, attempted_users):
+    """Воронка по урокам/модулям: дошедшие до первого шага группы и до ее последнего шага."""
+    groups = []
+    for index, step in enumerate(steps):
+        group_id = step[key]
+        if not groups or groups[-1][key] != group_id:
+            groups.append({key: group_id, "position": step[key.replace('_id', '_position')],
+                           "first_step_index": index, "last_step_index": index})
+        groups[-1]["last_step_index"] = index
+    for group in groups:
+        first, last = group["first_step_index"], group["last_step_index"]
+        group["reached_start"] = int(reached[first])
+        group["reached_end"] = int(reached[last])
+        group["solved_end"] = int(solved[last])
+        group["reached_share"] = float(reached[first]) / attempted_users if attempted_users else None
+        group["retention_within"] = float(reached[last]) / reached[first] if reached[first] else None
+    return groups
+
+
+def calculate_course_funnel(course_id):
+    """
+    Воронка ОДНОГО курса по шагам в порядке курса и сгруппированная по урокам и модулям:
+    reached — начали шаг k или любой более поздний (кривая выживания), solved — решили шаг k или более поздний,
+    dropped — остановились на шаге k (самый дальний начатый шаг — k).
+    """
+    with span("funnel.course", log=True, course_id=course_id) as funnel_span:
+        all_steps = query_course_steps(course_id)
+        steps = [{"step_id": step.step_id,
+                  "lesson_id": step.lesson.lesson_id if step.lesson else None,
+                  "lesson_position": step.lesson.lesson_position if step.lesson else None,
+                  "module_id": step.lesson.module.module_id if step.lesson and step.lesson.module else None,
+                  "module_position": step.lesson.module.module_position if step.lesson and step.lesson.module else None}
+                 for step in all_steps]
+        step_positions = {step["step_id"]: index for index, step in enumerate(steps)}
+        enrolled = db.session.query(enrollment_table.c.learner_id).filter(enrollment_table.c.course_id == course_id).count()
+        result = {"course_id": course_id, "enrolled": enrolled, "attempted_users": 0, "steps": [], "lesson": [], "module": []}
+        if not steps:
+            return result
+
+        submissions = db.session.query(Submission.user_id, Submission.step_id, Submission.status)\
+            .filter(Submission.step_id.in_(list(step_positions))).all()
+        funnel_span["rows"] = len(submissions)
+        attempted_pairs = PairSet.from_pairs((user_id, step_id) for user_id, step_id, _ in submissions)
+        correct_pairs = PairSet.from_pairs((user_id, step_id) for user_id, step_id, status in submissions if status == 'correct')
+
+        # Компактные массивы по пользователям: индекс самого дальнего начатого и решенного шага
+        _, furthest_attempted = attempted_pairs.furthest_per_user(step_positions)
+        _, furthest_solved = correct_pairs.furthest_per_user(step_positions)
+        step_count = len(steps)
+        reached = _survival(furthest_attempted, step_count)
+        solved = _survival(furthest_solved, step_count)
+        dropped = np.bincount(furthest_attempted, minlength=step_count)
+        attempted_users = len(furthest_attempted)
+        result["attempted_users"] = attempted_users
+
+        for index, step in enumerate(steps):
+            result["steps"].append({
+                **step,
+                "index": index,
+                "reached": int(reached[index]),
+                "solved": int(solved[index]),
+                "dropped": int(dropped[index]) if index < step_count - 1 else 0, # С последнего шага уходить некуда
+                "reached_share": float(reached[index]) / attempted_users if attempted_users else None,
+                "retention_from_previous": (float(reached[index]) / reached[index - 1] if index and reached[index - 1] else None),
+            })
+        result["lesson"] = _group_funnel(steps, reached, solved, "lesson_id", attempted_users)
+        result["module"] = _group_funnel(steps, reached, solved, "module_id", attempted_users)
+    return result
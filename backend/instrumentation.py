@@ -0,0 +1,182 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# --- Инструментирование: именованные интервалы (spans) с длительностью и числом строк ---
+# Завершенные интервалы хранятся в кольцевом буфере процесса (старые вытесняются).
+# Воркеры пула процессов ведут собственные буферы. Счетчики для Prometheus (число, длительность, строки,
+# ошибки) накапливаются отдельно и не уменьшаются при вытеснении интервалов из буфера.
+SPAN_BUFFER_SIZE = 5000
+SQL_STATEMENT_PREVIEW = 200
+
+_spans = deque(maxlen=SPAN_BUFFER_SIZE)
+_span_totals = {} # Имя интервала -> накопленные с запуска процесса count, total_seconds, rows_total, errors
+_spans_lock = threading.Lock()
+_local = threading.local() # Стек открытых интервалов текущего потока
+_sql_instrumentation_installed = False
+
+
+def _span_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _record(span_data):
+    with _spans_lock:
+        _spans.append(span_data)
+        totals = _span_totals.setdefault(span_data["name"], {"count": 0, "total_seconds": 0.0, "rows_total": 0, "errors": 0})
+        totals["count"] += 1
+        totals["total_seconds"] += span_data["duration_seconds"]
+        totals["rows_total"] += span_data["rows"] or 0
+        if "error" in span_data: totals["errors"] += 1
+
+
+@contextmanager
+def span(name, log=False, **attrs):
+    """
+    Замеряет блок кода как интервал name. Возвращает словарь интервала:
+    в него можно дописать "rows" и любые атрибуты до выхода из блока.
+    log=True — после завершения печатает одну строку с длительностью.
+    """
+    stack = _span_stack()
+    span_data = {"name": name, "parent": stack[-1]["name"] if stack else None,
+                 "started_at": time.time(), "duration_seconds": None, "rows": None}
+    span_data.update(attrs)
+    stack.append(span_data)
+    start = time.perf_counter()
+    try:
+        yield span_data
+    except Exception as e:
+        span_data["error"] = str(e)
+        raise
+    finally:
+        span_data["duration_seconds"] = time.perf_counter() - start
+        stack.pop()
+        _record(span_data)
+        if log:
+            rows_info = f", строк: {span_data['rows']}" if span_data["rows"] is not None else ""
+            print(f"    ... {name}: {span_data['duration_seconds']:.2f} сек{rows_info}")
+
+
+def current_span():
+    """Открытый интервал текущего потока (или None)."""
+    stack = _span_stack()
+    return stack[-1] if stack else None
+
+
+def get_spans(limit=None, name_prefix=None):
+    """Последние завершенные интервалы (новые в конце)."""
+    with _spans_lock:
+        spans = list(_spans)
+    if name_prefix:
+        spans = [s for s in spans if s["name"].startswith(name_prefix)]
+    if limit:
+        spans = spans[-limit:]
+    return spans
+
+
+def span_totals(name_prefix=None):
+    """Накопленные с запуска процесса агрегаты по имени интервала (не зависят от вытеснения из буфера)."""
+    with _spans_lock:
+        return {name: dict(totals) for name, totals in _span_totals.items()
+                if not name_prefix or name.startswith(name_prefix)}
+
+
+def clear_spans():
+    """Очищает буфер интервалов (накопленные счетчики span_totals не сбрасываются)."""
+    with _spans_lock:
+        _spans.clear()
+
+
+def summarize_spans(spans=None):
+    """Агрегаты по имени интервала: число, сумма/максимум/последняя длительность, строки."""
+    summary = {}
+    for s in spans if spans is not None else get_spans():
+        item = summary.setdefault(s["name"], {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+                                              "last_seconds": 0.0, "rows_total": 0, "errors": 0})
+        item["count"] += 1
+        item["total_seconds"] += s["duration_seconds"]
+        item["max_seconds"] = max(item["max_seconds"], s["duration_seconds"])
+        item["last_seconds"] = s["duration_seconds"]
+        item["rows_total"] += s["rows"] or 0
+        if "error" in s: item["errors"] += 1
+    return summary
+
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def prometheus_text(name_prefix=None):
+    """
+    Интервалы в текстовом формате Prometheus: счетчики (*_total) — накопленные с запуска процесса
+    (span_totals), максимум и последняя длительность — по интервалам в буфере.
+    """
+    totals = span_totals(name_prefix)
+    buffered = summarize_spans(get_spans(name_prefix=name_prefix))
+    metrics = [
+        ("course_analytics_span_total", "counter", "Число завершенных интервалов", totals, "count"),
+        ("course_analytics_span_seconds_total", "counter", "Суммарная длительность интервалов, сек", totals, "total_seconds"),
+        ("course_analytics_span_seconds_max", "gauge", "Максимальная длительность интервала в буфере, сек", buffered, "max_seconds"),
+        ("course_analytics_span_seconds_last", "gauge", "Длительность последнего интервала в буфере, сек", buffered, "last_seconds"),
+        ("course_analytics_span_rows_total", "counter", "Суммарное число строк интервалов", totals, "rows_total"),
+        ("course_analytics_span_errors_total", "counter", "Число интервалов, завершившихся ошибкой", totals, "errors"),
+    ]
+    lines = []
+    for metric_name, metric_type, help_text, summary, key in metrics:
+        lines.append(f"# HELP {metric_name} {help_text}")
+        lines.append(f"# TYPE {metric_name} {metric_type}")
+        for span_name, item in sorted(summary.items()):
+            lines.append(f'{metric_name}{{span="{_prometheus_label(span_name)}"}} {item[key]}')
+    return "\n".join(lines) + "\n"
+
+
+# --- SQL-запросы как интервалы (события SQLAlchemy на уровне всех движков) ---
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._instrumentation_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_instrumentation_start', None)
+    if start is None:
+        return
+    parent = current_span()
+    rowcount = getattr(cursor, 'rowcount', -1)
+    _record({"name": "sql", "parent": parent["name"] if parent else None,
+             "started_at": time.time() - (time.perf_counter() - start),
+             "duration_seconds": time.perf_counter() - start,
+             "rows": rowcount if rowcount is not None and rowcount >= 0 else None,
+             "statement": " ".join(statement.split())[:SQL_STATEMENT_PREVIEW]})
+
+
+def install_sql_instrumentation():
+    """Подключает замер SQL-запросов для всех движков процесса (повторный вызов безопасен)."""
+    global _sql_instrumentation_installed
+    if _sql_instrumentation_installed:
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    _sql_instrumentation_installed = True
+
+
+# --- Профилирование одного запроса (cProfile) ---
+def start_profile():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler, limit=40, sort_by='cumulative'):
+    """Останавливает профайлер и возвращает текстовую сводку pstats."""
+    profiler.disable()
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).strip_dirs().sort_stats(sort_by).print_stats(limit)
+    return stream.getvalue()
@@ -1,81 +1,177 @@
 import json
 import math
 import os
-from flask import Response, Blueprint, jsonify, request, current_app, abort
-from .models import db, Submission, Learner, Step, Comment, Lesson, Module, AdditionalStepInfo, Course, enrollment_table
-from sqlalchemy import func, distinct, case, cast, Float, text, select
-from .app_state import calculated_metrics_storage, structure_with_metrics_cache   
-from sqlalchemy.orm import joinedload, aliased
+from flask import Response, Blueprint, jsonify, request, current_app, abort, g, stream_with_context
+from .models import db, Submission, Learner, Step, Lesson, Module, AdditionalStepInfo, Course, enrollment_table, LearnerCourseProgress
+from sqlalchemy import func, distinct, case, cast, Float, select
+from .app_state import calculated_metrics_storage, structure_with_metrics_cache, structure_cache_times
+from .file_cache import (TEACHERS_CACHE_FILE, COMPLETION_RATES_CACHE_FILE, load_cache_from_file,
+                         save_cache_to_file, structure_cache_filepath,
+                         cohorts_cache_filepath, funnel_cache_filepath)
+from .structure_metrics import (calculate_structures_parallel, calculate_course_structure, parse_metrics_arg,
+                                project_metrics, projected_field, intermediate_cache, metric_params, metric_params_key,
+                                DEFAULT_METRIC_PARAMS, SOLVE_TIME_CUTOFF_SECONDS, SOLVE_TIME_QUANTILES)
+from .binary_cache import load_structure_cache, save_structure_cache
+from .parallel import run_parallel, get_metrics_workers
+from .rollups import calculate_course_structure_window, calculate_course_solve_times, course_step_ids
+from .cohorts import calculate_course_cohorts, COHORT_PERIODS, COHORT_BASES
+from .approx_structure import (calculate_course_structure_approx, course_submissions_total, start_exact_structure,
+                               exact_structure_running, APPROX_MIN_SUBMISSIONS)
+from .benchmarking import (update_benchmark_index, benchmark_has_course, annotate_percentile_ranks,
+                           benchmark_summary, BENCHMARK_METRICS)
+from .funnel import calculate_course_funnel, FUNNEL_GROUPS
+from .step_compare import step_course_ids, step_distributions, MAX_COMPARE_STEPS
+from .recommendations import evaluate_recommendations, summarize_findings
+from .structure_versions import record_structure_version, course_structure_version, structure_changes
+from .warmup import warmup_progress, stale_course_ids, course_data_changed_at
+from .comment_search import search_comments, parse_query, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE
+from .export import EXPORT_FORMATS, EXPORT_COLUMNS, resolve_columns, flatten_completion_rates, csv_stream, xlsx_stream
+from .comment_activity import course_comment_activity
+from .comment_threads import step_comment_threads, THREADS_PAGE_SIZE, MAX_THREADS_PAGE_SIZE
+from .progress import (ensure_progress, query_learner_progress, SORT_KEYS as PROGRESS_SORT_KEYS,
+                       LEARNERS_PAGE_SIZE, MAX_LEARNERS_PAGE_SIZE)
+from .instrumentation import span, get_spans, summarize_spans, prometheus_text, start_profile, stop_profile
+from .db_routing import use_read_replica, pin_primary, read_database_uri
+from sqlalchemy.orm import aliased
 import time
 import traceback
+from datetime import datetime
 from collections import defaultdict
 
 metrics_bp = Blueprint('metrics', __name__, url_prefix='/api/metrics')
 
-CACHE_DIR = os.path.join(os.path.dirname(__file__), 'cache') # Папка для кеша рядом с этим файлом
-STRUCTURE_CACHE_FILE = os.path.join(CACHE_DIR, 'structure_cache.json')
-STRUCTURE_CACHE_KEY = 'all_steps_data' # Ключ для in-memory кеша
-TEACHERS_CACHE_FILE = os.path.join(CACHE_DIR, 'teachers_cache.json')
-COMPLETION_RATES_CACHE_FILE = os.path.join(CACHE_DIR, 'completion_rates_cache.json')
+@metrics_bp.before_request
+def route_reads_to_replica():
+    """
+    GET-запросы метрик читают с реплики (если она задана). Обработчики, которые по прочитанному что-то
+    записывают (кеш и версии структуры, прогресс, агрегаты), перед этим чтением закрепляют запрос
+    за основной БД: calculate_structures_to_store, refresh_course_progress, refresh_step_rollups.
+    """
+    if request.method == 'GET':
+        use_read_replica(db.session)
 
-# --- Функции для работы с файловым кешем ---
-def load_cache_from_file(filepath):
-    """Загружает данные из JSON-файла, если он существует."""
-    if os.path.exists(filepath):
+def calculate_course_completion(course_id, course_title):
+    """
+    Рассчитывает результативность по диапазонам для ОДНОГО курса.
+    Курс — независимая единица работы для пула процессов (см. parallel.run_parallel).
+    Ошибка расчета возвращается как словарь с ключом "error", чтобы не прерывать остальные курсы.
+    """
+    with span("global.course_completion", log=True, course_id=course_id) as course_span:
+        # --- Логика расчета для ОДНОГО курса (адаптирована из старой версии) ---
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                print(f"--- КЕШ: Данные успешно загружены из файла {filepath} ---")
-                return data
-        except (json.JSONDecodeError, IOError, FileNotFoundError) as e:
-            print(f"!!! ОШИБКА КЕША: Не удалось прочитать или декодировать файл {filepath}. Ошибка: {e}")
-            # Если файл поврежден, лучше его удалить, чтобы пересчитать
-            try:
-                os.remove(filepath)
-                print(f"--- КЕШ: Поврежденный файл кеша {filepath} удален. ---")
-            except OSError as remove_err:
-                 print(f"!!! ОШИБКА КЕША: Не удалось удалить поврежденный файл {filepath}. Ошибка: {remove_err}")
-            return None # Возвращаем None, чтобы данные пересчитались
-    return None # Файла нет
-
-def save_cache_to_file(data, filepath):
-    """Сохраняет данные в JSON-файл, создавая директорию при необходимости."""
-    try:
-        # Убедимся, что директория существует
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2) # Добавил indent для читаемости
-            print(f"--- КЕШ: Данные успешно сохранены в файл {filepath} ---")
-    except (IOError, TypeError) as e:
-        print(f"!!! ОШИБКА КЕША: Не удалось сохранить данные в файл {filepath}. Ошибка: {e}")
+            # Шаг 2.1: Получаем ID оцениваемых шагов ДАННОГО курса
+            submittable_steps_query = db.session.query(Step.step_id)\
+                .join(Lesson, Step.lesson_id == Lesson.lesson_id)\
+                .join(Module, Lesson.module_id == Module.module_id)\
+                .filter(Module.course_id == course_id, # <-- Фильтр по курсу
+                        Step.step_cost.isnot(None),
+                        Step.step_cost > 0)
+            submittable_step_ids = [s.step_id for s in submittable_steps_query.all()]
+            total_submittable_steps = len(submittable_step_ids)
+            course_span["submittable_steps"] = total_submittable_steps
+
+            # Шаг 2.2: Считаем общее количество УЧЕНИКОВ, ЗАПИСАННЫХ на ДАННЫЙ курс
+            total_learners_on_course = db.session.query(func.count(Learner.user_id))\
+                .join(enrollment_table, Learner.user_id == enrollment_table.c.learner_id)\
+                .filter(enrollment_table.c.course_id == course_id, # <-- Фильтр по курсу
+                        Learner.is_learner == True)\
+                .scalar() or 0
+            course_span["rows"] = total_learners_on_course
+
+            # Структура результата для этого курса
+            completion_result = {
+                "course_id": course_id, "course_title": course_title,
+                "total_learners_on_course": total_learners_on_course,
+                "total_submittable_steps": total_submittable_steps,
+                "ranges": { "gte_80": {}, "gte_50_lt_80": {}, "gte_25_lt_50": {}, "lt_25": {} }, # Заполним ниже
+                "message": "Calculation started."
+            }
 
-def calculate_global_metrics(storage):
+            # Проверки для пропуска расчета
+            if total_submittable_steps == 0:
+                completion_result["message"] = "No steps requiring submission found for this course.";
+                return completion_result
+            if total_learners_on_course == 0:
+                completion_result["message"] = "No learners enrolled in this course.";
+                return completion_result
+
+            # Шаг 2.3: Пороги (без изменений)
+            threshold_80_steps = math.ceil(total_submittable_steps * 0.80); threshold_50_steps = math.ceil(total_submittable_steps * 0.50); threshold_25_steps = math.ceil(total_submittable_steps * 0.25)
+
+            # Шаг 2.4: Подзапрос - сколько оцениваемых шагов прошел каждый УЧЕНИК НА ЭТОМ КУРСЕ
+            user_steps_passed_subquery = db.session.query(
+                Submission.user_id, func.count(distinct(Submission.step_id)).label('steps_passed_count')
+            ).join(enrollment_table, Submission.user_id == enrollment_table.c.learner_id)\
+             .filter(
+                enrollment_table.c.course_id == course_id, # <-- Фильтр по курсу
+                Submission.step_id.in_(submittable_step_ids), # Только оцениваемые шаги ЭТОГО курса
+                Submission.status == 'correct',
+                Submission.user.has(Learner.is_learner == True) # Убедимся, что это ученик
+             ).group_by(Submission.user_id).subquery()
+
+            # Шаг 2.5: Основной запрос для подсчета по диапазонам (без изменений, работает с подзапросом)
+            range_counts_query = db.session.query(
+                # ... (определение label("count_gte_80"), label("count_gte_50_lt_80"), label("count_gte_25_lt_50") как было) ...
+                 func.sum(case((user_steps_passed_subquery.c.steps_passed_count >= threshold_80_steps, 1), else_=0)).label("count_gte_80"),
+                 func.sum(case(((user_steps_passed_subquery.c.steps_passed_count >= threshold_50_steps) & (user_steps_passed_subquery.c.steps_passed_count < threshold_80_steps), 1), else_=0)).label("count_gte_50_lt_80"),
+                 func.sum(case(((user_steps_passed_subquery.c.steps_passed_count >= threshold_25_steps) & (user_steps_passed_subquery.c.steps_passed_count < threshold_50_steps), 1), else_=0)).label("count_gte_25_lt_50")
+            ).select_from(user_steps_passed_subquery)
+            range_counts_result = range_counts_query.first()
+
+            # Шаг 2.6: Извлечение и расчет диапазона <25% (используем total_learners_on_course)
+            count_gte_80 = int(range_counts_result.count_gte_80 if range_counts_result else 0)
+            count_gte_50_lt_80 = int(range_counts_result.count_gte_50_lt_80 if range_counts_result else 0)
+            count_gte_25_lt_50 = int(range_counts_result.count_gte_25_lt_50 if range_counts_result else 0)
+            count_lt_25 = int(total_learners_on_course - count_gte_80 - count_gte_50_lt_80 - count_gte_25_lt_50)
+            # Проверка
+            if (count_gte_80 + count_gte_50_lt_80 + count_gte_25_lt_50 + count_lt_25) != total_learners_on_course:
+                print("!!! ПРЕДУПРЕЖДЕНИЕ: Сумма учеников по диапазонам не сходится с числом учеников на курсе!")
+
+            # Шаг 2.7: Заполнение результата для ЭТОГО курса (считаем % от total_learners_on_course)
+            # ... (заполнение completion_result['ranges'][...] как было, но используя count_* и total_learners_on_course) ...
+            completion_result["ranges"]["gte_80"] = {"threshold_steps": int(threshold_80_steps), "count": count_gte_80, "percentage": float(count_gte_80 / total_learners_on_course) if total_learners_on_course > 0 else 0.0}
+            completion_result["ranges"]["gte_50_lt_80"] = {"threshold_steps": int(threshold_50_steps), "count": count_gte_50_lt_80, "percentage": float(count_gte_50_lt_80 / total_learners_on_course) if total_learners_on_course > 0 else 0.0}
+            completion_result["ranges"]["gte_25_lt_50"] = {"threshold_steps": int(threshold_25_steps), "count": count_gte_25_lt_50, "percentage": float(count_gte_25_lt_50 / total_learners_on_course) if total_learners_on_course > 0 else 0.0}
+            completion_result["ranges"]["lt_25"] = {"threshold_steps": int(threshold_25_steps), "count": count_lt_25, "percentage": float(count_lt_25 / total_learners_on_course) if total_learners_on_course > 0 else 0.0}
+            completion_result["message"] = "Calculation successful."
+
+            return completion_result
+
+        # Обработка ошибки для ОДНОГО курса, чтобы не прерывать весь цикл
+        except Exception as course_err:
+             print(f"!!! ОШИБКА при расчете результативности для курса ID={course_id}: {course_err}")
+             traceback.print_exc() # Выводим трассировку
+             course_span["error"] = str(course_err)
+             return { # Записываем ошибку для этого курса
+                  "course_id": course_id, "course_title": course_title, "error": "Calculation failed", "details": str(course_err)
+             }
+
+def calculate_global_metrics(storage, max_workers=None, save_cache=True):
     """
     Рассчитывает глобальные метрики:
     1. Список преподавателей (глобально).
-    2. Результативность по диапазонам (ДЛЯ КАЖДОГО КУРСА).
-    Сохраняет их в переданный словарь storage.
+    2. Результативность по диапазонам (ДЛЯ КАЖДОГО КУРСА, курсы — в пуле из max_workers процессов).
+    Сохраняет их в переданный словарь storage (и в файловый кеш, если save_cache).
     """
     print("--- Начало расчета ГЛОБАЛЬНЫХ метрик (учителя + результативность ПО КУРСАМ) ---")
     global_calc_start_time = time.time()
     calculation_successful = True
 
     # --- 1. Расчет списка преподавателей (без изменений) ---
-    print("    [1/2] Расчет списка преподавателей...")
-    teachers_start_time = time.time()
     try:
-        teachers = db.session.query(Learner).filter(Learner.is_learner == False).order_by(Learner.last_name, Learner.first_name).all()
-        teacher_list = []
-        # ... (код формирования teacher_list как был) ...
-        for teacher in teachers:
-             teacher_list.append({
-                 "user_id": teacher.user_id, "first_name": teacher.first_name, "last_name": teacher.last_name,
-                 "last_login": teacher.last_login.isoformat() if teacher.last_login else None,
-                 "data_joined": teacher.data_joined.isoformat() if teacher.data_joined else None
-             })
-        storage['teachers'] = teacher_list
-        save_cache_to_file(teacher_list, TEACHERS_CACHE_FILE)
-        print(f"    ... Найдено преподавателей: {len(teacher_list)} (за {(time.time() - teachers_start_time):.2f} сек)")
+        with span("global.1_teachers", log=True) as phase_span:
+            teachers = db.session.query(Learner).filter(Learner.is_learner == False).order_by(Learner.last_name, Learner.first_name).all()
+            teacher_list = []
+            # ... (код формирования teacher_list как был) ...
+            for teacher in teachers:
+                 teacher_list.append({
+                     "user_id": teacher.user_id, "first_name": teacher.first_name, "last_name": teacher.last_name,
+                     "last_login": teacher.last_login.isoformat() if teacher.last_login else None,
+                     "data_joined": teacher.data_joined.isoformat() if teacher.data_joined else None
+                 })
+            storage['teachers'] = teacher_list
+            if save_cache: save_cache_to_file(teacher_list, TEACHERS_CACHE_FILE)
+            phase_span["rows"] = len(teacher_list)
     except Exception as e:
         calculation_successful = False
         print(f"!!! Ошибка при расчете списка преподавателей: {e}")
@@ -83,7 +179,6 @@ def calculate_global_metrics(storage):
         traceback.print_exc()
 
     # --- 2. Расчет результативности ДЛЯ КАЖДОГО КУРСА ---
-    print("\n    [2/2] Расчет результативности ПО КУРСАМ...")
     storage_key_courses = 'course_completion_rates' # Общий ключ для данных по курсам
     course_completion_data = {}
     storage[storage_key_courses] = {} # Инициализируем пустой словарь для курсов
@@ -91,118 +186,24 @@ def calculate_global_metrics(storage):
     try:
         # Получаем все курсы из БД
         all_courses = db.session.query(Course).all()
-        print(f"        Найдено курсов для расчета: {len(all_courses)}")
 
         if not all_courses:
              print("        Нет курсов в БД, расчет результативности пропущен.")
              return # Выходим, если курсов нет
 
-        # Цикл по каждому курсу
-        for course in all_courses:
-            course_id = course.course_id
-            course_title = course.title
-            print(f"\n        --- Расчет для курса ID={course_id} ('{course_title}') ---")
-            course_calc_start_time = time.time()
-
-            # --- Логика расчета для ОДНОГО курса (адаптирована из старой версии) ---
-            try:
-                # Шаг 2.1: Получаем ID оцениваемых шагов ДАННОГО курса
-                submittable_steps_query = db.session.query(Step.step_id)\
-                    .join(Lesson, Step.lesson_id == Lesson.lesson_id)\
-                    .join(Module, Lesson.module_id == Module.module_id)\
-                    .filter(Module.course_id == course_id, # <-- Фильтр по курсу
-                            Step.step_cost.isnot(None),
-                            Step.step_cost > 0)
-                submittable_step_ids = [s.step_id for s in submittable_steps_query.all()]
-                total_submittable_steps = len(submittable_step_ids)
-                print(f"            Найдено оцениваемых шагов: {total_submittable_steps}")
-
-                # Шаг 2.2: Считаем общее количество УЧЕНИКОВ, ЗАПИСАННЫХ на ДАННЫЙ курс
-                total_learners_on_course = db.session.query(func.count(Learner.user_id))\
-                    .join(enrollment_table, Learner.user_id == enrollment_table.c.learner_id)\
-                    .filter(enrollment_table.c.course_id == course_id, # <-- Фильтр по курсу
-                            Learner.is_learner == True)\
-                    .scalar() or 0
-                print(f"            Найдено учеников на курсе: {total_learners_on_course}")
-
-                # Структура результата для этого курса
-                completion_result = {
-                    "course_id": course_id, "course_title": course_title,
-                    "total_learners_on_course": total_learners_on_course,
-                    "total_submittable_steps": total_submittable_steps,
-                    "ranges": { "gte_80": {}, "gte_50_lt_80": {}, "gte_25_lt_50": {}, "lt_25": {} }, # Заполним ниже
-                    "message": "Calculation started."
-                }
-
-                # Проверки для пропуска расчета
-                if total_submittable_steps == 0:
-                    completion_result["message"] = "No steps requiring submission found for this course.";
-                    storage[storage_key_courses][course_id] = completion_result; continue # Переход к следующему курсу
-                if total_learners_on_course == 0:
-                    completion_result["message"] = "No learners enrolled in this course.";
-                    storage[storage_key_courses][course_id] = completion_result; continue # Переход к следующему курсу
-
-                # Шаг 2.3: Пороги (без изменений)
-                threshold_80_steps = math.ceil(total_submittable_steps * 0.80); threshold_50_steps = math.ceil(total_submittable_steps * 0.50); threshold_25_steps = math.ceil(total_submittable_steps * 0.25)
-                print(f"            Пороги (шагов): >=80%={threshold_80_steps}, >=50%={threshold_50_steps}, >=25%={threshold_25_steps}")
-
-                # Шаг 2.4: Подзапрос - сколько оцениваемых шагов прошел каждый УЧЕНИК НА ЭТОМ КУРСЕ
-                user_steps_passed_subquery = db.session.query(
-                    Submission.user_id, func.count(distinct(Submission.step_id)).label('steps_passed_count')
-                ).join(enrollment_table, Submission.user_id == enrollment_table.c.learner_id)\
-                 .filter(
-                    enrollment_table.c.course_id == course_id, # <-- Фильтр по курсу
-                    Submission.step_id.in_(submittable_step_ids), # Только оцениваемые шаги ЭТОГО курса
-                    Submission.status == 'correct',
-                    Submission.user.has(Learner.is_learner == True) # Убедимся, что это ученик
-                 ).group_by(Submission.user_id).subquery()
-                print(f"            Подзапрос user_steps_passed определен.")
-
-                # Шаг 2.5: Основной запрос для подсчета по диапазонам (без изменений, работает с подзапросом)
-                range_counts_query = db.session.query(
-                    # ... (определение label("count_gte_80"), label("count_gte_50_lt_80"), label("count_gte_25_lt_50") как было) ...
-                     func.sum(case((user_steps_passed_subquery.c.steps_passed_count >= threshold_80_steps, 1), else_=0)).label("count_gte_80"),
-                     func.sum(case(((user_steps_passed_subquery.c.steps_passed_count >= threshold_50_steps) & (user_steps_passed_subquery.c.steps_passed_count < threshold_80_steps), 1), else_=0)).label("count_gte_50_lt_80"),
-                     func.sum(case(((user_steps_passed_subquery.c.steps_passed_count >= threshold_25_steps) & (user_steps_passed_subquery.c.steps_passed_count < threshold_50_steps), 1), else_=0)).label("count_gte_25_lt_50")
-                ).select_from(user_steps_passed_subquery)
-                print(f"            Выполняется агрегирующий запрос...")
-                range_counts_result = range_counts_query.first()
-                print(f"            Агрегирующий запрос завершен.")
-
-                # Шаг 2.6: Извлечение и расчет диапазона <25% (используем total_learners_on_course)
-                count_gte_80 = int(range_counts_result.count_gte_80 if range_counts_result else 0)
-                count_gte_50_lt_80 = int(range_counts_result.count_gte_50_lt_80 if range_counts_result else 0)
-                count_gte_25_lt_50 = int(range_counts_result.count_gte_25_lt_50 if range_counts_result else 0)
-                count_lt_25 = int(total_learners_on_course - count_gte_80 - count_gte_50_lt_80 - count_gte_25_lt_50)
-                print(f"            Распределение (кол-во): >=80%={count_gte_80}, 50-79%={count_gte_50_lt_80}, 25-49%={count_gte_25_lt_50}, <25%={count_lt_25}")
-                # Проверка
-                if (count_gte_80 + count_gte_50_lt_80 + count_gte_25_lt_50 + count_lt_25) != total_learners_on_course:
-                    print("!!! ПРЕДУПРЕЖДЕНИЕ: Сумма учеников по диапазонам не сходится с числом учеников на курсе!")
-
-                # Шаг 2.7: Заполнение результата для ЭТОГО курса (считаем % от total_learners_on_course)
-                # ... (заполнение completion_result['ranges'][...] как было, но используя count_* и total_learners_on_course) ...
-                completion_result["ranges"]["gte_80"] = {"threshold_steps": int(threshold_80_steps), "count": count_gte_80, "percentage": float(count_gte_80 / total_learners_on_course) if total_learners_on_course > 0 else 0.0}
-                completion_result["ranges"]["gte_50_lt_80"] = {"threshold_steps": int(threshold_50_steps), "count": count_gte_50_lt_80, "percentage": float(count_gte_50_lt_80 / total_learners_on_course) if total_learners_on_course > 0 else 0.0}
-                completion_result["ranges"]["gte_25_lt_50"] = {"threshold_steps": int(threshold_25_steps), "count": count_gte_25_lt_50, "percentage": float(count_gte_25_lt_50 / total_learners_on_course) if total_learners_on_course > 0 else 0.0}
-                completion_result["ranges"]["lt_25"] = {"threshold_steps": int(threshold_25_steps), "count": count_lt_25, "percentage": float(count_lt_25 / total_learners_on_course) if total_learners_on_course > 0 else 0.0}
-                completion_result["message"] = "Calculation successful."
-
-                # Сохраняем результат для текущего course_id
+        # Курсы считаются независимо (параллельно, если max_workers > 1), результаты — в порядке all_courses
+        course_units = [(course.course_id, course.title) for course in all_courses]
+        with span("global.2_course_completion_rates", log=True, courses=len(course_units)) as phase_span:
+            for (course_id, _), completion_result in zip(course_units, run_parallel(
+                    calculate_course_completion, course_units, max_workers=max_workers,
+                    database_uri=read_database_uri())):
                 storage[storage_key_courses][course_id] = completion_result
-                print(f"        --- Расчет для курса ID={course_id} завершен (за {(time.time() - course_calc_start_time):.2f} сек) ---")
+            phase_span["rows"] = len(course_units)
 
-            # Обработка ошибки для ОДНОГО курса, чтобы не прерывать весь цикл
-            except Exception as course_err:
-                 print(f"!!! ОШИБКА при расчете результативности для курса ID={course_id}: {course_err}")
-                 storage[storage_key_courses][course_id] = { # Записываем ошибку для этого курса
-                      "course_id": course_id, "course_title": course_title, "error": "Calculation failed", "details": str(course_err)
-                 }
-                 traceback.print_exc() # Выводим трассировку
-
-        if calculation_successful:
+        if calculation_successful and save_cache:
              save_cache_to_file(storage[storage_key_courses], COMPLETION_RATES_CACHE_FILE)
              print("    ... Данные по результативности курсов сохранены в кеш.")
-        else:
+        elif not calculation_successful:
              storage[storage_key_courses] = {"error": "Calculation failed for one or more courses."} # Записываем общую ошибку в storage
              print("!!! ОШИБКА: Расчет результативности завершился с ошибками для некоторых курсов. Кеш НЕ сохранен.")
 
@@ -264,464 +265,891 @@ def get_all_courses_completion_rates(): # Переименовал функци
     return Response(json_string, status=status_code, mimetype='application/json; charset=utf-8')
 
 
+def structure_cache_key(course_id, params_key):
+    return f"structure_metrics_{course_id}_{params_key}" if params_key else f"structure_metrics_{course_id}"
+
+def course_structure_changed_at(course_id):
+    """
+    Время последнего импорта данных курса (course_data_change) или None. Промежуточные наборы курса,
+    собранные раньше (импорт идет в другом процессе), сбрасываются.
+    """
+    changed_at = course_data_changed_at(course_id)
+    if changed_at is not None:
+        intermediate_cache.invalidate(course_id, before=changed_at)
+    return changed_at
+
+def fresh_memory_cache(cache_key, changed_at):
+    """Список из in-memory кеша структуры (шаги или находки), если он посчитан после changed_at (устаревший удаляется), иначе None."""
+    cached_data = structure_with_metrics_cache.get(cache_key)
+    if cached_data is None:
+        return None
+    cached_at = structure_cache_times.get(cache_key)
+    if isinstance(cached_data, list) and (changed_at is None or (cached_at is not None and cached_at >= changed_at)):
+        return cached_data
+    del structure_with_metrics_cache[cache_key]
+    structure_cache_times.pop(cache_key, None)
+    return None
+
+def fresh_structure_cache_filepath(course_id, params_key, changed_at, extension="bin"):
+    """
+    Путь к файловому кешу структуры курса, если файл есть и сохранен после changed_at, иначе None.
+    Проверяется для любого набора параметров: кеш с параметрами запроса прогрев не пересчитывает.
+    """
+    filepath = structure_cache_filepath(course_id, params_key, extension=extension)
+    if not os.path.exists(filepath):
+        return None
+    if changed_at is not None and datetime.fromtimestamp(os.path.getmtime(filepath)) < changed_at:
+        print(f"--- КЕШ: {filepath} сохранен до импорта данных курса ({changed_at}), будет пересчитан. ---")
+        return None
+    return filepath
+
+def has_cached_course_structure(course_id, params=None):
+    """Есть ли актуальный кеш метрик структуры курса (in-memory или файловый) — без чтения файла."""
+    params_key = metric_params_key(params or metric_params())
+    changed_at = course_structure_changed_at(course_id)
+    return (fresh_memory_cache(structure_cache_key(course_id, params_key), changed_at) is not None
+            or fresh_structure_cache_filepath(course_id, params_key, changed_at) is not None
+            or fresh_structure_cache_filepath(course_id, params_key, changed_at, extension="json") is not None)
+
+def get_cached_course_structure(course_id, params=None, remember=True):
+    """
+    Возвращает метрики структуры курса из in-memory или файлового кеша (или None).
+    params — параметры метрик (по умолчанию — из настроек, metric_params()): у каждого набора свой кеш.
+    remember=False — прочитанный файл не сохраняется в in-memory кеше (выдача всех курсов подряд).
+    Кеш, посчитанный раньше последнего импорта данных курса, не возвращается (см. course_structure_changed_at).
+    """
+    is_configured = params is None or params == metric_params()
+    params_key = metric_params_key(params or metric_params())
+    cache_key = structure_cache_key(course_id, params_key)
+    changed_at = course_structure_changed_at(course_id)
+    cached_data = fresh_memory_cache(cache_key, changed_at)
+    if cached_data is not None:
+        return cached_data
+
+    cache_filepath = fresh_structure_cache_filepath(course_id, params_key, changed_at)
+    file_cached_data = load_structure_cache(cache_filepath) if cache_filepath else None
+    if file_cached_data is None: # Кеш в прежнем формате JSON переводится в .bin при первом чтении
+        cache_filepath = fresh_structure_cache_filepath(course_id, params_key, changed_at, extension="json")
+        file_cached_data = load_cache_from_file(cache_filepath) if cache_filepath else None
+        if isinstance(file_cached_data, list):
+            save_structure_cache(file_cached_data, structure_cache_filepath(course_id, params_key))
+    if file_cached_data is not None and isinstance(file_cached_data, list):
+        if remember:
+            structure_with_metrics_cache[cache_key] = file_cached_data
+            structure_cache_times[cache_key] = datetime.fromtimestamp(os.path.getmtime(cache_filepath))
+        if is_configured and not benchmark_has_course(course_id): # Кеш посчитан до появления индекса
+            update_benchmark_index(course_id, file_cached_data)
+        return file_cached_data
+    elif file_cached_data is not None:
+         print(f"--- /steps/structure: Невалидные данные в ФАЙЛОВОМ КЕШЕ ({cache_filepath}). Кеш будет пересчитан. ---")
+    return None
+
+def calculate_structures_to_store(course_ids, params=None):
+    """
+    Расчет структуры курсов для store_course_structure. Читает основную БД (и сам запрос дальше — тоже):
+    кеш, посчитанный по отстающей реплике, считался бы свежим (warmup.stale_course_ids), а версии структуры
+    сравнивались бы с устаревшими данными.
+    """
+    pin_primary(db.session)
+    return calculate_structures_parallel(course_ids, current_app.config['SQLALCHEMY_DATABASE_URI'],
+                                         params=params or metric_params())
+
+def store_course_structure(course_id, results_list, params=None, remember=True):
+    """
+    Сохраняет метрики структуры курса в in-memory (remember=False — только в файловый) и файловый кеш.
+    Для параметров из настроек также пересчитывает рекомендации курса и межкурсовой индекс
+    (они строятся по одному набору параметров).
+    """
+    params_key = metric_params_key(params or metric_params())
+    if remember:
+        structure_with_metrics_cache[structure_cache_key(course_id, params_key)] = results_list
+        structure_cache_times[structure_cache_key(course_id, params_key)] = datetime.now()
+    save_structure_cache(results_list, structure_cache_filepath(course_id, params_key))
+    if params is None or params == metric_params():
+        structure_with_metrics_cache[f"recommendations_{course_id}"] = evaluate_recommendations(results_list)
+        structure_cache_times[f"recommendations_{course_id}"] = datetime.now()
+        update_benchmark_index(course_id, results_list)
+        try:
+            record_structure_version(course_id, results_list)
+        except Exception as e: # Версии — дополнение к кешу: их ошибка (например, нет таблицы) не мешает отдать структуру
+            db.session.rollback()
+            print(f"!!! Ошибка при записи версии структуры курса ID={course_id}: {e}")
+
+def current_structure_version(course_id, results_list):
+    """Версия структуры курса для results_list (кеш, сохраненный до появления версий, записывается как новая версия)."""
+    return course_structure_version(course_id) or record_structure_version(course_id, results_list)
+
+def get_course_recommendations(course_id):
+    """Находки правил рекомендаций для курса (по кешу метрик структуры; при отсутствии кеша — расчет структуры)."""
+    cache_key = f"recommendations_{course_id}"
+    findings = fresh_memory_cache(cache_key, course_structure_changed_at(course_id))
+    if findings is not None:
+        return findings
+    results_list = get_cached_course_structure(course_id)
+    if results_list is None:
+        for _, results_list in calculate_structures_to_store([course_id]):
+            store_course_structure(course_id, results_list)
+        return structure_with_metrics_cache[cache_key]
+    findings = evaluate_recommendations(results_list)
+    structure_with_metrics_cache[cache_key] = findings
+    structure_cache_times[cache_key] = datetime.now()
+    return findings
+
+
+def get_course_structure_metrics(course_id, metrics, params):
+    """
+    Шаги курса только с метриками metrics: срез полного кеша курса (файловый кеш читается только
+    по нужным колонкам), а без кеша — расчет только нужных наборов данных
+    (промежуточные наборы — из intermediate_cache и сохраняются в нем).
+    """
+    params_key = metric_params_key(params or metric_params())
+    changed_at = course_structure_changed_at(course_id)
+    results_list = fresh_memory_cache(structure_cache_key(course_id, params_key), changed_at)
+    if results_list is not None:
+        return project_metrics(results_list, metrics)
+    cache_filepath = fresh_structure_cache_filepath(course_id, params_key, changed_at)
+    results_list = load_structure_cache(cache_filepath, fields=projected_field(metrics)) if cache_filepath else None
+    if results_list is None:
+        results_list = get_cached_course_structure(course_id, params) # Прежний JSON-кеш
+    if results_list is not None:
+        return project_metrics(results_list, metrics)
+    return calculate_course_structure(course_id, max_workers=get_metrics_workers(), metrics=metrics, cache=intermediate_cache,
+                                      params=params)
+
+
+def parse_metric_params_args():
+    """
+    ({параметр: значение} из query, итоговые параметры метрик) — параметры запроса поверх настроек.
+    ValueError для недопустимых значений.
+    """
+    overrides = {name: request.args[name] for name in DEFAULT_METRIC_PARAMS if request.args.get(name)}
+    return overrides, metric_params(overrides)
+
+
+def parse_date_arg(name):
+    """Дата из query-параметра в формате YYYY-MM-DD (None, если параметра нет)."""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f"Параметр {name} должен быть датой в формате YYYY-MM-DD, получено: {value}")
+
+
 @metrics_bp.route("/steps/structure", methods=['GET'])
 def get_steps_structure():
     """
     Возвращает список шагов с деталями и НОВЫМИ РАССЧИТАННЫМИ МЕТРИКАМИ.
     Принимает НЕОБЯЗАТЕЛЬНЫЙ параметр ?course_id= для фильтрации.
-    Использует кэш (in-memory и файловый), зависящий от course_id.
+    Без course_id список собирается из результатов по каждому курсу
+    (кеш in-memory и файловый — отдельный для каждого курса),
+    недостающие курсы считаются параллельно в пуле процессов.
+    ?from=YYYY-MM-DD&to=YYYY-MM-DD — метрики за период (границы включительно)
+    по дневным агрегатам step_daily_rollup, без кеша и без сканирования сабмишенов.
+    ?approx=1 — для больших курсов без кеша: быстрая оценка с "error_bounds"
+    (см. approx_structure), точный расчет запускается в фоне и попадает в кеш.
+    Каждый шаг (кроме метрик за период) дополняется "percentile_ranks" — рангами метрик
+    среди шагов того же типа всех курсов (см. benchmarking).
+    ?metrics=difficulty_index,skip_rate — только эти метрики (ключи structure_metrics.METRICS):
+    курсы с кешем отдаются срезом кеша, остальные считаются только по нужным наборам данных.
+    ?solve_time_cutoff_seconds=&discrimination_group_share=&correct_status= — параметры метрик
+    (по умолчанию — из настроек); кеш структуры отдельный для каждого набора параметров,
+    промежуточные наборы, не зависящие от параметра, переиспользуются.
     """
-    global structure_with_metrics_cache
     course_id_filter = request.args.get('course_id', type=int)
+    start_time = time.time()
+    try:
+        date_from = parse_date_arg('from')
+        date_to = parse_date_arg('to')
+    except ValueError as e:
+        return jsonify({"error": "Invalid date", "details": str(e)}), 400
+    try:
+        metrics = parse_metrics_arg(request.args.get('metrics'))
+    except ValueError as e:
+        return jsonify({"error": "Invalid metrics", "details": str(e)}), 400
+    try:
+        param_overrides, params = parse_metric_params_args()
+    except ValueError as e:
+        return jsonify({"error": "Invalid metric parameters", "details": str(e)}), 400
+
+    def select_metrics(course_steps):
+        return project_metrics(course_steps, metrics) if metrics is not None else course_steps
 
-    # Определяем ключ кеша и имя файла
     if course_id_filter is not None:
-        cache_key = f"structure_metrics_{course_id_filter}" # Изменил ключ для нового набора метрик
-        cache_filename = f"structure_cache_metrics_{course_id_filter}.json"
         print(f"--- /steps/structure: Запрос для курса ID={course_id_filter} ---")
+        course_ids = [course_id_filter]
     else:
-        cache_key = "structure_metrics_all" # Изменил ключ
-        cache_filename = "structure_cache_metrics_all.json"
         print(f"--- /steps/structure: Запрос для ВСЕХ курсов ---")
+        course_ids = [row.course_id for row in db.session.query(Course.course_id).order_by(Course.course_id).all()]
 
-    cache_filepath = os.path.join(CACHE_DIR, cache_filename)
+    if date_from is not None or date_to is not None:
+        if param_overrides:
+            return jsonify({"error": "Invalid metric parameters",
+                            "details": "Метрики за период считаются по дневным агрегатам с параметрами по умолчанию"}), 400
+        print(f"--- /steps/structure: Метрики за период {date_from} — {date_to} по дневным агрегатам ---")
+        try:
+            if course_id_filter is not None:
+                json_string = json.dumps(select_metrics(calculate_course_structure_window(course_id_filter, date_from, date_to)),
+                                         ensure_ascii=False)
+                return Response(json_string, mimetype='application/json; charset=utf-8')
+        except Exception as e:
+            print(f"!!! Ошибка при расчете структуры шагов за период (курс: {course_id_filter}): {e}")
+            traceback.print_exc()
+            return jsonify({"error": "Could not retrieve step structure for period", "details": str(e)}), 500
+
+        def generate_window_json():
+            yield '['
+            first_item = True
+            for course_id in course_ids:
+                for step_data in select_metrics(calculate_course_structure_window(course_id, date_from, date_to)):
+                    yield ('' if first_item else ', ') + json.dumps(step_data, ensure_ascii=False)
+                    first_item = False
+            yield ']'
+        return Response(stream_with_context(generate_window_json()), mimetype='application/json; charset=utf-8')
+
+    approx_course_ids = []
+    # Оценка строится по дневным агрегатам, посчитанным с параметрами по умолчанию
+    if request.args.get('approx') == '1' and not param_overrides and params == DEFAULT_METRIC_PARAMS:
+        try:
+            approx_course_ids = [cid for cid in course_ids if not has_cached_course_structure(cid)
+                                 and (exact_structure_running(cid) or course_submissions_total(cid) >= APPROX_MIN_SUBMISSIONS)]
+        except Exception as e:
+            print(f"!!! Ошибка при подготовке оценки структуры шагов (курсы: {course_ids}): {e}")
+            traceback.print_exc()
+            return jsonify({"error": "Could not estimate step structure", "details": str(e)}), 500
+        if approx_course_ids:
+            print(f"--- /steps/structure: Оценка (approx) для курсов {approx_course_ids}, точный расчет — в фоне ---")
+            start_exact_structure(current_app._get_current_object(), approx_course_ids, store_course_structure)
+            course_ids = [cid for cid in course_ids if cid not in approx_course_ids] # Остальные — как обычно
+            approx_headers = {"X-Metrics-Approximate": ",".join(str(cid) for cid in approx_course_ids)}
+
+    selected_structures = {}
+    try:
+        if metrics is not None:
+            # Только выбранные метрики: срез кеша курса или выборочный расчет (частичный результат в кеш структуры не попадает)
+            print(f"--- /steps/structure: Метрики {metrics} для курсов: {course_ids} ---")
+            with span("structure.request", courses=len(course_ids), metrics=len(metrics)) as request_span:
+                for course_id in course_ids:
+                    selected_structures[course_id] = get_course_structure_metrics(course_id, metrics, params)
+                request_span["rows"] = len(course_ids)
+        else:
+            # 1. Проверка кешей (in-memory, затем файловый) для каждого курса
+            # Для всех курсов кеш в памяти не пополняется (он не ограничен по размеру): курсы читаются из файлов по одному
+            remember = course_id_filter is not None
+            if remember:
+                missing_course_ids = [cid for cid in course_ids if get_cached_course_structure(cid, params) is None]
+            else:
+                missing_course_ids = [cid for cid in course_ids if not has_cached_course_structure(cid, params)]
+            if course_ids and not missing_course_ids:
+                print(f"--- /steps/structure: Все курсы ({len(course_ids)}) найдены в КЕШЕ ---")
+
+            # 2. Расчет недостающих курсов (параллельно, если курсов несколько)
+            if missing_course_ids:
+                print(f"--- /steps/structure: Расчет данных С НОВЫМИ МЕТРИКАМИ для курсов: {missing_course_ids} ---")
+                with span("structure.request", courses=len(missing_course_ids)) as request_span:
+                    for course_id, results_list in calculate_structures_to_store(missing_course_ids, params):
+                        store_course_structure(course_id, results_list, params, remember=remember)
+                    request_span["rows"] = len(missing_course_ids)
 
-    # 1. Проверка in-memory кеша (без изменений)
-    if cache_key in structure_with_metrics_cache:
-        # ... (код проверки in-memory кеша) ...
-        print(f"--- /steps/structure: Возврат данных из IN-MEMORY КЕША (ключ: {cache_key}) ---")
-        cached_data = structure_with_metrics_cache[cache_key]
-        if cached_data is not None and isinstance(cached_data, list):
-             json_string = json.dumps(cached_data, ensure_ascii=False); return Response(json_string, mimetype='application/json; charset=utf-8')
-        else: del structure_with_metrics_cache[cache_key]
+        total_duration = time.time() - start_time
+        print(f"--- Формирование списка шагов С НОВЫМИ МЕТРИКАМИ завершено (курсов: {len(course_ids)}, за {total_duration:.2f} сек).")
 
+    except Exception as e:
+        total_duration = time.time() - start_time
+        print(f"!!! Ошибка при расчете структуры шагов с НОВЫМИ метриками (курсы: {course_ids}, за {total_duration:.2f} сек): {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not retrieve step structure with metrics", "details": str(e)}), 500
 
-    # 2. Проверка файлового кеша (без изменений)
-    print(f"--- /steps/structure: Проверка файлового кеша ({cache_filepath})... ---")
-    file_cached_data = load_cache_from_file(cache_filepath)
-    if file_cached_data is not None and isinstance(file_cached_data, list):
-        structure_with_metrics_cache[cache_key] = file_cached_data
-        print(f"--- /steps/structure: Возврат данных из ФАЙЛОВОГО КЕША (ключ: {cache_key}) ---")
-        json_string = json.dumps(file_cached_data, ensure_ascii=False); return Response(json_string, mimetype='application/json; charset=utf-8')
-    elif file_cached_data is not None:
-         print(f"--- /steps/structure: Невалидные данные в ФАЙЛОВОМ КЕШЕ ({cache_filepath}). Кеш будет пересчитан. ---")
+    if approx_course_ids:
+        if course_id_filter is not None:
+            try:
+                json_string = json.dumps(annotate_percentile_ranks(select_metrics(calculate_course_structure_approx(course_id_filter))),
+                                         ensure_ascii=False)
+            except Exception as e:
+                print(f"!!! Ошибка при оценке структуры шагов (курс: {course_id_filter}): {e}")
+                traceback.print_exc()
+                return jsonify({"error": "Could not estimate step structure", "details": str(e)}), 500
+            return Response(json_string, mimetype='application/json; charset=utf-8', headers=approx_headers)
+        course_ids = [row.course_id for row in db.session.query(Course.course_id).order_by(Course.course_id).all()]
+
+    if course_id_filter is not None:
+        course_steps = selected_structures[course_id_filter] if metrics is not None else get_cached_course_structure(course_id_filter, params)
+        version_headers = {}
+        if metrics is None and not param_overrides and params == metric_params():
+            try:
+                version_headers["X-Structure-Version"] = str(current_structure_version(course_id_filter, course_steps))
+            except Exception as e:
+                db.session.rollback()
+                print(f"!!! Ошибка при чтении версии структуры курса ID={course_id_filter}: {e}")
+        json_string = json.dumps(annotate_percentile_ranks(course_steps), ensure_ascii=False)
+        return Response(json_string, mimetype='application/json; charset=utf-8', headers=version_headers)
+
+    # Для всех курсов — потоковая конкатенация списков отдельных курсов
+    def generate_all_courses_json():
+        yield '['
+        first_item = True
+        for course_id in course_ids:
+            if course_id in approx_course_ids:
+                course_steps = select_metrics(calculate_course_structure_approx(course_id))
+            elif metrics is not None:
+                course_steps = selected_structures.get(course_id) or []
+            else:
+                course_steps = get_cached_course_structure(course_id, params, remember=False) or []
+            for step_data in annotate_percentile_ranks(course_steps):
+                yield ('' if first_item else ', ') + json.dumps(step_data, ensure_ascii=False)
+                first_item = False
+        yield ']'
+    # Генератор выполняется после возврата из обработчика: app context нужен для METRIC_PARAMS и БД
+    return Response(stream_with_context(generate_all_courses_json()), mimetype='application/json; charset=utf-8',
+                    headers=approx_headers if approx_course_ids else None)
+    
 
+@metrics_bp.route("/steps/structure/changes", methods=['GET'])
+def get_steps_structure_changes():
+    """
+    Изменения структуры курса после версии ?since= (см. structure_versions): добавленные и измененные
+    шаги (полные словари, как в /steps/structure) и step_id удаленных. ?course_id= и ?since= обязательны;
+    since=0 — все шаги курса. Текущая версия — поле "version" ответа и заголовок X-Structure-Version
+    ответа /steps/structure?course_id=.
+    """
+    course_id = request.args.get('course_id', type=int)
+    since = request.args.get('since', type=int)
+    if course_id is None or since is None or since < 0:
+        return jsonify({"error": "course_id and since (>= 0) are required"}), 400
+    if db.session.get(Course, course_id) is None:
+        return jsonify({"error": f"Course {course_id} not found"}), 404
 
-    # 3. Расчет данных (если кеши пусты/невалидны)
-    print(f"--- /steps/structure: Расчет данных С НОВЫМИ МЕТРИКАМИ (ключ кеша: {cache_key}) ---")
-    start_time = time.time()
     try:
-        # --- ШАГ 1: Запрос базовой структуры и ОПРЕДЕЛЕНИЕ ПОРЯДКА ШАГОВ ПО КУРСАМ ---
-        print("    [1/9] Запрос базовой структуры и определение порядка шагов...")
-        all_steps_query = db.session.query(Step).options(
-            joinedload(Step.lesson).joinedload(Lesson.module).joinedload(Module.course),
-            joinedload(Step.additional_info)
-        ).join(Step.lesson).join(Lesson.module).join(Module.course)
-
-        if course_id_filter is not None:
-            all_steps_query = all_steps_query.filter(Module.course_id == course_id_filter)
-
-        all_steps_query = all_steps_query.order_by(
-            Course.course_id, Module.module_position, Lesson.lesson_position, Step.step_position
-        )
-        all_steps = all_steps_query.all()
-        step_ids = [step.step_id for step in all_steps] # Все ID шагов для текущего запроса
-
-        # Создаем словарь {course_id: [ordered_step_ids]}
-        course_step_order = defaultdict(list)
-        step_positions = {} # Словарь для хранения позиций step_id -> index в его курсе
-        lesson_to_steps = defaultdict(list) # ---> НОВЫЙ СЛОВАРЬ: lesson_id -> [step_ids]
-        steps_in_lessons = set()
-
-        for step in all_steps:
-             course_id = step.lesson.module.course_id if step.lesson and step.lesson.module else None
-             lesson_id = step.lesson_id if step.lesson else None
-             if course_id:
-                 course_step_order[course_id].append(step.step_id)
-                 step_positions[step.step_id] = len(course_step_order[course_id]) - 1 # Сохраняем индекс
-             if lesson_id:
-                lesson_to_steps[lesson_id].append(step.step_id)
-                steps_in_lessons.add(step.step_id)
-
-        print(f"    ... Найдено шагов: {len(all_steps)}. Определен порядок для {len(course_step_order)} курсов.")
-
-        if not all_steps:
-             structure_with_metrics_cache[cache_key] = []; save_cache_to_file([], cache_filepath); return jsonify([])
-        
-        if not steps_in_lessons:
-            print("    ... ПРЕДУПРЕЖДЕНИЕ: Ни один из найденных шагов не привязан к уроку. Расчет дискриминативности невозможен.")
-
-        # --- ШАГ 2: Запрос ВСЕХ релевантных Submissions (user_id, step_id, status, score) ---
-        # Нам нужны баллы (score) для дискриминативности
-        print("    [2/9] Запрос ВСЕХ сабмишенов (с баллами) для релевантных шагов...")
-        submissions_fetch_start = time.time()
-        all_submissions_for_steps = []
-        try:
-            # Запрашиваем нужные поля
-            submissions_query = db.session.query(
-                Submission.user_id, Submission.step_id, Submission.status, Submission.score
-            ).filter(Submission.step_id.in_(step_ids)) # Фильтруем по ID шагов
-            all_submissions_for_steps = submissions_query.all() # Получаем все кортежи
-            print(f"    ... Получено {len(all_submissions_for_steps)} сабмишенов (за {(time.time() - submissions_fetch_start):.2f} сек)")
-        except Exception as sub_err:
-            print(f"!!! Ошибка при запросе сабмишенов: {sub_err}")
-
-        # --- ШАГ 3: Предварительная Агрегация Submissions (по step_id) ---
-        # Считаем базовые счетчики, как и раньше
-        print("    [3/9] Предварительная агрегация данных из Submissions...")
-        submissions_agg_start = time.time()
-        submissions_data = defaultdict(lambda: {
-            "total_submissions": 0, "correct_submissions": 0,
-            "total_attempted_users": set(), "passed_correctly_users": set()
-        })
-        # Используем данные, полученные на ШАГЕ 2
-        for sub in all_submissions_for_steps:
-            data = submissions_data[sub.step_id]
-            data["total_submissions"] += 1
-            data["total_attempted_users"].add(sub.user_id)
-            if sub.status == 'correct':
-                data["correct_submissions"] += 1
-                data["passed_correctly_users"].add(sub.user_id)
-        # Преобразуем set в count
-        for step_id in submissions_data:
-            submissions_data[step_id]["total_attempted_users"] = len(submissions_data[step_id]["total_attempted_users"])
-            submissions_data[step_id]["passed_correctly_users"] = len(submissions_data[step_id]["passed_correctly_users"])
-        print(f"    ... Агрегаты Submissions посчитаны (за {(time.time() - submissions_agg_start):.2f} сек)")
-
-        # 4. ---> ИЗМЕНЕНО: Данные по комментариям (теперь считаем и уникальных пользователей) <---
-        print("    [4/9] Запрос данных по комментариям (включая уникальных пользователей)...")
-        comments_start = time.time()
-        comments_query = db.session.query(
-            Comment.step_id,
-            func.count(Comment.comment_id).label("comments_count"),
-            func.count(distinct(Comment.user_id)).label("unique_commenting_users") # <-- Добавили подсчет уникальных
-        ).filter(Comment.step_id.in_(step_ids)).group_by(Comment.step_id)
-        comments_results = comments_query.all()
-        # Сохраняем оба значения
-        comments_data = { row.step_id: {
-                "total_comments": row.comments_count or 0,
-                "unique_users": row.unique_commenting_users or 0
-            } for row in comments_results
-        }
-        print(f"    ... Данные по комментариям получены (за {(time.time() - comments_start):.2f} сек)")
-
-        # ---> 5. РАСЧЕТ СРЕДНЕГО ВРЕМЕНИ С ФИЛЬТРОМ (ДЛЯ ВСЕХ ШАГОВ СРАЗУ) <---
-        # Это все еще запрос к БД, но ОДИН на все шаги, а не в цикле
-        print("    [5/9] Запрос среднего времени выполнения с фильтром (< 3ч)...")
-        avg_time_start = time.time()
-        avg_time_filtered_data = {} # Словарь для хранения результата
-        try:
-            # Подзапрос: первая попытка и ПОСЛЕДНЯЯ ВЕРНАЯ попытка для user+step
-            user_step_times_sq = db.session.query(
-                Submission.step_id, # Добавляем step_id для группировки на внешнем уровне
-                Submission.user_id,
-                func.min(Submission.submission_time).label('first_attempt'),
-                func.max(case((Submission.status == 'correct', Submission.submission_time))).label('last_correct') # Используем MAX для последней верной
-            ).filter(
-                Submission.step_id.in_(step_ids) # Только нужные шаги
-            ).group_by(Submission.step_id, Submission.user_id).subquery() # Группируем по шагу и пользователю
-
-            # Основной запрос: считаем среднее время ДЛЯ КАЖДОГО ШАГА, применяя фильтр
-            avg_time_filtered_query = db.session.query(
-                user_step_times_sq.c.step_id, # Получаем step_id
-                func.avg(
-                    func.timestampdiff(text('SECOND'),
-                                       user_step_times_sq.c.first_attempt,
-                                       user_step_times_sq.c.last_correct)
-                ).label('avg_seconds_filtered')
-            ).filter(
-                user_step_times_sq.c.last_correct.isnot(None), # Пользователь решил верно
-                # Применяем фильтр по времени (< 10800 секунд = 3 часа)
-                func.timestampdiff(text('SECOND'),
-                                   user_step_times_sq.c.first_attempt,
-                                   user_step_times_sq.c.last_correct) <= 10800
-            ).group_by(user_step_times_sq.c.step_id) # Группируем по step_id, чтобы получить среднее для каждого шага
-
-            avg_time_filtered_results = avg_time_filtered_query.all()
-            # Сохраняем результаты в словарь
-            avg_time_filtered_data = {
-                row.step_id: round(float(row.avg_seconds_filtered)) if row.avg_seconds_filtered is not None else None
-                for row in avg_time_filtered_results
-            }
-            print(f"    ... Среднее время с фильтром рассчитано (за {(time.time() - avg_time_start):.2f} сек)")
+        results_list = get_cached_course_structure(course_id)
+        if results_list is None:
+            for _, results_list in calculate_structures_to_store([course_id]):
+                store_course_structure(course_id, results_list)
+        # Хеши сверяются с отдаваемым кешем: он мог быть сохранен другим процессом или до появления версий
+        version = record_structure_version(course_id, results_list)
+        if since > version:
+            return jsonify({"error": "Invalid since", "details": f"Текущая версия структуры курса: {version}"}), 400
+        changes = structure_changes(course_id, since, results_list)
+    except Exception as e:
+        db.session.rollback()
+        print(f"!!! Ошибка при получении изменений структуры (курс {course_id}, since={since}): {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not retrieve step structure changes", "details": str(e)}), 500
+    changes["added"] = annotate_percentile_ranks(changes["added"])
+    changes["updated"] = annotate_percentile_ranks(changes["updated"])
+    json_string = json.dumps(changes, ensure_ascii=False)
+    return Response(json_string, mimetype='application/json; charset=utf-8',
+                    headers={"X-Structure-Version": str(changes["version"])})
 
-        except Exception as time_err:
-             print(f"!!! Ошибка при расчете среднего времени с фильтром: {time_err}")
 
-        # ---> ШАГ 6: ЗАПРОС ВСЕХ ВЕРНЫХ САБМИШЕНОВ (ДЛЯ РАСЧЕТА T) <---
-        print("    [6/9] Запрос ВСЕХ верных сабмишенов (для расчета коэф. пропуска и дискриминативности)...")
-        correct_subs_start = time.time()
-        correct_submissions_set = set() # Используем set для быстрой проверки (user_id, step_id) in set
-        try:
-            correct_subs_query = db.session.query(Submission.user_id, Submission.step_id)\
-                .filter(Submission.status == 'correct', Submission.step_id.in_(step_ids))\
-                .distinct()
-            correct_submissions_set = {(row.user_id, row.step_id) for row in correct_subs_query.all()}
-            print(f"    ... Получено {len(correct_submissions_set)} уникальных верных пар (user, step) (за {(time.time() - correct_subs_start):.2f} сек)")
-        except Exception as cs_err:
-             print(f"!!! Ошибка при получении верных сабмишенов: {cs_err}")
-
-        # --- ШАГ 7: Запрос ВСЕХ УНИКАЛЬНЫХ попыток (ДЛЯ Completion Index) ---
-        print("    [7/9] Запрос ВСЕХ УНИКАЛЬНЫХ попыток (user, step) (для Индекса завершения)...")
-        all_attempts_start = time.time()
-        all_attempted_pairs_set = set()
-        try:
-            all_attempts_query = db.session.query(Submission.user_id, Submission.step_id)\
-                .filter(Submission.step_id.in_(step_ids))\
-                .distinct()
-            all_attempted_pairs_set = {(row.user_id, row.step_id) for row in all_attempts_query.all()}
-            print(f"    ... Получено {len(all_attempted_pairs_set)} уникальных пар попыток (user, step) (за {(time.time() - all_attempts_start):.2f} сек)")
-        except Exception as aa_err:
-            print(f"!!! Ошибка при получении всех пар попыток: {aa_err}")
-
-        # --- ШАГ 8: Построение множеств пользователей по шагам (attempted И passed) ---
-        print("    [8/9] Запрос множеств пользователей (attempted/passed) по шагам и расчит дискриминативности...")
-        users_data_start = time.time()
-        attempted_users_sets = defaultdict(set)
-        passed_users_sets = defaultdict(set)
-        discrimination_indices = {}
-        # Строим attempted из all_attempted_pairs_set
-        for user_id_res, step_id_res in all_attempted_pairs_set:
-             attempted_users_sets[step_id_res].add(user_id_res)
-        # Строим passed из correct_submissions_set
-        for user_id_res, step_id_res in correct_submissions_set:
-             passed_users_sets[step_id_res].add(user_id_res)
-        print(f"    ... Множества пользователей построены (за {(time.time() - users_data_start):.2f} сек)")
-
-        discrim_calc_start = time.time()
-        # ---> Цикл по УРОКАМ для расчета дискриминативности <---
-        for lesson_id, lesson_step_ids in lesson_to_steps.items():
-            print(f"        Расчет D для урока {lesson_id} (шагов: {len(lesson_step_ids)})...")
-            lesson_submissions = [s for s in all_submissions_for_steps if s.step_id in lesson_step_ids] # Фильтруем сабмишены для урока
-            if not lesson_submissions: print(f"        ... Нет сабмишенов для урока {lesson_id}, D не рассчитывается."); continue
-
-            # 1. Суммируем баллы (score) для каждого студента в этом уроке
-            student_lesson_scores = defaultdict(int)
-            lesson_students = set()
-            for sub in lesson_submissions:
-                # score может быть None, обрабатываем это
-                student_lesson_scores[sub.user_id] += (sub.score or 0)
-                lesson_students.add(sub.user_id)
-
-            total_lesson_students = len(lesson_students)
-            if total_lesson_students < 2: # Нужно хотя бы 2 студента для разделения
-                print(f"        ... Недостаточно студентов ({total_lesson_students}) в уроке {lesson_id} для расчета D."); continue
-
-            # 2. Определяем размер групп (n = 27%)
-            # Используем max(1, ...) чтобы гарантировать хотя бы одного студента в группе
-            # Используем floor, чтобы не выходить за пределы при малом N
-            n_percent = 0.27
-            n_group_size = max(1, math.floor(total_lesson_students * n_percent))
-            print(f"        ... Студентов в уроке: {total_lesson_students}, Размер группы (n): {n_group_size}")
-
-            # 3. Сортируем студентов по баллам
-            sorted_students = sorted(lesson_students, key=lambda uid: student_lesson_scores.get(uid, 0), reverse=True)
-
-            # 4. Выделяем верхнюю и нижнюю группы
-            top_group_ids = set(sorted_students[:n_group_size])
-            bottom_group_ids = set(sorted_students[-n_group_size:])
-            print(f"        ... Верхняя группа ID: {top_group_ids}") # Для отладки
-            print(f"        ... Нижняя группа ID: {bottom_group_ids}") # Для отладки
-
-            # 5. Считаем UG и LG для КАЖДОГО шага урока
-            for step_id in lesson_step_ids:
-                ug_correct = sum(1 for user_id in top_group_ids if (user_id, step_id) in correct_submissions_set)
-                lg_correct = sum(1 for user_id in bottom_group_ids if (user_id, step_id) in correct_submissions_set)
-
-                # 6. Считаем D = (UG - LG) / n
-                discrimination_index = (float(ug_correct - lg_correct) / n_group_size) if n_group_size > 0 else None
-                discrimination_indices[step_id] = discrimination_index
-                print(f"            Шаг {step_id}: UG={ug_correct}, LG={lg_correct}, D={discrimination_index}") # Для отладки
-
-        print(f"    ... Расчет дискриминативности завершен (за {(time.time() - discrim_calc_start):.2f} сек)")
-
-        # 9. ---> ИЗМЕНЕНО: Формирование результата с НОВЫМИ метриками <---
-        print("    [9/9] Формирование итогового результата с НОВЫМИ метриками...")
-        results_list = []
-        for step in all_steps:
-            # --- Базовые данные шага ---
-            step_data = {
-                "step_id": step.step_id, "step_position": step.step_position, "step_type": step.step_type, "step_cost": step.step_cost,
-                "lesson_id": step.lesson.lesson_id if step.lesson else None,
-                "lesson_position": step.lesson.lesson_position if step.lesson else None,
-                "module_id": step.lesson.module.module_id if step.lesson and step.lesson.module else None,
-                "module_position": step.lesson.module.module_position if step.lesson and step.lesson.module else None,
-                "module_title": getattr(step.lesson.module, 'title', None) if step.lesson and step.lesson.module else None,
-                "course_id": step.lesson.module.course.course_id if step.lesson and step.lesson.module and step.lesson.module.course else None,
-                "course_title": step.lesson.module.course.title if step.lesson and step.lesson.module and step.lesson.module.course else None,
-                "step_title_short": None,
-                "step_title_full": None,
-                "views": None,
-                "unique_views": None,
-                "passed_users_sub": None,
-                "all_users_attempted": None,
-                # ---> Новые/Обновленные Метрики <---
-                "difficulty_index": None,           # (сложность = R/T сабмитов)
-                "success_rate": None,               # (успешность = R/T уников)
-                "skip_rate_numerator_r": None,
-                "skip_rate_denominator_t": None,
-                "discrimination_index": None,       # дискриминативность
-                "skip_rate": None,                  # коэффициент пропуска
-                "completion_index": None,           # (завершение/отвал)
-                "completion_numerator_r": None,
-                "completion_denominator_t": None,
-                "avg_attempts_per_passed": None,    # (среднее число попыток)
-                "comment_count": 0,                 # Общее число комментов
-                "comment_rate": None,               # (коэф. комментариев)
-                "usefulness_index": None,           # (полезность = views/unique_views)
-                "avg_completion_time_filtered_seconds": None
-                # Метрики, которые здесь НЕ считаем из-за сложности:
-                # skip_rate, completion_index, avg_completion_time_seconds
-            }
+@metrics_bp.route("/steps/compare", methods=['GET'])
+def compare_steps():
+    """
+    Метрики нескольких шагов (можно из разных курсов) для сравнения: ?ids=1,2,3 (не больше MAX_COMPARE_STEPS).
+    Метрики — из кеша структуры курса (с percentile_ranks), без кеша — по дневным агрегатам только этих шагов
+    ("source": "rollups", индексы по всему курсу не считаются). Дополнительно для каждого шага:
+    распределение числа попыток на пользователя, номера первой верной попытки и гистограмма времени решения.
+    """
+    try:
+        step_ids = list(dict.fromkeys(int(step_id) for step_id in request.args.get('ids', '').split(',') if step_id.strip()))
+    except ValueError:
+        return jsonify({"error": "Invalid ids", "details": "ids — список ID шагов через запятую"}), 400
+    if not step_ids or len(step_ids) > MAX_COMPARE_STEPS:
+        return jsonify({"error": "Invalid ids", "details": f"Нужно от 1 до {MAX_COMPARE_STEPS} ID шагов"}), 400
 
-            # --- Заполнение данных из AdditionalStepInfo ---
-            add_info = step.additional_info
-            if add_info:
-                step_data["step_title_short"] = add_info.step_title_short
-                step_data["step_title_full"] = add_info.step_title_full
-                step_data["views"] = add_info.views
-                step_data["unique_views"] = add_info.unique_views
-                #step_data["passed"] = add_info.passed # Используем 'passed' из Excel/БД
-
-            # --- Получение агрегированных данных для текущего шага ---
-            step_submissions = submissions_data.get(step.step_id, {}) # Используем get с default {}
-            step_comments = comments_data.get(step.step_id, {})
-
-            attempted_users_count = 0
-
-            # --- Расчет метрик (с проверками на None и деление на 0) ---
-            if step_submissions:
-                total_subs = step_submissions.get("total_submissions", 0)
-                correct_subs = step_submissions.get("correct_submissions", 0)
-                attempted_users = step_submissions.get("total_attempted_users", 0)
-                passed_users = step_submissions.get("passed_correctly_users", 0) # Уники, прошедшие верно
-                #passed_val = step_data["passed"]
-                unique_views_val = step_data["unique_views"]
-
-                step_data["passed_users_sub"] = passed_users
-
-                step_data["all_users_attempted"] = attempted_users
-
-                step_data["difficulty_index"] = (float(correct_subs) / total_subs) if total_subs > 0 else 0.0
-
-                # Метрика 2: Успешность шага (доля верно решивших уников)
-                if passed_users is not None and unique_views_val is not None and unique_views_val > 0:
-                    step_data["success_rate"] = float(passed_users) / attempted_users
-                else:
-                    step_data["success_rate"] = 0.0
-
-                step_data["avg_attempts_per_passed"] = (float(total_subs) / passed_users) if passed_users > 0 else None
-
-                # Заполняем базовые счетчики для информации
-                # step_data["passed"] = passed_users # Перезаписываем значение из Excel значением из submissions? Решите, что важнее. Пока оставляю значение из Excel.
-                # step_data["unique_views"] = attempted_users # Аналогично. Оставляем из Excel.
-
-            if step_comments:
-                total_com = step_comments.get("total_comments", 0)
-                unique_com_users = step_comments.get("unique_users", 0)
-                attempted_users = step_submissions.get("total_attempted_users", 0) if step_submissions else 0 # Нужны пытавшиеся
-                step_data["comment_count"] = total_com
-                unique_views_val = step_data["unique_views"]
-
-                # Метрика 7: Коэффициент комментариев
-                if unique_com_users is not None and unique_views_val is not None and unique_views_val > 0:
-                    step_data["comment_rate"] = float(unique_com_users) / unique_views_val
-                else:
-                    step_data["comment_rate"] = 0.0 # Или None
+    try:
+        course_of_step = step_course_ids(step_ids)
+        steps_by_course = defaultdict(list)
+        for step_id in step_ids:
+            if step_id in course_of_step:
+                steps_by_course[course_of_step[step_id]].append(step_id)
+
+        step_metrics = {}
+        for course_id, compared_step_ids in steps_by_course.items():
+            cached_steps = get_cached_course_structure(course_id)
+            if cached_steps is not None:
+                requested = set(compared_step_ids)
+                for step_data in annotate_percentile_ranks(cached_steps):
+                    if step_data["step_id"] in requested:
+                        step_metrics[step_data["step_id"]] = {**step_data, "source": "structure_cache"}
             else:
-                step_data["comment_rate"] = 0.0
+                for step_data in calculate_course_structure_window(course_id, only_step_ids=compared_step_ids):
+                    step_metrics[step_data["step_id"]] = {**step_data, "source": "rollups"}
+
+        distributions = step_distributions(list(step_metrics))
+    except Exception as e:
+        print(f"!!! Ошибка при сравнении шагов {step_ids}: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not compare steps", "details": str(e)}), 500
+
+    result = {
+        "steps": [{**step_metrics[step_id], **distributions[step_id]} for step_id in step_ids if step_id in step_metrics],
+        "missing_step_ids": [step_id for step_id in step_ids if step_id not in step_metrics],
+    }
+    return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json; charset=utf-8')
+
 
-            # Метрика 8: Полезность (используем данные из add_info, уже загруженные)
-            views = step_data["views"]
-            unique_views_val = step_data["unique_views"]
-            if views is not None and unique_views_val is not None and unique_views_val > 0:
-                step_data["usefulness_index"] = float(views) / unique_views_val
+@metrics_bp.route("/steps/solve_times", methods=['GET'])
+def get_steps_solve_times():
+    """
+    Время решения шагов курса (среднее и квантили) из KLL sketch дневных агрегатов — без сканирования сабмишенов.
+    ?course_id= (обязательный), ?cutoff= — отсечка в секундах (0 — без отсечки, по умолчанию 10800),
+    ?q=0.5,0.75,0.9 — квантили, ?from=/?to= — период (YYYY-MM-DD).
+    """
+    course_id = request.args.get('course_id', type=int)
+    if course_id is None:
+        return jsonify({"error": "course_id is required"}), 400
+    try:
+        cutoff = request.args.get('cutoff', default=SOLVE_TIME_CUTOFF_SECONDS, type=int)
+        quantiles = tuple(float(q) for q in request.args['q'].split(',')) if request.args.get('q') else SOLVE_TIME_QUANTILES
+        if not all(0 < q <= 1 for q in quantiles):
+            raise ValueError("Квантили должны быть в диапазоне (0, 1]")
+        date_from = parse_date_arg('from')
+        date_to = parse_date_arg('to')
+    except ValueError as e:
+        return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+
+    try:
+        results_list = calculate_course_solve_times(course_id, cutoff=cutoff or None, quantiles=quantiles,
+                                                    date_from=date_from, date_to=date_to)
+    except Exception as e:
+        print(f"!!! Ошибка при расчете времени решения (курс {course_id}): {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not calculate solve times", "details": str(e)}), 500
+    json_string = json.dumps({"course_id": course_id, "cutoff_seconds": cutoff or None, "steps": results_list}, ensure_ascii=False)
+    return Response(json_string, mimetype='application/json; charset=utf-8')
+
+
+@metrics_bp.route("/benchmarks", methods=['GET'])
+def get_benchmarks():
+    """
+    Распределение метрики шагов по всем курсам (квантили) — контекст для percentile_ranks.
+    ?metric= (обязательный, одно из BENCHMARK_METRICS), ?step_type= — один тип шагов (по умолчанию все).
+    """
+    metric = request.args.get('metric')
+    if metric not in BENCHMARK_METRICS:
+        return jsonify({"error": "Invalid metric", "details": f"metric: {BENCHMARK_METRICS}"}), 400
+    json_string = json.dumps({"metric": metric, "step_types": benchmark_summary(metric, request.args.get('step_type'))},
+                             ensure_ascii=False)
+    return Response(json_string, mimetype='application/json; charset=utf-8')
+
+
+@metrics_bp.route("/recommendations", methods=['GET'])
+def get_recommendations():
+    """
+    Рекомендации по шагам курса: находки правил (recommendations.RULES) по метрикам структуры,
+    отсортированные по убыванию score, с пояснением значений метрик.
+    ?course_id= (обязательный), ?kind=problem|strength, ?limit=N.
+    """
+    course_id = request.args.get('course_id', type=int)
+    if course_id is None:
+        return jsonify({"error": "course_id is required"}), 400
+    kind = request.args.get('kind')
+    limit = request.args.get('limit', type=int)
+    if db.session.get(Course, course_id) is None:
+        return jsonify({"error": f"Course {course_id} not found"}), 404
+
+    try:
+        findings = get_course_recommendations(course_id)
+    except Exception as e:
+        print(f"!!! Ошибка при расчете рекомендаций (курс {course_id}): {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not calculate recommendations", "details": str(e)}), 500
+    summary = summarize_findings(findings)
+    if kind:
+        findings = [finding for finding in findings if finding["kind"] == kind]
+    if limit is not None and limit >= 0:
+        findings = findings[:limit]
+    json_string = json.dumps({"course_id": course_id, "summary": summary, "findings": findings}, ensure_ascii=False)
+    return Response(json_string, mimetype='application/json; charset=utf-8')
+
+
+def get_course_data_cache(course_id, cache_key, cache_filepath, calculate, refresh=False):
+    """
+    Данные курса, посчитанные по сабмишенам и зачислениям: in-memory кеш, затем файловый, иначе calculate()
+    и сохранение. Кеш, посчитанный раньше последнего импорта данных курса (course_data_change), пересчитывается.
+    В in-memory кеше хранится пара (время расчета, данные).
+    """
+    changed_at = course_data_changed_at(course_id)
+    if not refresh:
+        cached = structure_with_metrics_cache.get(cache_key)
+        if cached is not None and (changed_at is None or cached[0] >= changed_at):
+            return cached[1]
+        if os.path.exists(cache_filepath):
+            saved_at = datetime.fromtimestamp(os.path.getmtime(cache_filepath))
+            file_cached_data = load_cache_from_file(cache_filepath) if changed_at is None or saved_at >= changed_at else None
+            if isinstance(file_cached_data, dict):
+                structure_with_metrics_cache[cache_key] = (saved_at, file_cached_data)
+                return file_cached_data
+
+    pin_primary(db.session) # Расчет по отстающей реплике сохранился бы как посчитанный после импорта
+    calculated_at = datetime.now()
+    data = calculate()
+    structure_with_metrics_cache[cache_key] = (calculated_at, data)
+    save_cache_to_file(data, cache_filepath)
+    return data
+
+
+def get_course_cohorts(course_id, period='week', basis='enrollment', refresh=False):
+    """Матрица когорта × шаг курса (кеш — см. get_course_data_cache)."""
+    return get_course_data_cache(course_id, f"cohorts_{course_id}_{period}_{basis}", cohorts_cache_filepath(course_id, period, basis),
+                                 lambda: calculate_course_cohorts(course_id, period, basis), refresh)
+
+
+def get_course_funnel(course_id, refresh=False):
+    """Воронка курса (по шагам, урокам и модулям; кеш — см. get_course_data_cache)."""
+    return get_course_data_cache(course_id, f"funnel_{course_id}", funnel_cache_filepath(course_id),
+                                 lambda: calculate_course_funnel(course_id), refresh)
+
+
+@metrics_bp.route("/funnel", methods=['GET'])
+def get_funnel():
+    """
+    Воронка курса: сколько учащихся дошло до каждого шага в порядке курса (reached), решило шаг
+    или более поздний (solved) и остановилось на шаге (dropped).
+    ?course_id= (обязательный), ?group_by=step|lesson|module (по умолчанию step), ?refresh=1.
+    """
+    course_id = request.args.get('course_id', type=int)
+    group_by = request.args.get('group_by', 'step')
+    if course_id is None:
+        return jsonify({"error": "course_id is required"}), 400
+    if group_by not in FUNNEL_GROUPS:
+        return jsonify({"error": "Invalid parameters", "details": f"group_by: {FUNNEL_GROUPS}"}), 400
+    if db.session.get(Course, course_id) is None:
+        return jsonify({"error": f"Course {course_id} not found"}), 404
+
+    try:
+        funnel_data = get_course_funnel(course_id, refresh=request.args.get('refresh') == '1')
+    except Exception as e:
+        print(f"!!! Ошибка при расчете воронки курса {course_id}: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not calculate funnel", "details": str(e)}), 500
+    result = {key: funnel_data[key] for key in ("course_id", "enrolled", "attempted_users")}
+    result["group_by"] = group_by
+    result["items"] = funnel_data["steps" if group_by == 'step' else group_by]
+    return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json; charset=utf-8')
+
+
+@metrics_bp.route("/learners/progress", methods=['GET'])
+def get_learners_progress():
+    """
+    Прогресс учащихся курса постранично (из сводной таблицы learner_course_progress).
+    ?course_id= (обязательный), ?sort=last_activity|steps_solved|steps_attempted|score_sum|attempts|learner_id,
+    ?order=desc|asc, ?limit= (до MAX_LEARNERS_PAGE_SIZE), ?cursor= — next_cursor предыдущей страницы,
+    фильтры ?max_steps_solved= и ?inactive_since=YYYY-MM-DD (последняя активность раньше даты).
+    """
+    course_id = request.args.get('course_id', type=int)
+    sort = request.args.get('sort', 'last_activity')
+    order = request.args.get('order', 'desc')
+    limit = request.args.get('limit', LEARNERS_PAGE_SIZE, type=int)
+    max_steps_solved = request.args.get('max_steps_solved', type=int)
+    if course_id is None:
+        return jsonify({"error": "course_id is required"}), 400
+    if sort not in PROGRESS_SORT_KEYS or order not in ('asc', 'desc') or not 0 < limit <= MAX_LEARNERS_PAGE_SIZE:
+        return jsonify({"error": "Invalid parameters",
+                        "details": f"sort: {list(PROGRESS_SORT_KEYS)}, order: asc|desc, limit: 1..{MAX_LEARNERS_PAGE_SIZE}"}), 400
+    try:
+        inactive_since = parse_date_arg('inactive_since')
+    except ValueError as e:
+        return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+    if db.session.get(Course, course_id) is None:
+        return jsonify({"error": f"Course {course_id} not found"}), 404
+
+    try:
+        ensure_progress(course_id)
+        items, next_cursor = query_learner_progress(
+            course_id, sort=sort, order=order, limit=limit, cursor=request.args.get('cursor'),
+            max_steps_solved=max_steps_solved,
+            inactive_since=datetime.combine(inactive_since, datetime.min.time()) if inactive_since else None)
+    except ValueError as e:
+        return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+    except Exception as e:
+        print(f"!!! Ошибка при получении прогресса учащихся курса {course_id}: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not load learner progress", "details": str(e)}), 500
+    total = db.session.query(func.count(LearnerCourseProgress.learner_id))\
+        .filter(LearnerCourseProgress.course_id == course_id).scalar()
+    result = {"course_id": course_id, "sort": sort, "order": order, "total": total,
+              "items": items, "next_cursor": next_cursor}
+    return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json; charset=utf-8')
+
+
+@metrics_bp.route("/comments/search", methods=['GET'])
+def get_comments_search():
+    """
+    Поиск комментариев по словам (все слова запроса; "слово*" — по префиксу) через индекс comment_term.
+    ?q= (обязательный), ?course_id= или ?step_id=, ?from=/?to=YYYY-MM-DD, ?limit=, ?before_id= — next_before_id
+    предыдущей страницы. На первой странице также total и step_counts — число найденных комментариев по шагам.
+    """
+    query_text = request.args.get('q', '')
+    course_id = request.args.get('course_id', type=int)
+    step_id = request.args.get('step_id', type=int)
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    before_id = request.args.get('before_id', type=int)
+    if not parse_query(query_text):
+        return jsonify({"error": "q is required", "details": "Нужно хотя бы одно слово из 2 и более символов"}), 400
+    if not 0 < limit <= MAX_SEARCH_PAGE_SIZE:
+        return jsonify({"error": "Invalid parameters", "details": f"limit: 1..{MAX_SEARCH_PAGE_SIZE}"}), 400
+    try:
+        date_from = parse_date_arg('from')
+        date_to = parse_date_arg('to')
+    except ValueError as e:
+        return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+
+    step_ids = None
+    if course_id is not None:
+        if db.session.get(Course, course_id) is None:
+            return jsonify({"error": f"Course {course_id} not found"}), 404
+        step_ids = course_step_ids(course_id)
+    if step_id is not None:
+        step_ids = [step_id] if step_ids is None or step_id in step_ids else []
+
+    try:
+        result = search_comments(query_text, step_ids=step_ids, date_from=date_from, date_to=date_to, limit=limit,
+                                 before_id=before_id, with_step_counts=before_id is None)
+    except Exception as e:
+        print(f"!!! Ошибка при поиске комментариев ({query_text!r}): {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not search comments", "details": str(e)}), 500
+    result = {"query": query_text, "course_id": course_id, "step_id": step_id, **result}
+    return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json; charset=utf-8')
+
+
+@metrics_bp.route("/comments/threads", methods=['GET'])
+def get_comment_threads():
+    """
+    Обсуждение шага деревьями: ветки (корневой комментарий и все ответы на любую глубину)
+    с reply_count (прямые ответы) и descendant_count (все ответы ветки).
+    ?step_id= (обязательный), ?limit= — веток на страницу, ?before_root_id= — next_before_root_id предыдущей страницы.
+    """
+    step_id = request.args.get('step_id', type=int)
+    limit = request.args.get('limit', THREADS_PAGE_SIZE, type=int)
+    before_root_id = request.args.get('before_root_id', type=int)
+    if step_id is None:
+        return jsonify({"error": "step_id is required"}), 400
+    if not 0 < limit <= MAX_THREADS_PAGE_SIZE:
+        return jsonify({"error": "Invalid parameters", "details": f"limit: 1..{MAX_THREADS_PAGE_SIZE}"}), 400
+    if db.session.get(Step, step_id) is None:
+        return jsonify({"error": f"Step {step_id} not found"}), 404
+
+    try:
+        result = step_comment_threads(step_id, limit=limit, before_root_id=before_root_id)
+    except Exception as e:
+        print(f"!!! Ошибка при получении обсуждения шага {step_id}: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not load comment threads", "details": str(e)}), 500
+    return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json; charset=utf-8')
+
+
+@metrics_bp.route("/comments/activity", methods=['GET'])
+def get_comment_activity():
+    """
+    Активность в обсуждениях курса по шагам и в целом: доля комментариев преподавателей, доля удаленных,
+    ветки без ответа, медиана/p90 задержки первого ответа преподавателя на ветку учащегося (сек).
+    ?course_id= (обязательный), ?from=/?to=YYYY-MM-DD. Считается по дневным агрегатам step_comment_rollup.
+    """
+    course_id = request.args.get('course_id', type=int)
+    if course_id is None:
+        return jsonify({"error": "course_id is required"}), 400
+    try:
+        date_from = parse_date_arg('from')
+        date_to = parse_date_arg('to')
+    except ValueError as e:
+        return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+    if db.session.get(Course, course_id) is None:
+        return jsonify({"error": f"Course {course_id} not found"}), 404
+
+    try:
+        result = course_comment_activity(course_id, date_from=date_from, date_to=date_to)
+    except Exception as e:
+        print(f"!!! Ошибка при расчете активности обсуждений курса {course_id}: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not calculate comment activity", "details": str(e)}), 500
+    result["date_from"] = date_from.isoformat() if date_from else None
+    result["date_to"] = date_to.isoformat() if date_to else None
+    return Response(json.dumps(result, ensure_ascii=False), mimetype='application/json; charset=utf-8')
+
+
+EXPORT_PROGRESS_PAGE_ROWS = 1000 # Строк прогресса учащихся за один запрос при выгрузке
+
+
+def iter_structure_rows(course_ids, date_from=None, date_to=None):
+    """Шаги курсов по одному курсу за раз (из кеша или по дневным агрегатам за период), без копирования списков."""
+    for course_id in course_ids:
+        if date_from is not None or date_to is not None:
+            yield from calculate_course_structure_window(course_id, date_from, date_to)
+        else:
+            yield from get_cached_course_structure(course_id) or []
+
+
+def iter_learner_progress_rows(course_id):
+    """Весь прогресс учащихся курса страницами по ключу (learner_id)."""
+    cursor = None
+    while True:
+        items, cursor = query_learner_progress(course_id, sort='learner_id', order='asc',
+                                               limit=EXPORT_PROGRESS_PAGE_ROWS, cursor=cursor)
+        yield from items
+        if cursor is None:
+            break
+
+
+@metrics_bp.route("/export/<dataset>", methods=['GET'])
+def export_dataset(dataset):
+    """
+    Выгрузка в файл: dataset = structure | completion_rates | teachers | learner_progress.
+    ?format=csv|xlsx (по умолчанию csv), ?columns=a,b,c — колонки и их порядок (для structure — поля /steps/structure),
+    ?course_id= (обязателен для learner_progress), для structure также ?from=/?to=YYYY-MM-DD.
+    """
+    export_format = request.args.get('format', 'csv')
+    course_id = request.args.get('course_id', type=int)
+    if dataset not in EXPORT_COLUMNS:
+        return jsonify({"error": f"Unknown dataset {dataset}", "details": f"dataset: {list(EXPORT_COLUMNS)}"}), 404
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": "Invalid parameters", "details": f"format: {list(EXPORT_FORMATS)}"}), 400
+    try:
+        columns = resolve_columns(dataset, request.args.get('columns'))
+        date_from = parse_date_arg('from')
+        date_to = parse_date_arg('to')
+    except ValueError as e:
+        return jsonify({"error": "Invalid parameters", "details": str(e)}), 400
+    if course_id is not None and db.session.get(Course, course_id) is None:
+        return jsonify({"error": f"Course {course_id} not found"}), 404
+
+    try:
+        if dataset == 'structure':
+            if course_id is not None:
+                course_ids = [course_id]
             else:
-                 step_data["usefulness_index"] = None # Или 0.0, если просмотров нет
-
-            step_data["avg_completion_time_filtered_seconds"] = avg_time_filtered_data.get(step.step_id, None)
-
-            # ---> РАСЧЕТ ОБОИХ ИНДЕКСОВ: Skip Rate и Completion Index <---
-            step_course_id = step_data["course_id"]
-            current_step_index = step_positions.get(step.step_id)
-
-            # Общие проверки
-            if step_course_id and step_course_id in course_step_order and current_step_index is not None:
-                ordered_steps = course_step_order[step_course_id]
-                is_last_step = (current_step_index == len(ordered_steps) - 1)
-                next_step_ids = ordered_steps[current_step_index + 1:] if not is_last_step else []
-                next_step_ids_set = set(next_step_ids)
-
-                # Множества пользователей для текущего шага
-                current_attempted_set = attempted_users_sets.get(step.step_id, set())
-                current_passed_set = passed_users_sets.get(step.step_id, set())
-                failed_user_ids = current_attempted_set - current_passed_set # R для Skip Rate
-
-                # --- Расчет Skip Rate (Метрика 3) ---
-                numerator_r_skip = len(failed_user_ids) # R = число не прошедших
-                step_data["skip_rate_numerator_r"] = numerator_r_skip
-                denominator_t_skip = 0 # T = число R, решивших хоть что-то дальше (верно)
-
-                if numerator_r_skip > 0 and not is_last_step:
-                    for failed_user_id in failed_user_ids:
-                         found_next_success = False
-                         for next_step_id in next_step_ids:
-                             if (failed_user_id, next_step_id) in correct_submissions_set: # Проверяем ВЕРНЫЕ
-                                 found_next_success = True; break
-                         if found_next_success: denominator_t_skip += 1
-                step_data["skip_rate_denominator_t"] = denominator_t_skip
-                step_data["skip_rate"] = (float(numerator_r_skip) / denominator_t_skip) if denominator_t_skip > 0 else (0.0 if numerator_r_skip == 0 else None) # None если R>0, T=0
-                step_data["skip_rate"] = (float(denominator_t_skip) / numerator_r_skip) if numerator_r_skip > 0 else (0.0 if denominator_t_skip == 0 else None)
-
-                # --- Расчет Completion Index (Метрика 4) ---
-                denominator_t_comp = len(current_attempted_set) # T = число пытавшихся
-                step_data["completion_denominator_t"] = denominator_t_comp
-                numerator_r_comp = 0 # R = число T, не пытавшихся ничего дальше
-
-                if denominator_t_comp > 0 and not is_last_step:
-                    for user_id in current_attempted_set: # Итерируем по всем пытавшимся
-                        attempted_subsequent = False
-                        for next_step_id in next_step_ids:
-                            if (user_id, next_step_id) in all_attempted_pairs_set: # Проверяем ЛЮБЫЕ попытки
-                                attempted_subsequent = True; break
-                        if not attempted_subsequent: numerator_r_comp += 1
-                elif is_last_step: # Если последний шаг, R=0
-                     numerator_r_comp = 0
-
-                step_data["completion_numerator_r"] = numerator_r_comp
-                step_data["completion_index"] = (float(numerator_r_comp) / denominator_t_comp) if denominator_t_comp > 0 else 0.0
-
-            else: # Не удалось определить курс/порядок или шаг последний (для skip_rate T)
-                 step_data["skip_rate"] = None; step_data["skip_rate_numerator_r"] = None; step_data["skip_rate_denominator_t"] = None
-                 step_data["completion_index"] = None if current_step_index is not None else 0.0 # 0.0 для последнего шага
-                 step_data["completion_numerator_r"] = None if current_step_index is not None else 0
-                 step_data["completion_denominator_t"] = attempted_users_count if step_submissions else 0
-            # ------------------------------------------------------
-
-            step_data["discrimination_index"] = discrimination_indices.get(step.step_id, None)
-
-            results_list.append(step_data)
-
-        # 5. СОХРАНЕНИЕ В КЕШ (in-memory и файловый)
-        if results_list:
-            structure_with_metrics_cache[cache_key] = results_list
-            save_cache_to_file(results_list, cache_filepath)
+                course_ids = [row.course_id for row in db.session.query(Course.course_id).order_by(Course.course_id).all()]
+            if date_from is None and date_to is None:
+                missing_course_ids = [cid for cid in course_ids if not has_cached_course_structure(cid)]
+                for missing_course_id, results_list in calculate_structures_to_store(missing_course_ids):
+                    store_course_structure(missing_course_id, results_list)
+            rows = iter_structure_rows(course_ids, date_from, date_to)
+        elif dataset == 'learner_progress':
+            if course_id is None:
+                return jsonify({"error": "course_id is required"}), 400
+            ensure_progress(course_id)
+            rows = iter_learner_progress_rows(course_id)
         else:
-             structure_with_metrics_cache[cache_key] = []
-             save_cache_to_file([], cache_filepath)
+            storage_key = 'teachers' if dataset == 'teachers' else 'course_completion_rates'
+            stored_data = calculated_metrics_storage.get(storage_key)
+            if stored_data is None or (isinstance(stored_data, dict) and "error" in stored_data):
+                return jsonify({"error": f"{dataset} data not pre-calculated",
+                                "details": stored_data.get("details") if isinstance(stored_data, dict) else None}), 500
+            if dataset == 'teachers':
+                rows = iter(stored_data)
+            else:
+                rows = (flatten_completion_rates(course_data) for course_data in stored_data.values()
+                        if course_id is None or course_data.get("course_id") == course_id)
+    except Exception as e:
+        print(f"!!! Ошибка при подготовке выгрузки {dataset} (курс: {course_id}): {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not export data", "details": str(e)}), 500
 
-        total_duration = time.time() - start_time
-        print(f"--- Формирование списка шагов С НОВЫМИ МЕТРИКАМИ завершено (ключ: {cache_key}, за {total_duration:.2f} сек).")
-        json_string = json.dumps(results_list, ensure_ascii=False)
-        return Response(json_string, mimetype='application/json; charset=utf-8')
+    filename = f"{dataset}_course_{course_id}.{export_format}" if course_id is not None else f"{dataset}.{export_format}"
+    stream = csv_stream(rows, columns) if export_format == 'csv' else xlsx_stream(rows, columns, dataset)
+    return Response(stream_with_context(stream), mimetype=EXPORT_FORMATS[export_format],
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
+@metrics_bp.route("/cohorts", methods=['GET'])
+def get_cohorts():
+    """
+    Когорты учащихся курса (по неделе или месяцу зачисления) и их метрики по шагам.
+    ?course_id= (обязательный), ?period=week|month, ?basis=enrollment|joined, ?refresh=1 — пересчитать.
+    Матрица считается один раз для курса и берется из кеша (in-memory и файлового) до следующего импорта данных курса.
+    """
+    course_id = request.args.get('course_id', type=int)
+    period = request.args.get('period', 'week')
+    basis = request.args.get('basis', 'enrollment')
+    if course_id is None:
+        return jsonify({"error": "course_id is required"}), 400
+    if period not in COHORT_PERIODS or basis not in COHORT_BASES:
+        return jsonify({"error": "Invalid parameters", "details": f"period: {COHORT_PERIODS}, basis: {COHORT_BASES}"}), 400
+    if db.session.get(Course, course_id) is None:
+        return jsonify({"error": f"Course {course_id} not found"}), 404
 
+    try:
+        cohorts_data = get_course_cohorts(course_id, period, basis, refresh=request.args.get('refresh') == '1')
     except Exception as e:
-        if cache_key in structure_with_metrics_cache: del structure_with_metrics_cache[cache_key]
-        total_duration = time.time() - start_time
-        print(f"!!! Ошибка при расчете структуры шагов с НОВЫМИ метриками (ключ: {cache_key}, за {total_duration:.2f} сек): {e}")
+        print(f"!!! Ошибка при расчете когорт курса {course_id}: {e}")
         traceback.print_exc()
-        return jsonify({"error": "Could not retrieve step structure with metrics", "details": str(e)}), 500
-    
+        return jsonify({"error": "Could not calculate cohorts", "details": str(e)}), 500
+    json_string = json.dumps(cohorts_data, ensure_ascii=False)
+    return Response(json_string, mimetype='application/json; charset=utf-8')
+
+
+# --- Инструментирование: тайминги и профилирование запросов ---
+@metrics_bp.before_request
+def start_request_profile():
+    """
+    ?profile=1 — запрос выполняется под cProfile, вместо данных возвращается сводка.
+    Тело потокового ответа (все курсы /steps/structure, метрики за период, /export) формируется
+    генератором уже после обработчика, поэтому при профилировании оно вычитывается в finish_request_profile.
+    """
+    if request.args.get('profile') == '1':
+        g.request_profiler = start_profile()
+        g.request_profile_started = time.time()
+
+@metrics_bp.after_request
+def finish_request_profile(response):
+    profiler = g.pop('request_profiler', None)
+    if profiler is None:
+        return response
+    started = g.pop('request_profile_started')
+    body_bytes = None
+    if response.is_streamed: # Основная работа потокового ответа — в генераторе тела: выполняется под профайлером
+        body_bytes = sum(len(chunk) for chunk in response.iter_encoded())
+        response.close()
+    profile_text = stop_profile(profiler)
+    request_spans = [s for s in get_spans() if s["started_at"] >= started]
+    json_string = json.dumps({
+        "path": request.path, "status_code": response.status_code,
+        "duration_seconds": time.time() - started, "streamed_body_bytes": body_bytes,
+        "spans": summarize_spans(request_spans),
+        "profile": profile_text,
+    }, ensure_ascii=False, indent=2)
+    return Response(json_string, mimetype='application/json; charset=utf-8')
+
+
+@metrics_bp.route("/warmup", methods=['GET'])
+def get_warmup_progress():
+    """
+    Состояние фонового прогрева кеша структуры (см. warmup): текущий проход (total, done, pending, failed)
+    и число курсов, кеш которых сейчас отсутствует или устарел.
+    """
+    try:
+        reasons = stale_course_ids()
+    except Exception as e:
+        print(f"!!! Ошибка при проверке кеша структуры курсов: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "Could not check structure caches", "details": str(e)}), 500
+    json_string = json.dumps({
+        **warmup_progress(),
+        "missing_courses": sorted(course_id for course_id, reason in reasons.items() if reason == "missing"),
+        "stale_courses": sorted(course_id for course_id, reason in reasons.items() if reason == "stale"),
+    }, ensure_ascii=False)
+    return Response(json_string, mimetype='application/json; charset=utf-8')
+
+
+@metrics_bp.route("/_debug/timings", methods=['GET'])
+def get_debug_timings():
+    """
+    Последние интервалы (фазы расчета и SQL-запросы) из кольцевого буфера процесса.
+    ?limit= — число последних интервалов, ?name= — префикс имени,
+    ?format=prometheus — агрегаты в текстовом формате Prometheus.
+    """
+    limit = request.args.get('limit', default=200, type=int)
+    name_prefix = request.args.get('name')
+    if request.args.get('format') == 'prometheus':
+        return Response(prometheus_text(name_prefix=name_prefix), content_type='text/plain; version=0.0.4; charset=utf-8')
+    json_string = json.dumps({
+        "summary": summarize_spans(get_spans(name_prefix=name_prefix)),
+        "spans": get_spans(limit=limit, name_prefix=name_prefix),
+    }, ensure_ascii=False)
+    return Response(json_string, mimetype='application/json; charset=utf-8')
+
 
 @metrics_bp.route("/courses", methods=['GET'])
 def get_all_courses():
@@ -1,9 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from sqlalchemy.dialects.mysql import LONGTEXT
-from sqlalchemy import String, Text, Float, ForeignKey, Integer
+from sqlalchemy import String, Text, Float, ForeignKey, Integer, Date, BigInteger, LargeBinary
+from .db_routing import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession}) # Чтение с реплики для запросов метрик, см. db_routing.py
 
 enrollment_table = db.Table('enrollment',
     db.Column('learner_id', Integer, ForeignKey('learner.user_id'), primary_key=True),
@@ -113,4 +114,128 @@ class AdditionalStepInfo(db.Model):
     passed = db.Column(Integer, nullable=True)
 
     def __repr__(self):
-        return f'<AdditionalStepInfo for Step {self.step_id}>'
\ No newline at end of file
+        return f'<AdditionalStepInfo for Step {self.step_id}>'
+
+class StepDailyRollup(db.Model):
+    """
+    Дневной агрегат по шагу: сабмишены по дате submission_time, комментарии по дате time.
+    Уникальные пользователи хранятся как HyperLogLog (sketches.py), чтобы их можно было
+    объединять по любому диапазону дней. Заполняется и обновляется модулем rollups.py.
+    """
+    __tablename__ = 'step_daily_rollup'
+    step_id = db.Column(Integer, ForeignKey('step.step_id'), primary_key=True)
+    day = db.Column(Date, primary_key=True)
+    submissions_count = db.Column(Integer, nullable=False, default=0)
+    correct_count = db.Column(Integer, nullable=False, default=0)
+    attempted_users_sketch = db.Column(LargeBinary, nullable=True) # Пытавшиеся в этот день
+    passed_users_sketch = db.Column(LargeBinary, nullable=True)    # Решившие верно в этот день
+    comments_count = db.Column(Integer, nullable=False, default=0)
+    commenting_users_sketch = db.Column(LargeBinary, nullable=True)
+    # Время решения (первая попытка -> последняя верная, не дольше отсечки) относится ко дню последней верной попытки
+    solve_time_sum_seconds = db.Column(BigInteger, nullable=False, default=0)
+    solve_time_count = db.Column(Integer, nullable=False, default=0)
+    solve_time_sketch = db.Column(LargeBinary, nullable=True) # KLLSketch всех времен решения (без отсечки)
+
+    def __repr__(self):
+        return f'<StepDailyRollup step={self.step_id} day={self.day}>'
+
+
+class LearnerCourseProgress(db.Model):
+    """
+    Прогресс учащегося в курсе (сводка по сабмишенам), для /api/learners.
+    Индексы (course_id, ключ сортировки, learner_id) позволяют листать страницы по ключу (keyset),
+    не вычисляя OFFSET. Заполняется и обновляется модулем progress.py.
+    """
+    __tablename__ = 'learner_course_progress'
+    learner_id = db.Column(Integer, ForeignKey('learner.user_id'), primary_key=True)
+    course_id = db.Column(Integer, ForeignKey('course.course_id'), primary_key=True)
+    steps_attempted = db.Column(Integer, nullable=False, default=0)
+    steps_solved = db.Column(Integer, nullable=False, default=0)
+    score_sum = db.Column(Integer, nullable=False, default=0) # Сумма лучших баллов по шагам
+    attempts = db.Column(Integer, nullable=False, default=0)  # Всего сабмишенов
+    first_activity = db.Column(db.DateTime, nullable=True)
+    last_activity = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_progress_course_last_activity', 'course_id', 'last_activity', 'learner_id'),
+        db.Index('ix_progress_course_steps_solved', 'course_id', 'steps_solved', 'learner_id'),
+        db.Index('ix_progress_course_steps_attempted', 'course_id', 'steps_attempted', 'learner_id'),
+        db.Index('ix_progress_course_score_sum', 'course_id', 'score_sum', 'learner_id'),
+        db.Index('ix_progress_course_attempts', 'course_id', 'attempts', 'learner_id'),
+    )
+
+    def __repr__(self):
+        return f'<LearnerCourseProgress learner={self.learner_id} course={self.course_id}>'
+
+
+class CommentTerm(db.Model):
+    """
+    Инвертированный индекс текста комментариев: одна строка на (слово, комментарий).
+    step_id и time продублированы из comment, чтобы фильтры поиска по шагу/курсу и дате
+    проверялись по тем же строкам индекса без чтения comment. Заполняется модулем comment_search.py.
+    """
+    __tablename__ = 'comment_term'
+    term = db.Column(String(64), primary_key=True)
+    comment_id = db.Column(Integer, ForeignKey('comment.comment_id'), primary_key=True, index=True)
+    step_id = db.Column(Integer, nullable=True)
+    time = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<CommentTerm {self.term!r} comment={self.comment_id}>'
+
+
+class StepCommentRollup(db.Model):
+    """
+    Дневной агрегат активности в обсуждении шага. Комментарии учитываются по дню time,
+    ветки (корневой комментарий и все ответы на него) — по дню корневого комментария.
+    Преподаватель — автор с Learner.is_learner == False. Заполняется модулем comment_activity.py.
+    """
+    __tablename__ = 'step_comment_rollup'
+    step_id = db.Column(Integer, ForeignKey('step.step_id'), primary_key=True)
+    day = db.Column(Date, primary_key=True)
+    teacher_comments = db.Column(Integer, nullable=False, default=0)
+    learner_comments = db.Column(Integer, nullable=False, default=0)
+    deleted_comments = db.Column(Integer, nullable=False, default=0)
+    threads_count = db.Column(Integer, nullable=False, default=0)
+    learner_threads = db.Column(Integer, nullable=False, default=0)     # Ветки, начатые учащимися
+    unanswered_threads = db.Column(Integer, nullable=False, default=0)  # Ветки без единого ответа
+    teacher_answered_threads = db.Column(Integer, nullable=False, default=0) # Ветки учащихся с ответом преподавателя
+    teacher_response_sketch = db.Column(LargeBinary, nullable=True) # KLLSketch задержки первого ответа преподавателя, сек
+
+    def __repr__(self):
+        return f'<StepCommentRollup step={self.step_id} day={self.day}>'
+
+
+class StepMetricsVersion(db.Model):
+    """
+    Версии метрик шагов в кеше структуры курса (для /steps/structure/changes). Версия курса растет
+    при каждом сохранении структуры, в котором изменился, появился или пропал хотя бы один шаг.
+    Для шага хранится хеш его словаря метрик и версии добавления, последнего изменения и удаления
+    (строки удаленных шагов остаются, чтобы клиент с любой старой версией узнал об удалении).
+    Заполняется модулем structure_versions.py.
+    """
+    __tablename__ = 'step_metrics_version'
+    course_id = db.Column(Integer, ForeignKey('course.course_id'), primary_key=True)
+    step_id = db.Column(Integer, primary_key=True) # Без внешнего ключа: шаг мог быть удален из структуры
+    metrics_hash = db.Column(String(40), nullable=False)
+    added_version = db.Column(Integer, nullable=False)
+    changed_version = db.Column(Integer, nullable=False)
+    removed_version = db.Column(Integer, nullable=True)
+
+    def __repr__(self):
+        return f'<StepMetricsVersion course={self.course_id} step={self.step_id} v={self.changed_version}>'
+
+
+class CourseDataChange(db.Model):
+    """
+    Время последнего импорта, затронувшего данные курса. Кеш структуры курса, сохраненный раньше
+    этого времени, считается устаревшим и пересчитывается фоновым прогревом (warmup.py);
+    кеш когорт и воронки пересчитывается при следующем запросе.
+    Импорт идет в отдельном процессе (seed_database.py), поэтому отметка хранится в БД.
+    """
+    __tablename__ = 'course_data_change'
+    course_id = db.Column(Integer, ForeignKey('course.course_id'), primary_key=True)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<CourseDataChange course={self.course_id} at={self.changed_at}>'
@@ -0,0 +1,130 @@
+import numpy as np
+
+# --- Компактное множество пар (user_id, step_id) ---
+# Пара упаковывается в один int64: step_id в старших 32 битах, user_id в младших.
+# Массив ключей отсортирован и без повторов, поэтому пары одного шага лежат подряд:
+# членство и выборка пользователей шага — бинарный поиск, 8 байт на пару вместо ~100+ у set кортежей.
+_USER_BITS = 32
+_USER_MASK = (1 << _USER_BITS) - 1
+
+
+def pack_pairs(user_ids, step_ids):
+    """Упаковывает массивы user_id и step_id в массив int64-ключей."""
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    step_ids = np.asarray(step_ids, dtype=np.int64)
+    return (step_ids << _USER_BITS) | user_ids
+
+
+class PairSet:
+    """Неизменяемое множество пар (user_id, step_id) на отсортированном массиве int64."""
+    __slots__ = ('keys',)
+
+    def __init__(self, keys=None):
+        # keys должны быть отсортированы и уникальны (используйте конструкторы from_*)
+        self.keys = np.asarray(keys if keys is not None else [], dtype=np.int64)
+
+    @classmethod
+    def from_arrays(cls, user_ids, step_ids):
+        return cls(np.unique(pack_pairs(user_ids, step_ids)))
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Из итерируемого (user_id, step_id); пары с None пропускаются."""
+        pairs = [(user_id, step_id) for user_id, step_id in pairs if user_id is not None and step_id is not None]
+        if not pairs:
+            return cls()
+        user_ids, step_ids = zip(*pairs)
+        return cls.from_arrays(user_ids, step_ids)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, pair):
+        user_id, step_id = pair
+        key = (int(step_id) << _USER_BITS) | int(user_id)
+        i = np.searchsorted(self.keys, key)
+        return bool(i < len(self.keys) and self.keys[i] == key)
+
+    def contains(self, user_ids, step_ids):
+        """Векторная проверка членства: bool-массив для пар (user_ids[i], step_ids[i])."""
+        probe = pack_pairs(user_ids, step_ids)
+        if not len(self.keys):
+            return np.zeros(probe.shape, dtype=bool)
+        i = np.searchsorted(self.keys, probe)
+        i[i == len(self.keys)] = 0
+        return self.keys[i] == probe
+
+    @property
+    def user_ids(self):
+        return self.keys & _USER_MASK
+
+    @property
+    def step_ids(self):
+        return self.keys >> _USER_BITS
+
+    def _step_bounds(self, step_id):
+        lo = np.searchsorted(self.keys, int(step_id) << _USER_BITS)
+        hi = np.searchsorted(self.keys, (int(step_id) + 1) << _USER_BITS)
+        return lo, hi
+
+    def users(self, step_id):
+        """Отсортированный массив user_id, у которых есть пара с шагом step_id."""
+        lo, hi = self._step_bounds(step_id)
+        return self.keys[lo:hi] & _USER_MASK
+
+    def count(self, step_id):
+        """Число пользователей шага (кардинальность по шагу)."""
+        lo, hi = self._step_bounds(step_id)
+        return int(hi - lo)
+
+    def counts(self):
+        """{step_id: число пользователей} для всех шагов множества."""
+        steps, step_counts = np.unique(self.step_ids, return_counts=True)
+        return dict(zip(steps.tolist(), step_counts.tolist()))
+
+    def union(self, other):
+        return PairSet(np.union1d(self.keys, other.keys))
+
+    def intersection(self, other):
+        return PairSet(np.intersect1d(self.keys, other.keys, assume_unique=True))
+
+    def difference(self, other):
+        return PairSet(np.setdiff1d(self.keys, other.keys, assume_unique=True))
+
+    def furthest_per_user(self, step_index):
+        """
+        Для каждого пользователя — максимальный порядковый индекс шага среди его пар.
+        step_index: {step_id: позиция шага в курсе}; шаги без позиции игнорируются.
+        Возвращает (отсортированные user_id, индексы) — один проход сортировки по массиву.
+        """
+        if not len(self.keys):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        known_steps = np.fromiter(step_index.keys(), dtype=np.int64, count=len(step_index))
+        known_positions = np.fromiter(step_index.values(), dtype=np.int64, count=len(step_index))
+        order = np.argsort(known_steps)
+        known_steps, known_positions = known_steps[order], known_positions[order]
+
+        step_ids = self.step_ids
+        i = np.searchsorted(known_steps, step_ids)
+        i[i == len(known_steps)] = 0
+        has_position = known_steps[i] == step_ids
+        users = self.user_ids[has_position]
+        positions = known_positions[i[has_position]]
+
+        # Сортировка по (user, position): последняя запись каждого пользователя — его максимум
+        order = np.lexsort((positions, users))
+        users, positions = users[order], positions[order]
+        is_last = np.ones(len(users), dtype=bool)
+        is_last[:-1] = users[1:] != users[:-1]
+        return users[is_last], positions[is_last]
+
+
+def lookup_per_user(user_ids, per_user_keys, per_user_values, default=-1):
+    """Значения per_user_values для user_ids (ключи per_user_keys отсортированы); default, если нет."""
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    if not len(per_user_keys):
+        return np.full(user_ids.shape, default, dtype=np.int64)
+    i = np.searchsorted(per_user_keys, user_ids)
+    i[i == len(per_user_keys)] = 0
+    found = per_user_keys[i] == user_ids
+    return np.where(found, per_user_values[i], default)
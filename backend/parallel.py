@@ -0,0 +1,74 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import Flask, current_app, has_app_context
+
+from .models import db
+from .instrumentation import install_sql_instrumentation
+from .db_routing import configure_database
+
+# --- Параллельный расчет метрик (ProcessPoolExecutor) ---
+# Единица работы — курс (или урок для дискриминативности).
+# Каждый процесс-воркер создает собственное Flask-приложение и, соответственно,
+# собственный пул соединений с БД. Соединения родительского процесса не наследуются.
+_worker_app = None
+DEFAULT_METRICS_WORKERS = 2 # Пул не занимает все ядра веб-сервера (больше — через METRICS_WORKERS или --workers)
+
+def create_metrics_app(database_uri):
+    """Минимальное Flask-приложение с подключением к БД (для воркеров и бенчмарков)."""
+    app = Flask(__name__)
+    configure_database(app, database_uri) # Параметры пула — из того же окружения, что у основного процесса
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    install_sql_instrumentation()
+    return app
+
+def get_metrics_workers(max_workers=None, default=DEFAULT_METRICS_WORKERS):
+    """
+    Число процессов для расчета метрик: явный аргумент, затем
+    app.config['METRICS_WORKERS'], затем default (для пакетного пересчета передается число ядер).
+    """
+    if max_workers is None and has_app_context():
+        max_workers = current_app.config.get('METRICS_WORKERS')
+    if max_workers is None:
+        max_workers = default
+    return max(1, int(max_workers))
+
+def _init_worker(database_uri):
+    """Инициализатор процесса-воркера: отдельное приложение и движок БД."""
+    global _worker_app
+    if database_uri is not None:
+        _worker_app = create_metrics_app(database_uri)
+
+def _run_unit(func, unit):
+    if _worker_app is None:
+        return func(*unit)
+    with _worker_app.app_context():
+        return func(*unit)
+
+def run_parallel(func, units, max_workers=None, database_uri=None):
+    """
+    Выполняет func(*unit) для каждого unit (кортеж аргументов).
+    Генератор: отдает результаты СТРОГО в порядке units, поэтому итог
+    не зависит от того, какой воркер закончил первым.
+    database_uri нужен, если func обращается к БД — тогда у воркера будет свой app context.
+    При max_workers == 1 (или одной единице работы) выполняет в текущем процессе.
+    """
+    units = list(units)
+    if not units:
+        return
+    max_workers = min(get_metrics_workers(max_workers), len(units))
+
+    if max_workers == 1:
+        for unit in units:
+            yield func(*unit)
+        return
+
+    print(f"--- Параллельный расчет {func.__name__}: единиц работы={len(units)}, процессов={max_workers} ---")
+    # spawn вместо fork: не копируем соединения и потоки веб-сервера в дочерние процессы
+    mp_context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context,
+                             initializer=_init_worker, initargs=(database_uri,)) as pool:
+        futures = [pool.submit(_run_unit, func, unit) for unit in units]
+        for future in futures:
+            yield future.result()
@@ -0,0 +1,144 @@
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import func, distinct, case, insert, and_, or_
+
+from .models import db, Submission, Step, Lesson, Module, Learner, LearnerCourseProgress
+from .rollups import course_step_ids
+from .instrumentation import span
+from .db_routing import pin_primary
+
+# --- Прогресс учащихся по курсам (learner_course_progress) ---
+# Сводка по (learner, course) пересчитывается целиком для курса двумя GROUP BY по сабмишенам
+# (после импорта — только для затронутых курсов). Страницы /api/learners листаются по ключу:
+# курсор — значение ключа сортировки и learner_id последней строки страницы.
+PROGRESS_INSERT_CHUNK = 5000
+LEARNERS_PAGE_SIZE = 50
+MAX_LEARNERS_PAGE_SIZE = 500
+SORT_KEYS = {
+    "last_activity": LearnerCourseProgress.last_activity,
+    "steps_solved": LearnerCourseProgress.steps_solved,
+    "steps_attempted": LearnerCourseProgress.steps_attempted,
+    "score_sum": LearnerCourseProgress.score_sum,
+    "attempts": LearnerCourseProgress.attempts,
+    "learner_id": LearnerCourseProgress.learner_id,
+}
+
+
+def refresh_course_progress(course_id):
+    """Пересчитывает прогресс всех учащихся курса (удаляет старые строки и записывает новые)."""
+    pin_primary(db.session) # Пересчет читает основную БД: строки по отстающей реплике были бы устаревшими
+    with span("progress.refresh", log=True, course_id=course_id) as refresh_span:
+        step_ids = course_step_ids(course_id)
+        rows = {}
+        if step_ids:
+            course_submissions = and_(Submission.step_id.in_(step_ids), Submission.user_id.isnot(None))
+            for row in db.session.query(
+                    Submission.user_id,
+                    func.count(Submission.submission_id),
+                    func.count(distinct(Submission.step_id)),
+                    func.count(distinct(case((Submission.status == 'correct', Submission.step_id)))),
+                    func.min(Submission.submission_time),
+                    func.max(Submission.submission_time)
+            ).filter(course_submissions).group_by(Submission.user_id).all():
+                user_id, attempts, steps_attempted, steps_solved, first_activity, last_activity = row
+                rows[user_id] = {"learner_id": user_id, "course_id": course_id, "attempts": attempts,
+                                 "steps_attempted": steps_attempted, "steps_solved": steps_solved, "score_sum": 0,
+                                 "first_activity": first_activity, "last_activity": last_activity}
+            # Сумма лучших баллов по шагам
+            best_scores = db.session.query(Submission.user_id, Submission.step_id, func.max(Submission.score).label('best_score'))\
+                .filter(course_submissions).group_by(Submission.user_id, Submission.step_id).subquery()
+            for user_id, score_sum in db.session.query(best_scores.c.user_id, func.sum(best_scores.c.best_score))\
+                    .group_by(best_scores.c.user_id).all():
+                if user_id in rows:
+                    rows[user_id]["score_sum"] = int(score_sum or 0)
+
+        db.session.query(LearnerCourseProgress).filter(LearnerCourseProgress.course_id == course_id).delete(synchronize_session=False)
+        values = list(rows.values())
+        for chunk_start in range(0, len(values), PROGRESS_INSERT_CHUNK):
+            db.session.execute(insert(LearnerCourseProgress), values[chunk_start:chunk_start + PROGRESS_INSERT_CHUNK])
+        db.session.commit()
+        refresh_span["rows"] = len(values)
+    return len(values)
+
+
+def refresh_progress_for_steps(step_ids):
+    """Пересчитывает прогресс в курсах, которым принадлежат шаги step_ids (после импорта сабмишенов)."""
+    step_ids = [step_id for step_id in step_ids if step_id is not None]
+    if not step_ids:
+        return 0
+    course_ids = sorted({row.course_id for row in db.session.query(Module.course_id).select_from(Step)
+                         .join(Step.lesson).join(Lesson.module).filter(Step.step_id.in_(step_ids)).distinct().all()})
+    return sum(refresh_course_progress(course_id) for course_id in course_ids)
+
+
+def ensure_progress(course_id):
+    """Строит прогресс курса, если строк еще нет совсем (например, БД заполнена до появления таблицы)."""
+    if db.session.query(LearnerCourseProgress.learner_id).filter(LearnerCourseProgress.course_id == course_id).first() is None:
+        refresh_course_progress(course_id)
+
+
+def encode_cursor(sort_value, learner_id):
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([sort_value, learner_id]).encode()).decode()
+
+
+def decode_cursor(cursor, sort):
+    """(значение ключа сортировки, learner_id) из курсора; ValueError для некорректного курсора."""
+    try:
+        sort_value, learner_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if sort == 'last_activity' and sort_value is not None:
+            sort_value = datetime.fromisoformat(sort_value)
+        return sort_value, int(learner_id)
+    except (TypeError, ValueError, json.JSONDecodeError) as e:
+        raise ValueError(f"Некорректный курсор: {e}")
+
+
+def query_learner_progress(course_id, sort='last_activity', order='desc', limit=LEARNERS_PAGE_SIZE, cursor=None,
+                           max_steps_solved=None, inactive_since=None):
+    """
+    Страница прогресса учащихся курса, отсортированная по sort (с learner_id для однозначности).
+    Возвращает (строки, курсор следующей страницы или None). Стоимость не зависит от номера страницы.
+    """
+    sort_column = SORT_KEYS[sort]
+    descending = order == 'desc'
+    progress_query = db.session.query(LearnerCourseProgress, Learner.first_name, Learner.last_name, Learner.is_learner)\
+        .join(Learner, Learner.user_id == LearnerCourseProgress.learner_id)\
+        .filter(LearnerCourseProgress.course_id == course_id)
+    if max_steps_solved is not None:
+        progress_query = progress_query.filter(LearnerCourseProgress.steps_solved <= max_steps_solved)
+    if inactive_since is not None:
+        progress_query = progress_query.filter(LearnerCourseProgress.last_activity < inactive_since)
+
+    if cursor is not None:
+        sort_value, last_learner_id = decode_cursor(cursor, sort)
+        id_column = LearnerCourseProgress.learner_id
+        if sort == 'learner_id':
+            progress_query = progress_query.filter(id_column < last_learner_id if descending else id_column > last_learner_id)
+        elif descending:
+            progress_query = progress_query.filter(or_(sort_column < sort_value,
+                                                       and_(sort_column == sort_value, id_column < last_learner_id)))
+        else:
+            progress_query = progress_query.filter(or_(sort_column > sort_value,
+                                                       and_(sort_column == sort_value, id_column > last_learner_id)))
+
+    order_columns = [sort_column] if sort == 'learner_id' else [sort_column, LearnerCourseProgress.learner_id]
+    progress_query = progress_query.order_by(*[column.desc() if descending else column.asc() for column in order_columns])
+    rows = progress_query.limit(limit + 1).all() # Лишняя строка — признак следующей страницы
+
+    items = []
+    for progress, first_name, last_name, is_learner in rows[:limit]:
+        items.append({
+            "learner_id": progress.learner_id, "first_name": first_name, "last_name": last_name, "is_learner": is_learner,
+            "steps_attempted": progress.steps_attempted, "steps_solved": progress.steps_solved,
+            "score_sum": progress.score_sum, "attempts": progress.attempts,
+            "first_activity": progress.first_activity.isoformat() if progress.first_activity else None,
+            "last_activity": progress.last_activity.isoformat() if progress.last_activity else None,
+        })
+    next_cursor = None
+    if len(rows) > limit and items:
+        last_progress = rows[limit - 1][0]
+        next_cursor = encode_cursor(getattr(last_progress, sort), last_progress.learner_id)
+    return items, next_cursor
@@ -0,0 +1,165 @@
+import numpy as np
+
+# --- Рекомендации по метрикам шагов (правила) ---
+# Правило — набор условий над полями результата /steps/structure, все условия должны выполняться.
+# Условия проверяются векторно (numpy) по всем шагам курса сразу, поэтому оценка курса занимает
+# миллисекунды и выполняется при каждом пересчете метрик структуры.
+# Виды условий:
+#   ("lt", x) / ("gt", x) / ("ge", x)  — значение меньше / больше / не меньше порога x;
+#   ("z_lt", x) / ("z_gt", x)          — робастный z-score (медиана и MAD по шагам курса) меньше / больше x.
+# Шаги, где метрики нет (None), правилу не удовлетворяют.
+MIN_ATTEMPTED_USERS = 20 # Доли по меньшему числу пытавшихся не интерпретируются
+
+RULES = [
+    {
+        "id": "hard_task",
+        "kind": "problem",
+        "severity": 3,
+        "title": "Низкая успешность при большом числе попыток",
+        "advice": "Проверьте, нет ли неоднозначности в условии задачи или слишком строгих тестов.",
+        "conditions": [("success_rate", "lt", 0.5), ("avg_attempts_per_passed", "gt", 3.0)],
+    },
+    {
+        "id": "negative_discrimination",
+        "kind": "problem",
+        "severity": 3,
+        "title": "Отрицательная дискриминативность",
+        "advice": "Сильные учащиеся решают шаг хуже слабых: возможна ошибка в ответе или запутанная формулировка.",
+        "conditions": [("discrimination_index", "lt", 0.0)],
+    },
+    {
+        "id": "dropoff",
+        "kind": "problem",
+        "severity": 2,
+        "title": "Высокий отток после шага",
+        "advice": "Многие учащиеся после этого шага не пытаются решать дальше. Проверьте сложность и мотивацию перед шагом.",
+        "conditions": [("completion_index", "gt", 0.15)],
+    },
+    {
+        "id": "often_skipped",
+        "kind": "problem",
+        "severity": 2,
+        "title": "Шаг часто пропускают",
+        "advice": "Не решившие шаг продолжают курс дальше: шаг может восприниматься как необязательный или слишком сложный.",
+        "conditions": [("skip_rate", "gt", 0.5)],
+    },
+    {
+        "id": "low_discrimination",
+        "kind": "problem",
+        "severity": 1,
+        "title": "Низкая дискриминативность",
+        "advice": "Шаг одинаково решают сильные и слабые учащиеся: он может быть слишком простым.",
+        "conditions": [("discrimination_index", "ge", 0.0), ("discrimination_index", "lt", 0.1)],
+    },
+    {
+        "id": "comment_outlier",
+        "kind": "problem",
+        "severity": 1,
+        "title": "Необычно много обсуждений",
+        "advice": "Доля комментирующих сильно выше, чем у других шагов курса. Просмотрите вопросы учащихся.",
+        "conditions": [("comment_rate", "z_gt", 3.0)],
+    },
+    {
+        "id": "slow_solve",
+        "kind": "problem",
+        "severity": 1,
+        "title": "Долгое решение",
+        "advice": "Медианное время решения сильно выше, чем у других шагов курса. Возможно, нужна подсказка или разбиение шага.",
+        "conditions": [("solve_time_p50_seconds", "z_gt", 3.0)],
+    },
+    {
+        "id": "effective_task",
+        "kind": "strength",
+        "severity": 1,
+        "title": "Хорошо работающее задание",
+        "advice": "Высокая успешность и хорошая дискриминативность.",
+        "conditions": [("success_rate", "gt", 0.8), ("discrimination_index", "gt", 0.3)],
+    },
+]
+
+_OPERATOR_LABELS = {"lt": "<", "gt": ">", "ge": ">=", "z_lt": "z <", "z_gt": "z >"}
+_COMPARISONS = {"lt": np.less, "gt": np.greater, "ge": np.greater_equal}
+
+
+def metric_columns(results_list, fields):
+    """{поле: float-массив по шагам} (None -> NaN)."""
+    return {field: np.array([np.nan if step_data.get(field) is None else step_data[field] for step_data in results_list],
+                            dtype=np.float64) for field in fields}
+
+
+def robust_zscores(values):
+    """Робастный z-score: (x - медиана) / (1.4826 * MAD); NaN, если разброса нет."""
+    finite = values[~np.isnan(values)]
+    if len(finite) < 3:
+        return np.full(len(values), np.nan)
+    median = np.median(finite)
+    mad = 1.4826 * np.median(np.abs(finite - median))
+    if mad == 0:
+        return np.full(len(values), np.nan)
+    return (values - median) / mad
+
+
+def _condition_mask(values, zscores, operator, threshold):
+    """(маска, превышение порога) для одного условия; превышение — в единицах порога или z."""
+    checked = zscores if operator.startswith("z_") else values
+    with np.errstate(invalid='ignore'):
+        mask = _COMPARISONS[operator[2:] if operator.startswith("z_") else operator](checked, threshold)
+    scale = 1.0 if operator.startswith("z_") else max(abs(threshold), 1.0)
+    excess = np.abs(checked - threshold) / scale
+    return mask & ~np.isnan(checked), np.nan_to_num(excess)
+
+
+def evaluate_recommendations(results_list, rules=None, min_attempted_users=MIN_ATTEMPTED_USERS):
+    """
+    Проверяет правила по метрикам шагов ОДНОГО курса (результат calculate_course_structure).
+    Возвращает находки, отсортированные по убыванию score = severity * (1 + среднее превышение порогов):
+    [{step_id, rule_id, kind, severity, score, title, advice, explanation, metrics}].
+    """
+    rules = RULES if rules is None else rules
+    if not results_list:
+        return []
+    fields = {field for rule in rules for field, _, _ in rule["conditions"]} | {"all_users_attempted"}
+    columns = metric_columns(results_list, fields)
+    zscores = {field: robust_zscores(values) for field, values in columns.items()}
+    with np.errstate(invalid='ignore'):
+        enough_users = columns["all_users_attempted"] >= min_attempted_users
+
+    findings = []
+    for rule in rules:
+        mask = enough_users.copy()
+        excess_total = np.zeros(len(results_list))
+        for field, operator, threshold in rule["conditions"]:
+            condition_mask, excess = _condition_mask(columns[field], zscores[field], operator, threshold)
+            mask &= condition_mask
+            excess_total += excess
+        scores = rule["severity"] * (1 + excess_total / len(rule["conditions"]))
+        for index in np.flatnonzero(mask).tolist():
+            step_data = results_list[index]
+            explanation = ", ".join(
+                f"{field} = {step_data[field]:.3g} ({_OPERATOR_LABELS[operator]} {threshold:g}"
+                + (f", z = {zscores[field][index]:.1f})" if operator.startswith("z_") else ")")
+                for field, operator, threshold in rule["conditions"])
+            findings.append({
+                "step_id": step_data["step_id"],
+                "step_title_short": step_data.get("step_title_short"),
+                "module_id": step_data.get("module_id"),
+                "lesson_id": step_data.get("lesson_id"),
+                "rule_id": rule["id"],
+                "kind": rule["kind"],
+                "severity": rule["severity"],
+                "score": round(float(scores[index]), 4),
+                "title": rule["title"],
+                "advice": rule["advice"],
+                "explanation": explanation,
+                "metrics": {field: step_data[field] for field, _, _ in rule["conditions"]},
+            })
+    findings.sort(key=lambda finding: (-finding["score"], finding["step_id"]))
+    return findings
+
+
+def summarize_findings(findings):
+    """Число находок по правилам (для заголовка блока рекомендаций)."""
+    summary = {}
+    for finding in findings:
+        summary[finding["rule_id"]] = summary.get(finding["rule_id"], 0) + 1
+    return summary
@@ -0,0 +1,258 @@
+from collections import defaultdict
+
+import pandas as pd
+from sqlalchemy import insert
+
+from .models import db, Submission, Comment, Step, Lesson, Module, StepDailyRollup
+from .sketches import HyperLogLog, KLLSketch
+from .structure_metrics import (query_course_steps, build_step_data, set_solve_time_percentiles,
+                                SOLVE_TIME_CUTOFF_SECONDS, SOLVE_TIME_QUANTILES)
+from .instrumentation import span
+from .db_routing import stream_results_query, pin_primary
+
+# --- Дневные агрегаты по шагам (step_daily_rollup) ---
+# Метрики за период (from/to) считаются суммированием дневных строк, без сканирования сабмишенов.
+# Агрегаты шага пересчитываются целиком по его истории: время решения пары (user, step)
+# зависит от ПЕРВОЙ попытки, которая может быть в другом дне.
+ROLLUP_STEP_CHUNK = 50 # Шагов за один проход пересчета (ограничивает объем сабмишенов в памяти)
+CONFIDENCE_Z = 1.96    # Границы ошибки — полуширина ~95% интервала
+
+
+def course_step_ids(course_id):
+    return [row.step_id for row in db.session.query(Step.step_id).join(Step.lesson).join(Lesson.module)
+            .filter(Module.course_id == course_id).all()]
+
+
+def _submission_rollups(step_ids):
+    """{(step_id, day): поля агрегата} по сабмишенам шагов."""
+    rows = stream_results_query(db.session.query(Submission.step_id, Submission.user_id, Submission.status, Submission.submission_time
+                                                 ).filter(Submission.step_id.in_(step_ids), Submission.submission_time.isnot(None))).all()
+    rollups = {}
+    if not rows:
+        return rollups
+    df = pd.DataFrame(rows, columns=['step_id', 'user_id', 'status', 'submission_time'])
+    df['submission_time'] = pd.to_datetime(df['submission_time'])
+    df['day'] = df['submission_time'].dt.date
+    df['is_correct'] = df['status'] == 'correct'
+
+    for (step_id, day), group in df.groupby(['step_id', 'day'], sort=True):
+        users = group['user_id'].dropna()
+        passed_users = group.loc[group['is_correct'], 'user_id'].dropna()
+        rollups[(int(step_id), day)] = {
+            "submissions_count": len(group),
+            "correct_count": int(group['is_correct'].sum()),
+            "attempted_users_sketch": HyperLogLog.from_values(users).to_bytes() if len(users) else None,
+            "passed_users_sketch": HyperLogLog.from_values(passed_users).to_bytes() if len(passed_users) else None,
+        }
+
+    # Время решения: первая попытка -> последняя верная попытка пары (user, step)
+    pairs = df.dropna(subset=['user_id'])
+    first_attempt = pairs.groupby(['step_id', 'user_id'])['submission_time'].min()
+    last_correct = pairs[pairs['is_correct']].groupby(['step_id', 'user_id'])['submission_time'].max()
+    solve_times = pd.DataFrame({'first_attempt': first_attempt.loc[last_correct.index], 'last_correct': last_correct})
+    solve_times['seconds'] = (solve_times['last_correct'] - solve_times['first_attempt']).dt.total_seconds().astype('int64')
+    solve_times = solve_times.reset_index()
+    solve_times['day'] = solve_times['last_correct'].dt.date
+    for (step_id, day), group in solve_times.groupby(['step_id', 'day'], sort=True):
+        rollup = rollups[(int(step_id), day)] # В этот день была верная попытка — строка уже есть
+        filtered_seconds = group.loc[group['seconds'] <= SOLVE_TIME_CUTOFF_SECONDS, 'seconds']
+        rollup["solve_time_sum_seconds"] = int(filtered_seconds.sum())
+        rollup["solve_time_count"] = len(filtered_seconds)
+        # Sketch хранит все времена: другая отсечка применяется при запросе, без пересчета сабмишенов
+        rollup["solve_time_sketch"] = KLLSketch.from_values(group['seconds'].to_numpy()).to_bytes()
+    return rollups
+
+
+def _comment_rollups(step_ids):
+    """{(step_id, day): поля агрегата} по комментариям шагов."""
+    rows = db.session.query(Comment.step_id, Comment.user_id, Comment.time
+                            ).filter(Comment.step_id.in_(step_ids), Comment.time.isnot(None)).all()
+    rollups = {}
+    if not rows:
+        return rollups
+    df = pd.DataFrame(rows, columns=['step_id', 'user_id', 'time'])
+    df['day'] = pd.to_datetime(df['time']).dt.date
+    for (step_id, day), group in df.groupby(['step_id', 'day'], sort=True):
+        users = group['user_id'].dropna()
+        rollups[(int(step_id), day)] = {
+            "comments_count": len(group),
+            "commenting_users_sketch": HyperLogLog.from_values(users).to_bytes() if len(users) else None,
+        }
+    return rollups
+
+
+def refresh_step_rollups(step_ids):
+    """Пересчитывает дневные агрегаты шагов step_ids (удаляет старые строки и записывает новые)."""
+    step_ids = sorted({step_id for step_id in step_ids if step_id is not None})
+    pin_primary(db.session) # Пересчет читает основную БД: агрегаты по отстающей реплике были бы устаревшими
+    with span("rollups.refresh", log=True, steps=len(step_ids)) as refresh_span:
+        rows_written = 0
+        for chunk_start in range(0, len(step_ids), ROLLUP_STEP_CHUNK):
+            chunk = step_ids[chunk_start:chunk_start + ROLLUP_STEP_CHUNK]
+            rollups = defaultdict(lambda: {
+                "submissions_count": 0, "correct_count": 0,
+                "attempted_users_sketch": None, "passed_users_sketch": None,
+                "comments_count": 0, "commenting_users_sketch": None,
+                "solve_time_sum_seconds": 0, "solve_time_count": 0, "solve_time_sketch": None,
+            })
+            for source in (_submission_rollups(chunk), _comment_rollups(chunk)):
+                for key, values in source.items():
+                    rollups[key].update(values)
+
+            db.session.query(StepDailyRollup).filter(StepDailyRollup.step_id.in_(chunk)).delete(synchronize_session=False)
+            if rollups:
+                db.session.execute(insert(StepDailyRollup), [
+                    {"step_id": step_id, "day": day, **values} for (step_id, day), values in sorted(rollups.items())])
+            db.session.commit()
+            rows_written += len(rollups)
+        refresh_span["rows"] = rows_written
+    return rows_written
+
+
+def refresh_course_rollups(course_id):
+    return refresh_step_rollups(course_step_ids(course_id))
+
+
+def ensure_rollups(step_ids):
+    """Строит агрегаты, если для шагов их еще нет совсем (например, БД заполнена до появления таблицы)."""
+    has_rollups = db.session.query(StepDailyRollup.step_id).filter(StepDailyRollup.step_id.in_(step_ids)).first()
+    if has_rollups is None:
+        has_data = (db.session.query(Submission.submission_id).filter(Submission.step_id.in_(step_ids)).first() or
+                    db.session.query(Comment.comment_id).filter(Comment.step_id.in_(step_ids)).first())
+        if has_data is not None:
+            print(f"--- Дневные агрегаты для {len(step_ids)} шагов не найдены, построение... ---")
+            refresh_step_rollups(step_ids)
+
+
+def sum_step_rollups(step_ids, date_from=None, date_to=None):
+    """
+    Суммирует дневные агрегаты шагов за период [date_from, date_to] (границы включительно, None — без границы).
+    Возвращает {step_id: {...}} с суммами и объединенными HyperLogLog.
+    """
+    rollup_query = db.session.query(StepDailyRollup).filter(StepDailyRollup.step_id.in_(step_ids))
+    if date_from is not None:
+        rollup_query = rollup_query.filter(StepDailyRollup.day >= date_from)
+    if date_to is not None:
+        rollup_query = rollup_query.filter(StepDailyRollup.day <= date_to)
+
+    totals = {}
+    for rollup in rollup_query.all():
+        step_totals = totals.setdefault(rollup.step_id, {
+            "submissions_count": 0, "correct_count": 0, "comments_count": 0,
+            "solve_time_sum_seconds": 0, "solve_time_count": 0,
+            "attempted_users": HyperLogLog(), "passed_users": HyperLogLog(), "commenting_users": HyperLogLog(),
+            "solve_times": KLLSketch(),
+        })
+        for field in ("submissions_count", "correct_count", "comments_count", "solve_time_sum_seconds", "solve_time_count"):
+            step_totals[field] += getattr(rollup, field) or 0
+        for field, sketch_data in (("attempted_users", rollup.attempted_users_sketch),
+                                   ("passed_users", rollup.passed_users_sketch),
+                                   ("commenting_users", rollup.commenting_users_sketch)):
+            if sketch_data:
+                step_totals[field].merge(HyperLogLog.from_bytes(sketch_data))
+        if rollup.solve_time_sketch:
+            step_totals["solve_times"].merge(KLLSketch.from_bytes(rollup.solve_time_sketch))
+    return totals
+
+
+def hll_error_bounds(step_data, step_totals):
+    """
+    Полуширина ~95% интервала для метрик из HyperLogLog: у числа уникальных — z * relative_error * значение,
+    у отношения двух оценок (success_rate) относительные ошибки складываются квадратично.
+    """
+    def bound(value, relative_error):
+        return CONFIDENCE_Z * relative_error * value if value is not None else None
+    attempted_error = step_totals["attempted_users"].relative_error()
+    passed_error = step_totals["passed_users"].relative_error()
+    return {
+        "all_users_attempted": bound(step_data["all_users_attempted"], attempted_error),
+        "passed_users_sub": bound(step_data["passed_users_sub"], passed_error),
+        "success_rate": bound(step_data["success_rate"], (attempted_error ** 2 + passed_error ** 2) ** 0.5),
+        "avg_attempts_per_passed": bound(step_data["avg_attempts_per_passed"], passed_error),
+        "comment_rate": bound(step_data["comment_rate"], step_totals["commenting_users"].relative_error()),
+    }
+
+
+def calculate_course_structure_window(course_id, date_from=None, date_to=None, with_error_bounds=False, only_step_ids=None):
+    """
+    Метрики шагов ОДНОГО курса за период по дневным агрегатам (формат — как у calculate_course_structure).
+    Уникальные пользователи — оценка HyperLogLog (точная, пока их не больше 256 на шаг).
+    skip_rate, completion_index и discrimination_index требуют сабмишенов каждого пользователя
+    по всем шагам курса и за период не считаются (None).
+    with_error_bounds — добавляет каждому шагу "error_bounds" (см. hll_error_bounds).
+    only_step_ids — только эти шаги курса (агрегаты остальных не читаются).
+    """
+    with span("structure.window", log=True, course_id=course_id) as window_span:
+        all_steps = query_course_steps(course_id)
+        if only_step_ids is not None:
+            requested_step_ids = set(only_step_ids)
+            all_steps = [step for step in all_steps if step.step_id in requested_step_ids]
+        if not all_steps:
+            return []
+        step_ids = [step.step_id for step in all_steps]
+        ensure_rollups(step_ids)
+        totals = sum_step_rollups(step_ids, date_from, date_to)
+
+        results_list = []
+        for step in all_steps:
+            step_data = build_step_data(step)
+            step_totals = totals.get(step.step_id)
+            if step_totals and step_totals["submissions_count"] > 0:
+                total_subs = step_totals["submissions_count"]
+                attempted_users = step_totals["attempted_users"].cardinality()
+                passed_users = step_totals["passed_users"].cardinality()
+                unique_views_val = step_data["unique_views"]
+                step_data["passed_users_sub"] = passed_users
+                step_data["all_users_attempted"] = attempted_users
+                step_data["difficulty_index"] = float(step_totals["correct_count"]) / total_subs
+                if unique_views_val is not None and unique_views_val > 0 and attempted_users > 0:
+                    step_data["success_rate"] = float(passed_users) / attempted_users
+                else:
+                    step_data["success_rate"] = 0.0
+                step_data["avg_attempts_per_passed"] = (float(total_subs) / passed_users) if passed_users > 0 else None
+                if step_totals["solve_time_count"] > 0:
+                    step_data["avg_completion_time_filtered_seconds"] = round(
+                        step_totals["solve_time_sum_seconds"] / step_totals["solve_time_count"])
+                if step_totals["solve_times"].count:
+                    set_solve_time_percentiles(step_data, step_totals["solve_times"].quantiles(
+                        SOLVE_TIME_QUANTILES, cutoff=SOLVE_TIME_CUTOFF_SECONDS))
+
+            step_data["comment_rate"] = 0.0
+            if step_totals and step_totals["comments_count"] > 0:
+                step_data["comment_count"] = step_totals["comments_count"]
+                unique_views_val = step_data["unique_views"]
+                if unique_views_val is not None and unique_views_val > 0:
+                    step_data["comment_rate"] = float(step_totals["commenting_users"].cardinality()) / unique_views_val
+            if with_error_bounds:
+                step_data["error_bounds"] = hll_error_bounds(step_data, step_totals) if step_totals else {}
+            results_list.append(step_data)
+        window_span["rows"] = len(results_list)
+    return results_list
+
+
+def calculate_course_solve_times(course_id, cutoff=SOLVE_TIME_CUTOFF_SECONDS, quantiles=SOLVE_TIME_QUANTILES,
+                                 date_from=None, date_to=None):
+    """
+    Время решения по шагам курса из KLL sketch дневных агрегатов: число решений, среднее и квантили
+    среди решений не дольше cutoff (None — без отсечки). Период — по дню последней верной попытки.
+    """
+    with span("solve_times.course", log=True, course_id=course_id) as solve_span:
+        step_ids = [step.step_id for step in query_course_steps(course_id)]
+        if not step_ids:
+            return []
+        ensure_rollups(step_ids)
+        totals = sum_step_rollups(step_ids, date_from, date_to)
+        results_list = []
+        for step_id in step_ids:
+            sketch = totals[step_id]["solve_times"] if step_id in totals else KLLSketch()
+            mean_seconds = sketch.mean_below(cutoff) if sketch.count else None
+            results_list.append({
+                "step_id": step_id,
+                "solved_count": sketch.count,
+                "solved_within_cutoff": sketch.count_below(cutoff) if sketch.count else 0,
+                "mean_seconds": round(mean_seconds) if mean_seconds is not None else None,
+                "quantiles": {f"p{round(fraction * 100)}": (round(value) if value is not None else None)
+                              for fraction, value in zip(quantiles, sketch.quantiles(quantiles, cutoff=cutoff))},
+            })
+        solve_span["rows"] = len(results_list)
+    return results_list
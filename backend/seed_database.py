@@ -10,6 +10,11 @@ import os
 # Предполагается, что database.py и models.py находятся в той же папке backend
 from backend.database import app, create_database_if_not_exists 
 from backend.models import db, Course, Module, Lesson, Step, Learner, Submission, Comment, AdditionalStepInfo, enrollment_table
+from backend.rollups import refresh_step_rollups
+from backend.progress import refresh_progress_for_steps
+from backend.comment_search import index_comments
+from backend.comment_activity import refresh_comment_activity
+from backend.warmup import mark_courses_changed, mark_course_ids_changed
 from sqlalchemy.exc import IntegrityError
 import argparse
 
@@ -63,6 +68,53 @@ def parse_datetime(date_str):
                 return None
 
 
+def update_aggregates_after_import(step_ids, submissions_changed=True, comments_changed=True):
+    """
+    Обновляет таблицы-агрегаты для шагов, затронутых импортом сабмишенов/комментариев.
+    submissions_changed=False (импорт комментариев) — прогресс учащихся не пересчитывается,
+    comments_changed=False (импорт сабмишенов) — агрегаты обсуждений не пересчитываются.
+    """
+    if not step_ids:
+        return
+    print(f"----------Обновление дневных агрегатов для {len(step_ids)} шагов...")
+    try:
+        refresh_step_rollups(step_ids)
+        if submissions_changed:
+            print("----------Обновление прогресса учащихся затронутых курсов...")
+            refresh_progress_for_steps(step_ids)
+        if comments_changed:
+            print("----------Обновление агрегатов обсуждений...")
+            refresh_comment_activity(step_ids)
+    except Exception as e:
+        print(f"!!! ОШИБКА при обновлении агрегатов: {e}")
+        db.session.rollback()
+    mark_structure_changed(step_ids)
+
+
+def mark_structure_changed(step_ids):
+    """Отмечает курсы затронутых шагов: сервер пересчитает их кеш структуры в фоне (warmup.py)."""
+    if not step_ids:
+        return
+    try:
+        course_ids = mark_courses_changed(step_ids)
+        print(f"----------Кеш структуры курсов {course_ids} отмечен как устаревший.")
+    except Exception as e:
+        print(f"!!! ОШИБКА при отметке курсов для прогрева кеша: {e}")
+        db.session.rollback()
+
+
+def update_comment_index_after_import(comment_ids):
+    """Обновляет поисковый индекс (comment_term) для импортированных комментариев."""
+    if not comment_ids:
+        return
+    print(f"----------Обновление поискового индекса для {len(comment_ids)} комментариев...")
+    try:
+        index_comments(comment_ids)
+    except Exception as e:
+        print(f"!!! ОШИБКА при обновлении поискового индекса комментариев: {e}")
+        db.session.rollback()
+
+
 def import_learners(course_data_path, limit=500000):
     print(f"----------Начало импорта learners (лимит: {limit})...")
     learners_csv_path = os.path.join(course_data_path, 'learners.csv')
@@ -202,6 +254,7 @@ def import_structure(course_data_path, limit=10000000):
         print(f"  Всего строк: {last_idx + 1}")
         print("-" * 30)
 
+    mark_structure_changed(processed_steps)
     # ---> ВОЗВРАЩАЕМ НАЙДЕННЫЙ ID КУРСА <---
     return first_course_id_found
 
@@ -234,13 +287,18 @@ def enroll_learners_to_course(target_course_id, learner_ids_to_enroll):
         for learner in learners_in_db: # Итерируем по найденным в БД
             if learner.user_id not in existing_enrollments:
                 try:
-                    enrollment_insert = enrollment_table.insert().values(learner_id=learner.user_id, course_id=course.course_id)
+                    # Времени зачисления в выгрузке нет (date_joined — регистрация на платформе, а не на курсе):
+                    # NULL вместо времени импорта, когорты берут первый сабмишен в курсе (см. cohorts.py)
+                    enrollment_insert = enrollment_table.insert().values(
+                        learner_id=learner.user_id, course_id=course.course_id, enrollment_date=None)
                     db.session.execute(enrollment_insert); enrolled_count += 1
                 except IntegrityError: db.session.rollback(); already_enrolled_count += 1
                 except Exception as e: db.session.rollback(); print(f"!!! Ошибка зачисления user {learner.user_id}: {e}"); error_count += 1
             else: already_enrolled_count += 1
 
         print("----------Коммит зачислений..."); db.session.commit()
+        if enrolled_count: # Когорты и воронка курса считаются по зачислениям
+            mark_course_ids_changed([course.course_id])
 
     except Exception as e: print(f"!!! КРИТИЧЕСКАЯ ОШИБКА при зачислении: {e}"); db.session.rollback()
     finally: # Итоговый отчет
@@ -264,6 +322,8 @@ def import_comments(course_data_path, limit=300000):
         skipped_count = 0
         teachers_added = 0
         last_idx = 0
+        imported_step_ids = set() # Шаги, для которых нужно обновить агрегаты
+        imported_comment_ids = [] # Комментарии, для которых нужно обновить поисковый индекс
         
         print("----------Предзагрузка существующих ID пользователей и шагов...")
         existing_user_ids = {u.user_id for u in db.session.query(Learner.user_id).all()}
@@ -331,6 +391,8 @@ def import_comments(course_data_path, limit=300000):
                     text_clear=text_val)
                 db.session.merge(new_comment) 
                 imported_count += 1
+                imported_step_ids.add(step_id)
+                imported_comment_ids.append(comment_id)
 
             except Exception as e:
                 db.session.rollback() 
@@ -351,6 +413,9 @@ def import_comments(course_data_path, limit=300000):
         except Exception as e:
              print(f"!!! КРИТИЧЕСКАЯ ОШИБКА при финальном коммите комментариев: {e}")
              db.session.rollback()
+             return
+        update_aggregates_after_import(imported_step_ids, submissions_changed=False)
+        update_comment_index_after_import(imported_comment_ids)
 
 
 def import_submissions(course_data_path, limit=30000000):
@@ -360,6 +425,7 @@ def import_submissions(course_data_path, limit=30000000):
     imported_count = 0
     skipped_count = 0
     last_idx = 0
+    imported_step_ids = set() # Шаги, для которых нужно обновить агрегаты
 
     print("----------Предзагрузка существующих ID пользователей и шагов...")
     existing_user_ids = {u.user_id for u in db.session.query(Learner.user_id).all()}
@@ -409,6 +475,7 @@ def import_submissions(course_data_path, limit=30000000):
                 # Добавление/обновление
                 db.session.merge(new_entry)
                 imported_count += 1
+                imported_step_ids.add(step_id)
 
             except Exception as e:
                 db.session.rollback() # Откат для этой строки
@@ -429,6 +496,8 @@ def import_submissions(course_data_path, limit=30000000):
     except Exception as e:
          print(f"!!! КРИТИЧЕСКАЯ ОШИБКА при финальном коммите submissions: {e}")
          db.session.rollback()
+         return
+    update_aggregates_after_import(imported_step_ids, comments_changed=False)
 
 
 def import_additional_info(course_data_path, excel_filename='AdditionalInfo.xlsx'):
@@ -466,6 +535,7 @@ def import_additional_info(course_data_path, excel_filename='AdditionalInfo.xlsx
         count = 0
         skipped_steps_no_match = 0
         skipped_rows_error = 0
+        imported_step_ids = set()
 
         print("--- Обработка строк из Excel...")
         # Итерируем по строкам DataFrame
@@ -517,6 +587,7 @@ def import_additional_info(course_data_path, excel_filename='AdditionalInfo.xlsx
                     # passed_correctly больше не нужен
                 )
                 db.session.merge(new_entry)
+                imported_step_ids.add(step_id)
                 count += 1
 
             except (IndexError, ValueError, TypeError) as data_err:
@@ -535,6 +606,7 @@ def import_additional_info(course_data_path, excel_filename='AdditionalInfo.xlsx
         except Exception as e:
              print(f"!!! КРИТИЧЕСКАЯ ОШИБКА при финальном коммите доп. инфо: {e}")
              db.session.rollback()
+        mark_structure_changed(imported_step_ids)
 
         # Итоговый отчет (без изменений)
         print(f"---------- Импортировано/обновлено доп. инфо: {count} записей.")
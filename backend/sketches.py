@@ -0,0 +1,254 @@
+import struct
+import zlib
+
+import numpy as np
+
+# --- Вероятностные структуры (sketches) для агрегатов ---
+# Сериализуются в bytes, чтобы храниться в BLOB-колонках таблиц-агрегатов
+# и объединяться (merge) без обращения к исходным строкам.
+
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+
+def hash64(values):
+    """Стабильный 64-битный хеш целых чисел (финализатор splitmix64), векторно."""
+    x = np.asarray(values, dtype=np.int64).astype(np.uint64)
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _bit_length(values):
+    """Число значащих бит для uint64 (0 для 0), векторно и без потери точности float."""
+    hi = (values >> np.uint64(32)).astype(np.float64)
+    lo = (values & _MASK32).astype(np.float64)
+    with np.errstate(divide='ignore'):
+        hi_bits = np.where(hi > 0, np.floor(np.log2(np.maximum(hi, 1))) + 33, 0)
+        lo_bits = np.where(lo > 0, np.floor(np.log2(np.maximum(lo, 1))) + 1, 0)
+    return np.where(hi > 0, hi_bits, lo_bits).astype(np.int64)
+
+
+class HyperLogLog:
+    """
+    HyperLogLog для числа уникальных пользователей.
+    Пока значений мало (<= explicit_limit), хранит сами хеши — оценка точная;
+    затем переходит к 2**precision регистрам (относительная ошибка ~1.04/sqrt(2**precision)).
+    """
+    _EXPLICIT, _DENSE = 0, 1
+
+    def __init__(self, precision=12, explicit_limit=256):
+        self.precision = precision
+        self.explicit_limit = explicit_limit
+        self.hashes = np.empty(0, dtype=np.uint64) # Отсортированные уникальные хеши (явный режим)
+        self.registers = None                       # uint8[2**precision] (плотный режим)
+
+    @property
+    def register_count(self):
+        return 1 << self.precision
+
+    @property
+    def is_exact(self):
+        return self.registers is None
+
+    def _to_dense(self):
+        self.registers = np.zeros(self.register_count, dtype=np.uint8)
+        self._add_hashes_dense(self.hashes)
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def _add_hashes_dense(self, hashes):
+        if not len(hashes):
+            return
+        value_bits = 64 - self.precision
+        index = (hashes >> np.uint64(value_bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << value_bits) - 1)
+        rank = (value_bits - _bit_length(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def add_many(self, values):
+        """Добавляет целые значения (например, user_id)."""
+        hashes = hash64(values)
+        if self.registers is None:
+            self.hashes = np.union1d(self.hashes, hashes)
+            if len(self.hashes) > self.explicit_limit:
+                self._to_dense()
+        else:
+            self._add_hashes_dense(hashes)
+        return self
+
+    def merge(self, other):
+        """Объединение множеств (на месте). Точность обоих sketch должна совпадать."""
+        if other.precision != self.precision:
+            raise ValueError("HyperLogLog: нельзя объединить sketch с разной точностью")
+        if other.registers is None:
+            if self.registers is None:
+                self.hashes = np.union1d(self.hashes, other.hashes)
+                if len(self.hashes) > self.explicit_limit:
+                    self._to_dense()
+            else:
+                self._add_hashes_dense(other.hashes)
+        else:
+            if self.registers is None:
+                self._to_dense()
+            np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def cardinality(self):
+        """Оценка числа уникальных значений."""
+        if self.registers is None:
+            return len(self.hashes)
+        m = self.register_count
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zero_registers = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zero_registers > 0:
+            estimate = m * np.log(m / zero_registers) # Поправка для малых кардинальностей (linear counting)
+        return int(round(estimate))
+
+    def relative_error(self):
+        """Стандартная относительная ошибка оценки (0 в явном режиме)."""
+        return 0.0 if self.registers is None else 1.04 / np.sqrt(self.register_count)
+
+    def to_bytes(self):
+        if self.registers is None:
+            return struct.pack('<BB', self._EXPLICIT, self.precision) + self.hashes.astype('<u8').tobytes()
+        return struct.pack('<BB', self._DENSE, self.precision) + zlib.compress(self.registers.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data, explicit_limit=256):
+        mode, precision = struct.unpack_from('<BB', data)
+        sketch = cls(precision=precision, explicit_limit=explicit_limit)
+        if mode == cls._EXPLICIT:
+            sketch.hashes = np.frombuffer(data[2:], dtype='<u8').astype(np.uint64)
+        else:
+            sketch.registers = np.frombuffer(zlib.decompress(data[2:]), dtype=np.uint8).copy()
+        return sketch
+
+    @classmethod
+    def from_values(cls, values, **kwargs):
+        return cls(**kwargs).add_many(values)
+
+
+def merged_cardinality(serialized_sketches):
+    """Число уникальных значений в объединении сериализованных HyperLogLog (None — пропускаются)."""
+    merged = None
+    for data in serialized_sketches:
+        if not data:
+            continue
+        sketch = HyperLogLog.from_bytes(data)
+        merged = sketch if merged is None else merged.merge(sketch)
+    return merged.cardinality() if merged is not None else 0
+
+
+class KLLSketch:
+    """
+    Квантильный sketch KLL (Karnin–Lang–Liberty): уровни-компакторы, элемент уровня h имеет вес 2**h.
+    Пока значений не больше k, хранит их все — квантили точные; далее ошибка ранга ~1.7/k.
+    Объединяется (merge) без исходных данных, поэтому подходит для агрегатов по дням/когортам.
+    """
+
+    def __init__(self, k=200):
+        self.k = k
+        self.levels = [np.empty(0, dtype=np.float64)]
+        self.count = 0
+        self._offsets = [] # Чередование четных/нечетных элементов при сжатии (детерминированно)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(8, int(np.ceil(self.k * (2.0 / 3.0) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) <= self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0, dtype=np.float64))
+            while len(self._offsets) <= level:
+                self._offsets.append(0)
+            items = np.sort(items)
+            leftover = items[-1:] if len(items) % 2 else items[:0]
+            compacted = items[:len(items) - len(leftover)]
+            offset = self._offsets[level]
+            self._offsets[level] = 1 - offset
+            self.levels[level + 1] = np.concatenate((self.levels[level + 1], compacted[offset::2]))
+            self.levels[level] = leftover
+            level = 0 # Емкость нижних уровней зависит от числа уровней — проверяем заново
+
+    def add_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.levels[0] = np.concatenate((self.levels[0], values))
+            self.count += len(values)
+            self._compress()
+        return self
+
+    def merge(self, other):
+        """Объединение (на месте)."""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float64))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate((self.levels[level], items))
+        self.count += other.count
+        self._compress()
+        return self
+
+    def _weighted_items(self, cutoff=None):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level_items), 1 << level, dtype=np.int64)
+                                  for level, level_items in enumerate(self.levels)])
+        if cutoff is not None:
+            keep = items <= cutoff
+            items, weights = items[keep], weights[keep]
+        order = np.argsort(items, kind='stable')
+        return items[order], weights[order]
+
+    def quantiles(self, fractions, cutoff=None):
+        """Квантили (метод ближайшего ранга) среди значений <= cutoff; None, если таких значений нет."""
+        items, weights = self._weighted_items(cutoff)
+        if not len(items):
+            return [None for _ in fractions]
+        cumulative = np.cumsum(weights)
+        total = cumulative[-1]
+        result = []
+        for fraction in fractions:
+            rank = max(1, int(np.ceil(fraction * total)))
+            result.append(float(items[min(np.searchsorted(cumulative, rank), len(items) - 1)]))
+        return result
+
+    def count_below(self, cutoff=None):
+        """Оценка числа значений <= cutoff."""
+        _, weights = self._weighted_items(cutoff)
+        return int(weights.sum())
+
+    def mean_below(self, cutoff=None):
+        """Оценка среднего значений <= cutoff (точное, пока sketch не сжимался)."""
+        items, weights = self._weighted_items(cutoff)
+        if not len(items):
+            return None
+        return float(np.dot(items, weights) / weights.sum())
+
+    def to_bytes(self):
+        header = struct.pack('<HHQ', self.k, len(self.levels), self.count)
+        sizes = struct.pack(f'<{len(self.levels)}I', *[len(level_items) for level_items in self.levels])
+        return header + sizes + np.concatenate(self.levels).astype('<f8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        k, level_count, count = struct.unpack_from('<HHQ', data)
+        offset = struct.calcsize('<HHQ')
+        sizes = struct.unpack_from(f'<{level_count}I', data, offset)
+        offset += 4 * level_count
+        items = np.frombuffer(data[offset:], dtype='<f8').astype(np.float64)
+        sketch = cls(k=k)
+        sketch.levels = np.split(items, np.cumsum(sizes)[:-1]) if level_count else [np.empty(0, dtype=np.float64)]
+        sketch.count = count
+        return sketch
+
+    @classmethod
+    def from_values(cls, values, **kwargs):
+        return cls(**kwargs).add_many(values)
@@ -0,0 +1,78 @@
+from collections import defaultdict
+
+import numpy as np
+
+from .models import db, Submission, Step, Lesson, Module
+from .structure_metrics import solve_times_per_step
+from .instrumentation import span
+
+# --- Сравнение нескольких шагов (/steps/compare) ---
+# Метрики шагов берутся из кеша структуры курса (или из дневных агрегатов, если кеша нет),
+# а тяжелые для полного списка распределения — попытки на пользователя и гистограмма времени
+# решения — считаются только по сабмишенам запрошенных шагов.
+MAX_COMPARE_STEPS = 20
+ATTEMPT_BUCKETS = 10 # Попытки 1..9 по отдельности, последняя корзина — "10 и больше"
+SOLVE_TIME_BIN_EDGES = (0, 30, 60, 120, 300, 600, 1800, 3600, 10800) # секунды; последняя корзина — "больше 3 часов"
+
+
+def step_course_ids(step_ids):
+    """{step_id: course_id} для существующих шагов."""
+    rows = db.session.query(Step.step_id, Module.course_id).join(Step.lesson).join(Lesson.module)\
+        .filter(Step.step_id.in_(step_ids)).all()
+    return {row.step_id: row.course_id for row in rows}
+
+
+def _attempt_distribution(attempt_counts):
+    """Число пользователей по количеству попыток (1, 2, ..., ATTEMPT_BUCKETS+); 0 попыток не бывает."""
+    counts = np.bincount(np.minimum(attempt_counts, ATTEMPT_BUCKETS), minlength=ATTEMPT_BUCKETS + 1)[1:]
+    labels = [str(attempts) for attempts in range(1, ATTEMPT_BUCKETS)] + [f"{ATTEMPT_BUCKETS}+"]
+    return [{"attempts": label, "users": int(count)} for label, count in zip(labels, counts.tolist())]
+
+
+def _solve_time_histogram(solve_seconds):
+    """Число решений по интервалам времени SOLVE_TIME_BIN_EDGES (последний интервал открыт справа)."""
+    edges = np.array(SOLVE_TIME_BIN_EDGES + (np.inf,), dtype=np.float64)
+    counts, _ = np.histogram(solve_seconds, bins=edges)
+    return [{"from_seconds": int(low), "to_seconds": (None if np.isinf(high) else int(high)), "solved": int(count)}
+            for low, high, count in zip(edges[:-1].tolist(), edges[1:].tolist(), counts.tolist())]
+
+
+def step_distributions(step_ids):
+    """
+    {step_id: {"attempt_distribution": [...], "first_correct_attempt_distribution": [...], "solve_time_histogram": [...]}}
+    по сабмишенам только этих шагов.
+    """
+    with span("compare.distributions", log=True, steps=len(step_ids)) as distribution_span:
+        submissions = db.session.query(Submission.user_id, Submission.step_id, Submission.status, Submission.submission_time)\
+            .filter(Submission.step_id.in_(step_ids), Submission.user_id.isnot(None)).all()
+        distribution_span["rows"] = len(submissions)
+
+        attempts = defaultdict(list)
+        for sub in submissions:
+            attempts[sub.step_id].append((sub.user_id, sub.submission_time, sub.status == 'correct'))
+        solve_times = solve_times_per_step(submissions)
+
+        distributions = {}
+        for step_id in step_ids:
+            step_attempts = attempts.get(step_id, [])
+            attempt_counts = np.empty(0, dtype=np.int64)
+            attempts_to_correct = np.empty(0, dtype=np.int64)
+            if step_attempts:
+                user_ids = np.array([user_id for user_id, _, _ in step_attempts], dtype=np.int64)
+                _, attempt_counts = np.unique(user_ids, return_counts=True)
+                # Номер первой верной попытки пользователя (в порядке времени сабмишенов)
+                ordered = sorted(step_attempts, key=lambda item: (item[0], item[1] is None, item[1]))
+                first_correct = {}
+                attempt_number = defaultdict(int)
+                for user_id, _, is_correct in ordered:
+                    attempt_number[user_id] += 1
+                    if is_correct and user_id not in first_correct:
+                        first_correct[user_id] = attempt_number[user_id]
+                attempts_to_correct = np.array(list(first_correct.values()), dtype=np.int64)
+            distributions[step_id] = {
+                "attempt_distribution": _attempt_distribution(attempt_counts),
+                "first_correct_attempt_distribution": _attempt_distribution(attempts_to_correct),
+                "solve_time_histogram": _solve_time_histogram(solve_times.get(step_id, np.empty(0))),
+            }
+    return distributions
+
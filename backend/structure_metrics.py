@@ -0,0 +1,716 @@
+import math
+import time
+import json
+import hashlib
+import threading
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+
+import numpy as np
+from flask import current_app, has_app_context
+from sqlalchemy import func, distinct
+from sqlalchemy.orm import joinedload
+
+from .models import db, Submission, Step, Comment, Lesson, Module, Course
+from .parallel import run_parallel, get_metrics_workers
+from .pairsets import PairSet, pack_pairs, lookup_per_user
+from .sketches import KLLSketch
+from .instrumentation import span
+from .db_routing import stream_results_query
+
+SOLVE_TIME_CUTOFF_SECONDS = 10800 # Решения дольше 3 часов (открытая вкладка) не учитываются
+SOLVE_TIME_QUANTILES = (0.5, 0.75, 0.9)
+DISCRIMINATION_GROUP_SHARE = 0.27 # Доля учащихся урока в верхней и нижней группах
+CORRECT_STATUS = 'correct'
+# Ранжирование по урокам (около 0.5 сек на 1 млн сабмишенов в одном процессе) отправляется в пул только
+# для курсов крупнее: меньше не окупаются запуск spawn-воркеров и сериализация сабмишенов
+LESSON_PARALLEL_MIN_SUBMISSIONS = 5_000_000
+
+# Настраиваемые параметры метрик структуры. Значения по умолчанию переопределяются
+# app.config['METRIC_PARAMS'] и параметрами запроса; кеш структуры хранится отдельно для каждого набора.
+DEFAULT_METRIC_PARAMS = {
+    "solve_time_cutoff_seconds": SOLVE_TIME_CUTOFF_SECONDS,
+    "discrimination_group_share": DISCRIMINATION_GROUP_SHARE,
+    "correct_status": CORRECT_STATUS,
+}
+
+
+def metric_params(overrides=None):
+    """
+    Параметры метрик: DEFAULT_METRIC_PARAMS, поверх — app.config['METRIC_PARAMS'] и overrides.
+    ValueError для неизвестных параметров и недопустимых значений.
+    """
+    params = dict(DEFAULT_METRIC_PARAMS)
+    if has_app_context():
+        params.update(current_app.config.get('METRIC_PARAMS') or {})
+    params.update(overrides or {})
+    unknown = [name for name in params if name not in DEFAULT_METRIC_PARAMS]
+    if unknown:
+        raise ValueError(f"Неизвестные параметры метрик: {', '.join(unknown)}")
+    try:
+        params["solve_time_cutoff_seconds"] = int(params["solve_time_cutoff_seconds"])
+        params["discrimination_group_share"] = float(params["discrimination_group_share"])
+    except (TypeError, ValueError):
+        raise ValueError("solve_time_cutoff_seconds должен быть целым числом, discrimination_group_share — числом")
+    if params["solve_time_cutoff_seconds"] <= 0:
+        raise ValueError("solve_time_cutoff_seconds должен быть больше 0")
+    if not 0 < params["discrimination_group_share"] <= 0.5:
+        raise ValueError("discrimination_group_share должен быть в диапазоне (0, 0.5]")
+    if not isinstance(params["correct_status"], str) or not params["correct_status"]:
+        raise ValueError("correct_status должен быть непустой строкой")
+    return params
+
+
+def metric_params_key(params):
+    """Суффикс ключей кеша для набора параметров: '' для значений по умолчанию, иначе короткий хеш."""
+    if params == DEFAULT_METRIC_PARAMS:
+        return ""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def solve_times_per_step(submissions, correct_status=CORRECT_STATUS):
+    """
+    {step_id: массив секунд решения} по сабмишенам (user_id, step_id, status, ..., submission_time):
+    для каждой пары (user, step) с верной попыткой — от первой попытки до последней верной.
+    """
+    rows = [(sub.user_id, sub.step_id, sub.submission_time, sub.status == correct_status) for sub in submissions
+            if sub.user_id is not None and sub.step_id is not None and sub.submission_time is not None]
+    if not rows:
+        return {}
+    user_ids, step_ids, times, is_correct = zip(*rows)
+    seconds = np.array(times, dtype='datetime64[s]').astype(np.int64) # Без часовых поясов, как TIMESTAMPDIFF
+    is_correct = np.array(is_correct, dtype=bool)
+    pair_keys, pair_index = np.unique(pack_pairs(user_ids, step_ids), return_inverse=True)
+
+    first_attempt = np.full(len(pair_keys), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first_attempt, pair_index, seconds)
+    last_correct = np.full(len(pair_keys), np.iinfo(np.int64).min, dtype=np.int64)
+    np.maximum.at(last_correct, pair_index[is_correct], seconds[is_correct])
+
+    solved = last_correct != np.iinfo(np.int64).min
+    solve_seconds = (last_correct - first_attempt)[solved]
+    solved_steps = PairSet(pair_keys[solved]).step_ids # Ключи отсортированы по шагу — шаги идут подряд
+    steps, starts = np.unique(solved_steps, return_index=True)
+    return dict(zip(steps.tolist(), np.split(solve_seconds, starts[1:])))
+
+
+def set_solve_time_percentiles(step_data, percentiles):
+    """Записывает медиану/p75/p90 (список в порядке SOLVE_TIME_QUANTILES) в словарь шага."""
+    if not percentiles:
+        return
+    for field, value in zip(("solve_time_p50_seconds", "solve_time_p75_seconds", "solve_time_p90_seconds"), percentiles):
+        step_data[field] = round(value) if value is not None else None
+
+
+def query_course_steps(course_id):
+    """Шаги курса (с уроком, модулем, курсом и AdditionalStepInfo) в порядке прохождения курса."""
+    all_steps_query = db.session.query(Step).options(
+        joinedload(Step.lesson).joinedload(Lesson.module).joinedload(Module.course),
+        joinedload(Step.additional_info)
+    ).join(Step.lesson).join(Lesson.module).join(Module.course)
+
+    all_steps_query = all_steps_query.filter(Module.course_id == course_id)
+
+    all_steps_query = all_steps_query.order_by(
+        Course.course_id, Module.module_position, Lesson.lesson_position, Step.step_position
+    )
+    return all_steps_query.all()
+
+
+def build_step_data(step):
+    """Словарь шага: данные структуры и AdditionalStepInfo, метрики пока не заполнены."""
+    # --- Базовые данные шага ---
+    step_data = {
+        "step_id": step.step_id, "step_position": step.step_position, "step_type": step.step_type, "step_cost": step.step_cost,
+        "lesson_id": step.lesson.lesson_id if step.lesson else None,
+        "lesson_position": step.lesson.lesson_position if step.lesson else None,
+        "module_id": step.lesson.module.module_id if step.lesson and step.lesson.module else None,
+        "module_position": step.lesson.module.module_position if step.lesson and step.lesson.module else None,
+        "module_title": getattr(step.lesson.module, 'title', None) if step.lesson and step.lesson.module else None,
+        "course_id": step.lesson.module.course.course_id if step.lesson and step.lesson.module and step.lesson.module.course else None,
+        "course_title": step.lesson.module.course.title if step.lesson and step.lesson.module and step.lesson.module.course else None,
+        "step_title_short": None,
+        "step_title_full": None,
+        "views": None,
+        "unique_views": None,
+        "passed_users_sub": None,
+        "all_users_attempted": None,
+        # ---> Новые/Обновленные Метрики <---
+        "difficulty_index": None,           # (сложность = R/T сабмитов)
+        "success_rate": None,               # (успешность = R/T уников)
+        "skip_rate_numerator_r": None,
+        "skip_rate_denominator_t": None,
+        "discrimination_index": None,       # дискриминативность
+        "skip_rate": None,                  # коэффициент пропуска
+        "completion_index": None,           # (завершение/отвал)
+        "completion_numerator_r": None,
+        "completion_denominator_t": None,
+        "avg_attempts_per_passed": None,    # (среднее число попыток)
+        "comment_count": 0,                 # Общее число комментов
+        "comment_rate": None,               # (коэф. комментариев)
+        "usefulness_index": None,           # (полезность = views/unique_views)
+        "avg_completion_time_filtered_seconds": None,
+        "solve_time_p50_seconds": None,     # перцентили времени решения (с той же отсечкой)
+        "solve_time_p75_seconds": None,
+        "solve_time_p90_seconds": None
+        # Метрики, которые здесь НЕ считаем из-за сложности:
+        # skip_rate, completion_index, avg_completion_time_seconds
+    }
+
+    # --- Заполнение данных из AdditionalStepInfo ---
+    add_info = step.additional_info
+    if add_info:
+        step_data["step_title_short"] = add_info.step_title_short
+        step_data["step_title_full"] = add_info.step_title_full
+        step_data["views"] = add_info.views
+        step_data["unique_views"] = add_info.unique_views
+        #step_data["passed"] = add_info.passed # Используем 'passed' из Excel/БД
+
+    # Метрика 8: Полезность (используем данные из add_info, уже загруженные)
+    views = step_data["views"]
+    unique_views_val = step_data["unique_views"]
+    if views is not None and unique_views_val is not None and unique_views_val > 0:
+        step_data["usefulness_index"] = float(views) / unique_views_val
+    else:
+         step_data["usefulness_index"] = None # Или 0.0, если просмотров нет
+    return step_data
+
+
+# --- Реестр промежуточных наборов данных и метрик структуры курса ---
+# Расчет разбит на наборы данных (бывшие фазы [1/9]-[8/9]); каждая метрика объявляет наборы, которые
+# ей нужны, и поля шага, которые она заполняет. Для ?metrics= считаются только нужные наборы
+# (каждый — один раз, общий для всех запрошенных метрик), вычисленные наборы кешируются по курсам
+# в intermediate_cache. Наборы, помеченные "cache": False (сырые сабмишены), не кешируются:
+# из них строятся все остальные, а сами они занимают больше всего памяти. Зависимости между наборами
+# разрешаются при обращении (context.get), поэтому сабмишены читаются, только если нужный набор
+# не найден в кеше. "params" — параметры метрик, от которых зависит набор: они входят в ключ кеша,
+# поэтому при другой отсечке времени или доле групп пары, баллы по урокам и времена решения
+# берутся из кеша, а пересчитывается только итоговая арифметика.
+MAX_CACHED_INTERMEDIATE_COURSES = 8
+
+
+class IntermediateCache:
+    """LRU промежуточных наборов по курсам: course_id -> {имя набора: значение} (и время первого набора курса)."""
+
+    def __init__(self, max_courses=MAX_CACHED_INTERMEDIATE_COURSES):
+        self.max_courses = max_courses
+        self._courses = OrderedDict()
+        self._created_at = {}
+        self._lock = threading.Lock()
+
+    def get(self, course_id, key):
+        with self._lock:
+            course_datasets = self._courses.get(course_id)
+            if course_datasets is None or key not in course_datasets:
+                return None
+            self._courses.move_to_end(course_id)
+            return course_datasets[key]
+
+    def put(self, course_id, key, value):
+        with self._lock:
+            if course_id not in self._courses:
+                self._created_at[course_id] = datetime.now()
+            self._courses.setdefault(course_id, {})[key] = value
+            self._courses.move_to_end(course_id)
+            while len(self._courses) > self.max_courses:
+                evicted_course_id, _ = self._courses.popitem(last=False)
+                self._created_at.pop(evicted_course_id, None)
+
+    def invalidate(self, course_id=None, before=None):
+        """
+        Сбрасывает наборы курса (или всех курсов) — например, после импорта данных.
+        before — сбросить, только если наборы курса начали собираться раньше этого времени.
+        """
+        with self._lock:
+            if course_id is None:
+                self._courses.clear()
+                self._created_at.clear()
+            elif before is None or self._created_at.get(course_id, before) < before:
+                self._courses.pop(course_id, None)
+                self._created_at.pop(course_id, None)
+
+
+intermediate_cache = IntermediateCache()
+
+
+class CourseMetricsContext:
+    """Наборы данных расчета ОДНОГО курса: каждый набор строится один раз, при первом обращении."""
+
+    def __init__(self, course_id, max_workers=1, user_sample_modulus=None, cache=None, params=None):
+        self.course_id = course_id
+        self.params = params or dict(DEFAULT_METRIC_PARAMS)
+        self.max_workers = max_workers
+        self.user_sample_modulus = user_sample_modulus
+        self.cache = cache if not user_sample_modulus else None # Наборы по выборке учащихся не кешируются
+        self._datasets = {}
+
+    def get(self, name):
+        if name in self._datasets:
+            return self._datasets[name]
+        dataset = DATASETS[name]
+        cache_key = (name,) + tuple(self.params[param] for param in dataset["params"])
+        value = self.cache.get(self.course_id, cache_key) if self.cache is not None and dataset["cache"] else None
+        if value is None:
+            with span(dataset["span"], log=True, course_id=self.course_id) as phase_span:
+                value = dataset["build"](self, phase_span)
+            if self.cache is not None and dataset["cache"]:
+                self.cache.put(self.course_id, cache_key, value)
+        self._datasets[name] = value
+        return value
+
+
+def _steps_dataset(context, phase_span):
+    """[1/9] Шаги курса в порядке прохождения: базовые словари шагов, позиции и уроки."""
+    all_steps = query_course_steps(context.course_id)
+    course_step_order = defaultdict(list) # {course_id: [ordered_step_ids]}
+    step_positions = {} # step_id -> индекс шага в его курсе
+    lesson_to_steps = defaultdict(list) # lesson_id -> [step_ids]
+    for step in all_steps:
+        step_course_id = step.lesson.module.course_id if step.lesson and step.lesson.module else None
+        lesson_id = step.lesson_id if step.lesson else None
+        if step_course_id:
+            course_step_order[step_course_id].append(step.step_id)
+            step_positions[step.step_id] = len(course_step_order[step_course_id]) - 1
+        if lesson_id:
+            lesson_to_steps[lesson_id].append(step.step_id)
+    phase_span["rows"] = len(all_steps)
+    if all_steps and not lesson_to_steps:
+        print("    ... ПРЕДУПРЕЖДЕНИЕ: Ни один из найденных шагов не привязан к уроку. Расчет дискриминативности невозможен.")
+    return {
+        "step_rows": [build_step_data(step) for step in all_steps], # Кешируются словари, а не ORM-объекты
+        "step_ids": [step.step_id for step in all_steps],
+        "course_step_order": dict(course_step_order),
+        "step_positions": step_positions,
+        "lesson_to_steps": dict(lesson_to_steps),
+    }
+
+
+def _submissions_dataset(context, phase_span):
+    """[2/9] Сабмишены шагов курса (user_id, step_id, status, score, submission_time)."""
+    submissions = []
+    try:
+        submissions_query = db.session.query(
+            Submission.user_id, Submission.step_id, Submission.status, Submission.score, Submission.submission_time
+        ).filter(Submission.step_id.in_(context.get("steps")["step_ids"]))
+        if context.user_sample_modulus:
+            submissions_query = submissions_query.filter(Submission.user_id % context.user_sample_modulus == 0)
+        submissions = stream_results_query(submissions_query).all()
+    except Exception as sub_err:
+        print(f"!!! Ошибка при запросе сабмишенов: {sub_err}")
+    phase_span["rows"] = len(submissions)
+    return submissions
+
+
+def _submission_counts_dataset(context, phase_span):
+    """[3/9] {step_id: {"total_submissions", "correct_submissions"}}."""
+    submission_counts = {}
+    correct_status = context.params["correct_status"]
+    for sub in context.get("submissions"):
+        counts = submission_counts.setdefault(sub.step_id, {"total_submissions": 0, "correct_submissions": 0})
+        counts["total_submissions"] += 1
+        if sub.status == correct_status:
+            counts["correct_submissions"] += 1
+    phase_span["rows"] = len(submission_counts)
+    return submission_counts
+
+
+def _comments_dataset(context, phase_span):
+    """[4/9] {step_id: {"total_comments", "unique_users"}}."""
+    comments_results = db.session.query(
+        Comment.step_id,
+        func.count(Comment.comment_id).label("comments_count"),
+        func.count(distinct(Comment.user_id)).label("unique_commenting_users")
+    ).filter(Comment.step_id.in_(context.get("steps")["step_ids"])).group_by(Comment.step_id).all()
+    phase_span["rows"] = len(comments_results)
+    return {row.step_id: {"total_comments": row.comments_count or 0, "unique_users": row.unique_commenting_users or 0}
+            for row in comments_results}
+
+
+def _solve_times_dataset(context, phase_span):
+    """[5/9] {step_id: массив секунд решения} — все времена, отсечка применяется в метриках."""
+    solve_times = solve_times_per_step(context.get("submissions"), context.params["correct_status"])
+    phase_span["rows"] = len(solve_times)
+    return solve_times
+
+
+def _correct_pairs_dataset(context, phase_span):
+    """[6/9] PairSet верных пар (user, step)."""
+    correct_status = context.params["correct_status"]
+    correct_pairs = PairSet.from_pairs((sub.user_id, sub.step_id) for sub in context.get("submissions") if sub.status == correct_status)
+    phase_span["rows"] = len(correct_pairs)
+    return correct_pairs
+
+
+def _attempted_pairs_dataset(context, phase_span):
+    """[7/9] PairSet всех пар (user, step) с попытками."""
+    attempted_pairs = PairSet.from_pairs((sub.user_id, sub.step_id) for sub in context.get("submissions"))
+    phase_span["rows"] = len(attempted_pairs)
+    return attempted_pairs
+
+
+def _user_counts_dataset(context, phase_span):
+    """[8/9] {step_id: {"total_attempted_users", "passed_correctly_users"}}."""
+    user_counts = defaultdict(lambda: {"total_attempted_users": 0, "passed_correctly_users": 0})
+    for step_id, users_count in context.get("attempted_pairs").counts().items():
+        user_counts[step_id]["total_attempted_users"] = users_count
+    for step_id, users_count in context.get("correct_pairs").counts().items():
+        user_counts[step_id]["passed_correctly_users"] = users_count
+    phase_span["rows"] = len(user_counts)
+    return dict(user_counts)
+
+
+# Для каждого пользователя — максимальный индекс (в порядке курса) решенного и просто начатого шага.
+# "Решил что-то после шага k" <=> furthest_solved > k; "пытался что-то после k" <=> furthest_attempted > k
+def _furthest_solved_dataset(context, phase_span):
+    """[8/9] (user_ids, индекс самого дальнего верно решенного шага)."""
+    furthest = context.get("correct_pairs").furthest_per_user(context.get("steps")["step_positions"])
+    phase_span["rows"] = len(furthest[0])
+    return furthest
+
+
+def _furthest_attempted_dataset(context, phase_span):
+    """[8/9] (user_ids, индекс самого дальнего начатого шага)."""
+    furthest = context.get("attempted_pairs").furthest_per_user(context.get("steps")["step_positions"])
+    phase_span["rows"] = len(furthest[0])
+    return furthest
+
+
+def _lesson_scores_dataset(context, phase_span):
+    """
+    [8/9] {lesson_id: учащиеся урока по убыванию суммы баллов} — по урокам. В пуле процессов (max_workers > 1)
+    только для курсов от LESSON_PARALLEL_MIN_SUBMISSIONS сабмишенов: ранжирование дешевле запуска
+    spawn-воркеров и передачи им сабмишенов (замер — bench_parallel --single-course).
+    """
+    lesson_to_steps = context.get("steps")["lesson_to_steps"]
+    step_to_lesson = {step_id: lesson_id for lesson_id, lesson_step_ids in lesson_to_steps.items() for step_id in lesson_step_ids}
+    submissions_by_lesson = defaultdict(list) # Один проход по сабмишенам с сохранением исходного порядка
+    for sub in context.get("submissions"):
+        lesson_id = step_to_lesson.get(sub.step_id)
+        if lesson_id is not None:
+            submissions_by_lesson[lesson_id].append((sub.user_id, sub.score))
+    lesson_units = [(lesson_id, submissions_by_lesson[lesson_id]) for lesson_id in lesson_to_steps if lesson_id in submissions_by_lesson]
+    lesson_submissions_total = sum(len(lesson_submissions) for _, lesson_submissions in lesson_units)
+    max_workers = context.max_workers if lesson_submissions_total >= LESSON_PARALLEL_MIN_SUBMISSIONS else 1
+    ranked_students = dict(run_parallel(rank_lesson_students, lesson_units, max_workers=max_workers))
+    phase_span["rows"] = len(ranked_students)
+    return ranked_students
+
+
+def _discrimination_dataset(context, phase_span):
+    """[8/9] {step_id: D} по упорядоченным учащимся уроков и верным парам."""
+    correct_pairs = context.get("correct_pairs")
+    ranked_students = context.get("lesson_scores")
+    discrimination_indices = {}
+    for lesson_id, lesson_step_ids in context.get("steps")["lesson_to_steps"].items():
+        if lesson_id in ranked_students: # Нет сабмишенов — D не рассчитывается
+            discrimination_indices.update(calculate_lesson_discrimination(
+                lesson_step_ids, ranked_students[lesson_id], correct_pairs, context.params["discrimination_group_share"]))
+    phase_span["rows"] = len(discrimination_indices)
+    return discrimination_indices
+
+
+DATASETS = {
+    "steps": {"span": "structure.1_steps", "build": _steps_dataset, "params": (), "cache": True},
+    "submissions": {"span": "structure.2_submissions", "build": _submissions_dataset, "params": (), "cache": False},
+    "submission_counts": {"span": "structure.3_submission_counts", "build": _submission_counts_dataset,
+                          "params": ("correct_status",), "cache": True},
+    "comments": {"span": "structure.4_comments", "build": _comments_dataset, "params": (), "cache": True},
+    "solve_times": {"span": "structure.5_solve_times", "build": _solve_times_dataset, "params": ("correct_status",), "cache": True},
+    "correct_pairs": {"span": "structure.6_correct_pairs", "build": _correct_pairs_dataset,
+                      "params": ("correct_status",), "cache": True},
+    "attempted_pairs": {"span": "structure.7_attempted_pairs", "build": _attempted_pairs_dataset, "params": (), "cache": True},
+    "user_counts": {"span": "structure.8_user_counts", "build": _user_counts_dataset, "params": ("correct_status",), "cache": True},
+    "furthest_solved": {"span": "structure.8_furthest_solved", "build": _furthest_solved_dataset,
+                        "params": ("correct_status",), "cache": True},
+    "furthest_attempted": {"span": "structure.8_furthest_attempted", "build": _furthest_attempted_dataset,
+                           "params": (), "cache": True},
+    "lesson_scores": {"span": "structure.8_lesson_scores", "build": _lesson_scores_dataset, "params": (), "cache": True},
+    "discrimination": {"span": "structure.8_discrimination", "build": _discrimination_dataset,
+                       "params": ("correct_status", "discrimination_group_share"), "cache": True},
+}
+
+
+def _course_position(step_data, steps):
+    """(индекс шага в курсе, последний ли шаг) или None, если курс/порядок шага не определен."""
+    step_course_id = step_data["course_id"]
+    current_step_index = steps["step_positions"].get(step_data["step_id"])
+    if not step_course_id or step_course_id not in steps["course_step_order"] or current_step_index is None:
+        return None
+    return current_step_index, current_step_index == len(steps["course_step_order"][step_course_id]) - 1
+
+
+def _apply_attempted_users(step_data, context):
+    if step_data["step_id"] in context.get("submission_counts"):
+        user_counts = context.get("user_counts").get(step_data["step_id"], {})
+        step_data["passed_users_sub"] = user_counts.get("passed_correctly_users", 0)
+        step_data["all_users_attempted"] = user_counts.get("total_attempted_users", 0)
+
+
+def _apply_difficulty_index(step_data, context):
+    submission_counts = context.get("submission_counts").get(step_data["step_id"])
+    if submission_counts: # Сложность = верные сабмиты / все сабмиты
+        total_subs = submission_counts["total_submissions"]
+        step_data["difficulty_index"] = (float(submission_counts["correct_submissions"]) / total_subs) if total_subs > 0 else 0.0
+
+
+def _apply_success_rate(step_data, context):
+    if step_data["step_id"] not in context.get("submission_counts"):
+        return
+    user_counts = context.get("user_counts").get(step_data["step_id"], {})
+    unique_views_val = step_data["unique_views"]
+    if unique_views_val is not None and unique_views_val > 0: # Доля верно решивших уников среди пытавшихся
+        step_data["success_rate"] = float(user_counts.get("passed_correctly_users", 0)) / user_counts.get("total_attempted_users", 0)
+    else:
+        step_data["success_rate"] = 0.0
+
+
+def _apply_avg_attempts_per_passed(step_data, context):
+    submission_counts = context.get("submission_counts").get(step_data["step_id"])
+    if submission_counts:
+        passed_users = context.get("user_counts").get(step_data["step_id"], {}).get("passed_correctly_users", 0)
+        step_data["avg_attempts_per_passed"] = (float(submission_counts["total_submissions"]) / passed_users) if passed_users > 0 else None
+
+
+def _apply_comment_rate(step_data, context):
+    step_comments = context.get("comments").get(step_data["step_id"])
+    step_data["comment_rate"] = 0.0
+    if step_comments: # Коэффициент комментариев = уникальные комментаторы / уникальные просмотры
+        step_data["comment_count"] = step_comments["total_comments"]
+        unique_views_val = step_data["unique_views"]
+        if unique_views_val is not None and unique_views_val > 0:
+            step_data["comment_rate"] = float(step_comments["unique_users"]) / unique_views_val
+
+
+def _apply_avg_completion_time(step_data, context):
+    solve_seconds = context.get("solve_times").get(step_data["step_id"])
+    if solve_seconds is not None: # Среднее — точное по решениям не дольше отсечки
+        filtered_seconds = solve_seconds[solve_seconds <= context.params["solve_time_cutoff_seconds"]]
+        if len(filtered_seconds):
+            step_data["avg_completion_time_filtered_seconds"] = round(float(filtered_seconds.mean()))
+
+
+def _apply_solve_time_percentiles(step_data, context):
+    solve_seconds = context.get("solve_times").get(step_data["step_id"])
+    if solve_seconds is not None: # Медиана/p75/p90 — из KLL sketch шага с той же отсечкой
+        set_solve_time_percentiles(step_data, KLLSketch.from_values(solve_seconds).quantiles(
+            SOLVE_TIME_QUANTILES, cutoff=context.params["solve_time_cutoff_seconds"]))
+
+
+def _apply_skip_rate(step_data, context):
+    position = _course_position(step_data, context.get("steps"))
+    if position is None:
+        step_data["skip_rate"] = None; step_data["skip_rate_numerator_r"] = None; step_data["skip_rate_denominator_t"] = None
+        return
+    current_step_index, is_last_step = position
+    current_attempted_set = context.get("attempted_pairs").users(step_data["step_id"])
+    current_passed_set = context.get("correct_pairs").users(step_data["step_id"])
+    failed_user_ids = np.setdiff1d(current_attempted_set, current_passed_set, assume_unique=True)
+    numerator_r_skip = len(failed_user_ids) # R = число не прошедших
+    denominator_t_skip = 0 # T = число R, решивших хоть что-то дальше (верно)
+    if numerator_r_skip > 0 and not is_last_step:
+        # Есть ВЕРНОЕ решение на любом следующем шаге <=> самый дальний решенный шаг дальше текущего
+        solved_user_ids, furthest_solved_index = context.get("furthest_solved")
+        furthest_solved = lookup_per_user(failed_user_ids, solved_user_ids, furthest_solved_index)
+        denominator_t_skip = int(np.count_nonzero(furthest_solved > current_step_index))
+    step_data["skip_rate_numerator_r"] = numerator_r_skip
+    step_data["skip_rate_denominator_t"] = denominator_t_skip
+    step_data["skip_rate"] = (float(denominator_t_skip) / numerator_r_skip) if numerator_r_skip > 0 else (0.0 if denominator_t_skip == 0 else None)
+
+
+def _apply_completion_index(step_data, context):
+    position = _course_position(step_data, context.get("steps"))
+    if position is None:
+        has_index = step_data["step_id"] in context.get("steps")["step_positions"]
+        step_data["completion_index"] = None if has_index else 0.0
+        step_data["completion_numerator_r"] = None if has_index else 0
+        step_data["completion_denominator_t"] = 0
+        return
+    current_step_index, is_last_step = position
+    current_attempted_set = context.get("attempted_pairs").users(step_data["step_id"])
+    denominator_t_comp = len(current_attempted_set) # T = число пытавшихся
+    numerator_r_comp = 0 # R = число T, не пытавшихся ничего дальше (для последнего шага R=0)
+    if denominator_t_comp > 0 and not is_last_step:
+        # Нет ЛЮБЫХ попыток на следующих шагах <=> самый дальний начатый шаг не дальше текущего
+        attempted_user_ids, furthest_attempted_index = context.get("furthest_attempted")
+        furthest_attempted = lookup_per_user(current_attempted_set, attempted_user_ids, furthest_attempted_index)
+        numerator_r_comp = int(np.count_nonzero(furthest_attempted <= current_step_index))
+    step_data["completion_denominator_t"] = denominator_t_comp
+    step_data["completion_numerator_r"] = numerator_r_comp
+    step_data["completion_index"] = (float(numerator_r_comp) / denominator_t_comp) if denominator_t_comp > 0 else 0.0
+
+
+def _apply_discrimination_index(step_data, context):
+    step_data["discrimination_index"] = context.get("discrimination").get(step_data["step_id"], None)
+
+
+def _apply_usefulness_index(step_data, context):
+    pass # Считается в build_step_data по просмотрам из AdditionalStepInfo
+
+
+# Метрика -> наборы данных и поля шага, которые она заполняет
+METRICS = {
+    "attempted_users": {"datasets": ("submission_counts", "user_counts"), "fields": ("passed_users_sub", "all_users_attempted"),
+                        "apply": _apply_attempted_users},
+    "difficulty_index": {"datasets": ("submission_counts",), "fields": ("difficulty_index",), "apply": _apply_difficulty_index},
+    "success_rate": {"datasets": ("submission_counts", "user_counts"), "fields": ("success_rate",), "apply": _apply_success_rate},
+    "skip_rate": {"datasets": ("correct_pairs", "attempted_pairs", "furthest_solved"),
+                  "fields": ("skip_rate", "skip_rate_numerator_r", "skip_rate_denominator_t"), "apply": _apply_skip_rate},
+    "discrimination_index": {"datasets": ("discrimination",), "fields": ("discrimination_index",),
+                             "apply": _apply_discrimination_index},
+    "completion_index": {"datasets": ("attempted_pairs", "furthest_attempted"),
+                         "fields": ("completion_index", "completion_numerator_r", "completion_denominator_t"),
+                         "apply": _apply_completion_index},
+    "avg_attempts_per_passed": {"datasets": ("submission_counts", "user_counts"), "fields": ("avg_attempts_per_passed",),
+                                "apply": _apply_avg_attempts_per_passed},
+    "comment_rate": {"datasets": ("comments",), "fields": ("comment_count", "comment_rate"), "apply": _apply_comment_rate},
+    "usefulness_index": {"datasets": (), "fields": ("usefulness_index",), "apply": _apply_usefulness_index},
+    "avg_completion_time_filtered_seconds": {"datasets": ("solve_times",), "fields": ("avg_completion_time_filtered_seconds",),
+                                             "apply": _apply_avg_completion_time},
+    "solve_time_percentiles": {"datasets": ("solve_times",),
+                               "fields": ("solve_time_p50_seconds", "solve_time_p75_seconds", "solve_time_p90_seconds"),
+                               "apply": _apply_solve_time_percentiles},
+}
+METRIC_FIELDS = {field for metric in METRICS.values() for field in metric["fields"]}
+
+
+def parse_metrics_arg(metrics_arg):
+    """Список метрик из ?metrics=a,b (None — все метрики); ValueError для неизвестных."""
+    if not metrics_arg:
+        return None
+    metrics = [metric.strip() for metric in metrics_arg.split(',') if metric.strip()]
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown or not metrics:
+        raise ValueError(f"Неизвестные метрики: {', '.join(unknown) or '(пусто)'}. Доступны: {', '.join(METRICS)}")
+    return list(dict.fromkeys(metrics))
+
+
+def metric_datasets(metrics):
+    """Наборы данных, объявленные метриками, в порядке фаз расчета."""
+    declared = {dataset for metric in metrics for dataset in METRICS[metric]["datasets"]}
+    return [name for name in DATASETS if name in declared]
+
+
+def projected_field(metrics):
+    """Предикат имени поля для среза metrics: поля структуры и поля выбранных метрик."""
+    fields = {field for metric in metrics for field in METRICS[metric]["fields"]}
+    return lambda key: key not in METRIC_FIELDS or key in fields
+
+
+def project_metrics(results_list, metrics):
+    """Копии словарей шагов только с полями структуры и полями метрик metrics."""
+    is_projected = projected_field(metrics)
+    return [{key: value for key, value in step_data.items() if is_projected(key)} for step_data in results_list]
+
+
+def calculate_course_structure(course_id, max_workers=1, user_sample_modulus=None, metrics=None, cache=None, params=None):
+    """
+    Рассчитывает список шагов ОДНОГО курса с деталями и метриками.
+    Все метрики локальны для курса, поэтому список для всех курсов
+    собирается конкатенацией результатов по отдельным курсам.
+    max_workers > 1 — ранжирование учащихся по урокам большого курса считается в пуле процессов
+    (см. LESSON_PARALLEL_MIN_SUBMISSIONS).
+    user_sample_modulus — расчет по выборке учащихся (user_id % modulus == 0), для быстрой оценки долей.
+    metrics — считать только эти метрики из METRICS (в результате — поля структуры и поля этих метрик),
+    cache — IntermediateCache для повторного использования промежуточных наборов.
+    params — параметры метрик (см. metric_params), по умолчанию DEFAULT_METRIC_PARAMS.
+    Требует активного app context.
+    """
+    start_time = time.time()
+    selected_metrics = list(METRICS) if metrics is None else metrics
+    context = CourseMetricsContext(course_id, max_workers=max_workers, user_sample_modulus=user_sample_modulus, cache=cache,
+                                   params=params)
+    steps = context.get("steps")
+    if not steps["step_rows"]:
+        return []
+    for name in metric_datasets(selected_metrics):
+        context.get(name)
+
+    with span("structure.9_results", log=True, course_id=course_id) as phase_span:
+        results_list = []
+        for base_step_data in steps["step_rows"]:
+            step_data = dict(base_step_data)
+            for metric in selected_metrics:
+                METRICS[metric]["apply"](step_data, context)
+            results_list.append(step_data)
+        if metrics is not None:
+            results_list = project_metrics(results_list, selected_metrics)
+        phase_span["rows"] = len(results_list)
+
+    total_duration = time.time() - start_time
+    print(f"--- Расчет метрик структуры для курса ID={course_id} завершен (шагов: {len(results_list)}, за {total_duration:.2f} сек).")
+    return results_list
+
+
+def rank_lesson_students(lesson_id, lesson_submissions):
+    """
+    Учащиеся ОДНОГО урока по убыванию суммы баллов (score) за урок — основа групп дискриминативности.
+    lesson_submissions — кортежи (user_id, score) сабмишенов урока.
+    Не обращается к БД, поэтому может выполняться в отдельном процессе.
+    Возвращает (lesson_id, [user_id, ...]).
+    """
+    # 1. Суммируем баллы (score) для каждого студента в этом уроке
+    student_lesson_scores = defaultdict(int)
+    lesson_students = set()
+    for user_id, score in lesson_submissions:
+        # score может быть None, обрабатываем это
+        student_lesson_scores[user_id] += (score or 0)
+        lesson_students.add(user_id)
+    # 2. Сортируем студентов по баллам
+    return lesson_id, sorted(lesson_students, key=lambda uid: student_lesson_scores.get(uid, 0), reverse=True)
+
+
+def calculate_lesson_discrimination(lesson_step_ids, sorted_students, correct_pairs, group_share=DISCRIMINATION_GROUP_SHARE):
+    """
+    Индекс дискриминативности D = (UG - LG) / n для шагов ОДНОГО урока.
+    sorted_students — учащиеся урока по убыванию баллов (rank_lesson_students),
+    correct_pairs — PairSet верных пар (user, step), group_share — доля учащихся в группе.
+    Возвращает {step_id: D}.
+    """
+    discrimination_indices = {}
+    total_lesson_students = len(sorted_students)
+    if total_lesson_students < 2: # Нужно хотя бы 2 студента для разделения
+        return discrimination_indices
+
+    # 1. Определяем размер групп (n = 27% по умолчанию)
+    # Используем max(1, ...) чтобы гарантировать хотя бы одного студента в группе
+    # Используем floor, чтобы не выходить за пределы при малом N
+    n_group_size = max(1, math.floor(total_lesson_students * group_share))
+
+    # 2. Выделяем верхнюю и нижнюю группы
+    top_group_ids = set(sorted_students[:n_group_size])
+    bottom_group_ids = set(sorted_students[-n_group_size:])
+
+    # 3. Считаем UG и LG для КАЖДОГО шага урока (векторная проверка членства в PairSet)
+    top_group_array = np.array([user_id for user_id in top_group_ids if user_id is not None], dtype=np.int64)
+    bottom_group_array = np.array([user_id for user_id in bottom_group_ids if user_id is not None], dtype=np.int64)
+    for step_id in lesson_step_ids:
+        ug_correct = int(np.count_nonzero(correct_pairs.contains(top_group_array, np.full(len(top_group_array), step_id))))
+        lg_correct = int(np.count_nonzero(correct_pairs.contains(bottom_group_array, np.full(len(bottom_group_array), step_id))))
+
+        # 4. Считаем D = (UG - LG) / n
+        discrimination_index = (float(ug_correct - lg_correct) / n_group_size) if n_group_size > 0 else None
+        discrimination_indices[step_id] = discrimination_index
+
+    return discrimination_indices
+
+
+def _calculate_course_unit(course_id, params=None):
+    return course_id, calculate_course_structure(course_id, params=params)
+
+def calculate_structures_parallel(course_ids, database_uri, max_workers=None, params=None):
+    """
+    Рассчитывает структуру для нескольких курсов в пуле процессов (курс — единица работы).
+    Генератор: отдает пары (course_id, results_list) в порядке course_ids.
+    Внутри воркера уроки курса считаются последовательно (без вложенных пулов);
+    если курс один, он считается в текущем процессе (уроки — в пуле, только если курс большой,
+    см. LESSON_PARALLEL_MIN_SUBMISSIONS), а промежуточные наборы
+    сохраняются в intermediate_cache (для последующих запросов ?metrics= и других параметров).
+    params — параметры метрик (см. metric_params).
+    """
+    course_ids = list(course_ids)
+    if len(course_ids) == 1:
+        yield course_ids[0], calculate_course_structure(course_ids[0], max_workers=get_metrics_workers(max_workers),
+                                                        cache=intermediate_cache, params=params)
+        return
+    yield from run_parallel(_calculate_course_unit, [(course_id, params) for course_id in course_ids],
+                            max_workers=max_workers, database_uri=database_uri)
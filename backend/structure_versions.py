@@ -0,0 +1,101 @@
+import json
+import hashlib
+
+from sqlalchemy import func
+
+from .models import db, StepMetricsVersion
+from .instrumentation import span
+from .db_routing import pin_primary
+
+# --- Версии кеша структуры курса (step_metrics_version) ---
+# При сохранении пересчитанной структуры для каждого шага считается хеш его словаря метрик
+# и сравнивается с сохраненным: новые, измененные и пропавшие шаги получают следующую версию курса.
+# /steps/structure/changes?since=N отдает только шаги, изменившиеся после версии N, — клиенту
+# не нужно заново загружать всю структуру после импорта, затронувшего несколько шагов.
+# percentile_ranks в хеш не входят: они добавляются к ответу и зависят от других курсов.
+
+
+def step_metrics_hash(step_data):
+    """SHA-1 словаря шага (ключи отсортированы, поэтому хеш не зависит от порядка полей)."""
+    encoded = json.dumps(step_data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+def course_structure_version(course_id):
+    """Текущая версия структуры курса (0 — структура еще не сохранялась)."""
+    changed, removed = db.session.query(func.max(StepMetricsVersion.changed_version),
+                                        func.max(StepMetricsVersion.removed_version))\
+        .filter(StepMetricsVersion.course_id == course_id).one()
+    return max(changed or 0, removed or 0)
+
+
+def record_structure_version(course_id, results_list):
+    """
+    Сравнивает хеши шагов results_list с сохраненными и, если что-то изменилось,
+    записывает изменения под следующей версией курса. Возвращает текущую версию.
+    """
+    pin_primary(db.session) # Хеши сравниваются с основной БД: отставание реплики дало бы лишнюю версию
+    with span("structure_versions.record", log=True, course_id=course_id) as record_span:
+        stored = {row.step_id: row for row in
+                  db.session.query(StepMetricsVersion).filter(StepMetricsVersion.course_id == course_id).all()}
+        current_version = max([max(row.changed_version, row.removed_version or 0) for row in stored.values()], default=0)
+        new_version = current_version + 1
+        changed_rows = 0
+
+        current_step_ids = set()
+        for step_data in results_list:
+            step_id = step_data["step_id"]
+            current_step_ids.add(step_id)
+            metrics_hash = step_metrics_hash(step_data)
+            row = stored.get(step_id)
+            if row is None:
+                db.session.add(StepMetricsVersion(course_id=course_id, step_id=step_id, metrics_hash=metrics_hash,
+                                                  added_version=new_version, changed_version=new_version))
+            elif row.removed_version is not None: # Шаг вернулся в структуру — для клиента это новый шаг
+                row.metrics_hash, row.added_version, row.changed_version, row.removed_version = \
+                    metrics_hash, new_version, new_version, None
+            elif row.metrics_hash != metrics_hash:
+                row.metrics_hash, row.changed_version = metrics_hash, new_version
+            else:
+                continue
+            changed_rows += 1
+        for step_id, row in stored.items():
+            if step_id not in current_step_ids and row.removed_version is None:
+                row.removed_version = new_version
+                changed_rows += 1
+
+        record_span["rows"] = changed_rows
+        if not changed_rows:
+            db.session.rollback()
+            return current_version
+        db.session.commit()
+    print(f"--- Структура курса ID={course_id}: версия {new_version} (изменено шагов: {changed_rows}) ---")
+    return new_version
+
+
+def structure_changes(course_id, since, results_list):
+    """
+    Изменения структуры курса после версии since: {"version", "added", "updated", "removed"}.
+    added/updated — словари шагов из results_list (текущего кеша), removed — step_id удаленных шагов.
+    Шаг, добавленный и удаленный после since, не попадает никуда.
+    """
+    rows = db.session.query(StepMetricsVersion).filter(
+        StepMetricsVersion.course_id == course_id,
+        (StepMetricsVersion.changed_version > since) | (StepMetricsVersion.removed_version > since)).all()
+    steps_by_id = {step_data["step_id"]: step_data for step_data in results_list}
+    added, updated, removed = [], [], []
+    for row in sorted(rows, key=lambda row: row.step_id):
+        if row.removed_version is not None:
+            if row.added_version <= since:
+                removed.append(row.step_id)
+        elif row.step_id in steps_by_id:
+            (added if row.added_version > since else updated).append(row.step_id)
+    order = {step_data["step_id"]: position for position, step_data in enumerate(results_list)}
+    return {
+        "course_id": course_id,
+        "since": since,
+        "version": course_structure_version(course_id),
+        "added": [steps_by_id[step_id] for step_id in sorted(added, key=order.get)],
+        "updated": [steps_by_id[step_id] for step_id in sorted(updated, key=order.get)],
+        "removed": removed,
+    }
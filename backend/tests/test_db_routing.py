@@ -0,0 +1,78 @@
+import pytest
+from flask import Flask
+from sqlalchemy import select, update
+
+from backend.db_routing import configure_database, use_read_replica, pin_primary, REPLICA_BIND_KEY
+from backend.models import db, Course
+
+# Маршрутизация чтения на реплику (db_routing.RoutingSession): две SQLite-БД, в которых у одного
+# и того же курса разные названия, — по названию видно, из какой БД пришел ответ.
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    configure_database(app, f"sqlite:///{tmp_path / 'primary.db'}", replica_uri=f"sqlite:///{tmp_path / 'replica.db'}",
+                       environ={})
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values(): # Только таблица курсов: LONGTEXT других таблиц SQLite не поддерживает
+            db.metadata.create_all(engine, tables=[Course.__table__])
+        db.session.add(Course(course_id=1, title="primary"))
+        db.session.commit()
+        with db.engines[REPLICA_BIND_KEY].begin() as connection:
+            connection.execute(Course.__table__.insert().values(course_id=1, title="replica"))
+        yield app
+        db.session.remove()
+
+
+def course_title():
+    return db.session.execute(select(Course.title).where(Course.course_id == 1)).scalar_one()
+
+
+def test_select_without_read_replica_goes_to_primary(app):
+    assert course_title() == "primary"
+
+
+def test_select_goes_to_replica(app):
+    use_read_replica(db.session)
+    assert course_title() == "replica"
+    assert db.session.query(Course).count() == 1 # ORM-запрос — тоже с реплики
+    assert db.session.get(Course, 1).title == "replica"
+
+
+def test_flush_switches_to_primary(app):
+    use_read_replica(db.session)
+    assert course_title() == "replica"
+    db.session.add(Course(course_id=2, title="new"))
+    db.session.flush()
+    assert course_title() == "primary"
+    assert db.session.query(Course).count() == 2 # Видна собственная незакоммиченная запись
+
+
+def test_dml_switches_to_primary(app):
+    use_read_replica(db.session)
+    db.session.execute(update(Course).where(Course.course_id == 1).values(title="updated"))
+    assert course_title() == "updated"
+
+
+def test_pin_primary_keeps_reads_on_primary(app):
+    use_read_replica(db.session)
+    assert course_title() == "replica"
+    pin_primary(db.session)
+    assert course_title() == "primary"
+    db.session.commit()
+    assert course_title() == "primary" # Закрепление действует до конца сессии, а не транзакции
+
+
+def test_without_replica_bind_reads_go_to_primary(tmp_path):
+    app = Flask(__name__)
+    configure_database(app, f"sqlite:///{tmp_path / 'primary.db'}", environ={})
+    db.init_app(app)
+    with app.app_context():
+        db.metadata.create_all(db.engine, tables=[Course.__table__])
+        db.session.add(Course(course_id=1, title="primary"))
+        db.session.commit()
+        use_read_replica(db.session)
+        assert course_title() == "primary"
+        db.session.remove()
@@ -0,0 +1,204 @@
+import os
+import time
+import threading
+from datetime import datetime, date
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+
+from .models import db, Course, Module, Lesson, Step, StepDailyRollup, CourseDataChange
+from .file_cache import structure_cache_filepath
+from .structure_metrics import calculate_course_structure, intermediate_cache, metric_params, metric_params_key
+from .approx_structure import exact_structure_running
+from .rollups import ROLLUP_STEP_CHUNK
+from .parallel import run_parallel
+from .instrumentation import span
+
+# --- Фоновый прогрев кеша структуры курсов ---
+# При старте сервера и затем раз в WARMUP_POLL_SECONDS поток прогрева находит курсы без файлового
+# кеша структуры (для параметров из настроек) или с кешем старше отметки импорта (course_data_change)
+# и считает их в пуле не более чем из WARMUP_WORKERS процессов: сначала курсы с самой свежей
+# активностью, затем самые большие (по дневным агрегатам). Импорт (seed_database.py) только ставит
+# отметку — пересчитывает сервер, поэтому обновляются и его кеш в памяти, и файлы кеша.
+WARMUP_WORKERS = 2
+WARMUP_POLL_SECONDS = 60
+WARMUP_RETRY_SECONDS = 600 # Курс с ошибкой расчета не повторяется раньше (если нет нового импорта)
+
+_progress = {
+    "state": "idle", "workers": None, "poll_seconds": None, "last_check_at": None,
+    "pass_started_at": None, "pass_finished_at": None, "total": 0, "done": 0, "pending": [], "failed": [],
+}
+_progress_lock = threading.Lock()
+_scheduler = None
+_failed_at = {} # course_id -> время последней ошибки расчета
+
+
+def mark_courses_changed(step_ids):
+    """Отмечает курсы шагов step_ids как измененные импортом (их кеш структуры устарел). Возвращает id курсов."""
+    step_ids = sorted({step_id for step_id in step_ids if step_id is not None})
+    course_ids = set()
+    for chunk_start in range(0, len(step_ids), ROLLUP_STEP_CHUNK):
+        chunk = step_ids[chunk_start:chunk_start + ROLLUP_STEP_CHUNK]
+        course_ids.update(row.course_id for row in db.session.query(Module.course_id)
+                          .join(Lesson, Lesson.module_id == Module.module_id)
+                          .join(Step, Step.lesson_id == Lesson.lesson_id)
+                          .filter(Step.step_id.in_(chunk)).distinct().all())
+    return mark_course_ids_changed(course_ids)
+
+
+def mark_course_ids_changed(course_ids):
+    """
+    Отмечает курсы course_ids как измененные импортом (например, после зачисления учащихся). Возвращает id курсов.
+    Промежуточные наборы этих курсов в текущем процессе сбрасываются сразу; другие процессы (сервер)
+    сбрасывают свои, сверяя время их сборки с отметкой (metric_routes.course_structure_changed_at).
+    """
+    changed_at = datetime.now()
+    for course_id in sorted(set(course_ids)):
+        db.session.merge(CourseDataChange(course_id=course_id, changed_at=changed_at))
+        intermediate_cache.invalidate(course_id)
+    db.session.commit()
+    return sorted(set(course_ids))
+
+
+def course_data_changed_at(course_id):
+    """Время последнего импорта, затронувшего данные курса (None — отметки нет или еще нет таблицы отметок)."""
+    try:
+        change = db.session.get(CourseDataChange, course_id)
+    except SQLAlchemyError as e: # Таблица создается при запуске сервера или командами flask; без нее кеш не сверяется
+        db.session.rollback()
+        print(f"!!! Не удалось прочитать отметку импорта курса ID={course_id}: {e}")
+        return None
+    return change.changed_at if change is not None else None
+
+
+def course_warmup_order(course_ids):
+    """Курсы по убыванию приоритета: последний день активности (дневные агрегаты), затем число сабмишенов."""
+    if not course_ids:
+        return []
+    rows = db.session.query(Module.course_id, func.max(StepDailyRollup.day), func.sum(StepDailyRollup.submissions_count))\
+        .join(Lesson, Lesson.module_id == Module.module_id)\
+        .join(Step, Step.lesson_id == Lesson.lesson_id)\
+        .join(StepDailyRollup, StepDailyRollup.step_id == Step.step_id)\
+        .filter(Module.course_id.in_(course_ids)).group_by(Module.course_id).all()
+    activity = {course_id: (last_day or date.min, int(submissions or 0)) for course_id, last_day, submissions in rows}
+    return sorted(course_ids, key=lambda course_id: (*activity.get(course_id, (date.min, 0)), -course_id), reverse=True)
+
+
+def stale_course_ids(params=None):
+    """{course_id: "missing" | "stale"} — курсы без файлового кеша структуры или с кешем старше отметки импорта."""
+    params_key = metric_params_key(params or metric_params())
+    changed = dict(db.session.query(CourseDataChange.course_id, CourseDataChange.changed_at).all())
+    reasons = {}
+    for (course_id,) in db.session.query(Course.course_id).order_by(Course.course_id).all():
+        filepath = structure_cache_filepath(course_id, params_key)
+        if not os.path.exists(filepath): # Прежний JSON-кеш тоже годится: он переводится в .bin при чтении
+            filepath = structure_cache_filepath(course_id, params_key, extension="json")
+        if not os.path.exists(filepath):
+            reasons[course_id] = "missing"
+        elif course_id in changed and datetime.fromtimestamp(os.path.getmtime(filepath)) < changed[course_id]:
+            reasons[course_id] = "stale"
+    return reasons
+
+
+def warmup_progress():
+    """Состояние прогрева: текущий проход (total/done/pending/failed) и время последней проверки."""
+    with _progress_lock:
+        return {**_progress, "pending": list(_progress["pending"]), "failed": list(_progress["failed"])}
+
+
+def _warm_course_unit(course_id, params):
+    """Единица работы пула: ошибка курса возвращается, а не прерывает прогрев остальных курсов."""
+    try:
+        return course_id, calculate_course_structure(course_id, params=params), None
+    except Exception as e:
+        return course_id, None, str(e)
+
+
+def run_warmup_pass(on_result, max_workers=None):
+    """
+    Один проход прогрева: курсы без кеша или с устаревшим кешем считаются по приоритету,
+    on_result(course_id, results_list) сохраняет результат (в текущем процессе). Возвращает число посчитанных курсов.
+    """
+    max_workers = max_workers or current_app.config.get('WARMUP_WORKERS') or WARMUP_WORKERS
+    params = metric_params()
+    now = time.time()
+    with span("warmup.pass", log=True) as pass_span:
+        reasons = stale_course_ids(params)
+        course_ids = [course_id for course_id in reasons if not exact_structure_running(course_id)
+                      and now - _failed_at.get(course_id, 0) >= WARMUP_RETRY_SECONDS]
+        order = course_warmup_order(course_ids)
+        with _progress_lock:
+            _progress.update(workers=max_workers, last_check_at=datetime.now().isoformat(timespec='seconds'))
+            if order:
+                _progress.update(state="running", pass_started_at=datetime.now().isoformat(timespec='seconds'),
+                                 pass_finished_at=None, total=len(order), done=0, pending=list(order), failed=[])
+        if not order:
+            return 0
+        print(f"--- Прогрев кеша структуры: {len(order)} курсов ({sum(reason == 'stale' for reason in reasons.values())} "
+              f"устаревших), процессов: {max_workers} ---")
+        for course_id in order:
+            if reasons[course_id] == "stale":
+                intermediate_cache.invalidate(course_id) # Промежуточные наборы посчитаны по старым данным
+
+        warmed = 0
+        # Прогрев читает основную БД: кеш, посчитанный по отстающей реплике сразу после импорта, считался бы свежим
+        for course_id, results_list, error in run_parallel(_warm_course_unit, [(course_id, params) for course_id in order],
+                                                           max_workers=max_workers,
+                                                           database_uri=current_app.config['SQLALCHEMY_DATABASE_URI']):
+            if error is None:
+                try:
+                    on_result(course_id, results_list)
+                    _failed_at.pop(course_id, None)
+                    warmed += 1
+                except Exception as e:
+                    db.session.rollback()
+                    error = str(e)
+            if error is not None:
+                _failed_at[course_id] = time.time()
+                print(f"!!! Ошибка прогрева структуры курса ID={course_id}: {error}")
+            with _progress_lock:
+                _progress["done"] += 1
+                _progress["pending"].remove(course_id)
+                if error is not None:
+                    _progress["failed"].append({"course_id": course_id, "error": error})
+        with _progress_lock:
+            _progress.update(state="idle", pass_finished_at=datetime.now().isoformat(timespec='seconds'))
+        pass_span["rows"] = warmed
+    return warmed
+
+
+def start_warmup(app, on_result, max_workers=None, poll_seconds=None):
+    """
+    Запускает поток прогрева (один на процесс): проход сразу и затем каждые poll_seconds
+    (по умолчанию app.config['WARMUP_POLL_SECONDS'] или WARMUP_POLL_SECONDS; 0 — только один проход).
+    Возвращает False, если поток уже запущен.
+    """
+    global _scheduler
+    if poll_seconds is None:
+        poll_seconds = app.config.get('WARMUP_POLL_SECONDS')
+    if poll_seconds is None:
+        poll_seconds = WARMUP_POLL_SECONDS
+    with _progress_lock:
+        if _scheduler is not None and _scheduler.is_alive():
+            return False
+        _scheduler = threading.Thread(target=_run_scheduler, args=(app, on_result, max_workers, poll_seconds),
+                                      name="structure-warmup", daemon=True)
+        _progress["poll_seconds"] = poll_seconds
+    _scheduler.start()
+    return True
+
+
+def _run_scheduler(app, on_result, max_workers, poll_seconds):
+    while True:
+        with app.app_context():
+            try:
+                run_warmup_pass(on_result, max_workers)
+            except Exception as e:
+                db.session.rollback()
+                with _progress_lock:
+                    _progress["state"] = "idle"
+                print(f"!!! Ошибка прохода прогрева кеша структуры: {e}")
+        if not poll_seconds:
+            break
+        time.sleep(poll_seconds)
@@ -135,16 +135,40 @@ const request = async (endpoint, options = {}) => {
 
 /**
  * Получение структуры ВСЕХ шагов (включая доп. инфо и связи).
+ * @param {number|string|null} courseId - ID курса (null — все курсы).
+ * @param {Array<string>|null} metrics - Только эти метрики (например, ['skip_rate']); null — все.
  * @returns {Promise<Array<object>>} - Массив объектов с данными по всем шагам.
  */
-export const getStepsStructure = (courseId = null) => {
-  let endpoint = `/metrics/steps/structure`;
+export const getStepsStructure = (courseId = null, metrics = null) => {
+  const params = new URLSearchParams();
   if (courseId !== null && courseId !== undefined) {
-    endpoint += `?course_id=${courseId}`;
+    params.append('course_id', courseId);
   }
-  return request(endpoint);
+  if (metrics && metrics.length) {
+    params.append('metrics', metrics.join(','));
+  }
+  const query = params.toString();
+  return request(`/metrics/steps/structure${query ? `?${query}` : ''}`);
+};
+
+/**
+ * Изменения структуры курса после версии since (добавленные, измененные и удаленные шаги).
+ * Текущая версия приходит в поле version ответа.
+ * @param {number|string} courseId - ID курса.
+ * @param {number} since - Версия, которая уже есть у клиента (0 — все шаги).
+ * @returns {Promise<object>} - { course_id, since, version, added, updated, removed }.
+ */
+export const getStepsStructureChanges = (courseId, since = 0) => {
+  const params = new URLSearchParams({ course_id: courseId, since });
+  return request(`/metrics/steps/structure/changes?${params.toString()}`);
 };
 
+/**
+ * Состояние фонового прогрева кеша структуры курсов.
+ * @returns {Promise<object>} - { state, total, done, pending, failed, missing_courses, stale_courses, ... }.
+ */
+export const getWarmupProgress = () => request('/metrics/warmup');
+
 /**
  * Получение ВСЕХ метрик и доп. инфо для ОДНОГО шага (оптимизированная версия).
  * @param {number|string} stepId - ID шага.
@@ -154,6 +178,41 @@ export const getAllStepMetrics = (stepId) => {
   return request(`/metrics/step/${stepId}/all_opti`); // Используем оптимизированный эндпоинт
 };
 
+/**
+ * Сравнение нескольких шагов (можно из разных курсов): метрики и распределения попыток/времени решения.
+ * @param {Array<number>} stepIds - ID шагов.
+ * @returns {Promise<{steps: Array<object>, missing_step_ids: Array<number>}>}
+ */
+export const compareSteps = (stepIds) => {
+  return request(`/metrics/steps/compare?ids=${stepIds.join(",")}`);
+};
+
+/**
+ * Получение рекомендаций по шагам курса (находки правил по метрикам, по убыванию важности).
+ * @param {number|string} courseId - ID курса.
+ * @param {object} [params] - Необязательные фильтры: kind ('problem' | 'strength'), limit.
+ * @returns {Promise<{course_id: number, summary: object, findings: Array<object>}>}
+ */
+export const getCourseRecommendations = (courseId, { kind, limit } = {}) => {
+  let endpoint = `/metrics/recommendations?course_id=${courseId}`;
+  if (kind) endpoint += `&kind=${kind}`;
+  if (limit !== undefined && limit !== null) endpoint += `&limit=${limit}`;
+  return request(endpoint);
+};
+
+/**
+ * URL выгрузки данных в файл (для ссылки на скачивание — файл отдается сервером потоком).
+ * @param {string} dataset - 'structure' | 'completion_rates' | 'teachers' | 'learner_progress'.
+ * @param {object} [params] - courseId, format ('csv' | 'xlsx'), columns (массив полей шага для structure).
+ * @returns {string}
+ */
+export const getExportUrl = (dataset, { courseId, format = "csv", columns } = {}) => {
+  let url = `${API_BASE_URL}/metrics/export/${dataset}?format=${format}`;
+  if (courseId !== undefined && courseId !== null) url += `&course_id=${courseId}`;
+  if (columns && columns.length) url += `&columns=${columns.join(",")}`;
+  return url;
+};
+
 /**
  * Получение ПРЕДВАРИТЕЛЬНО РАССЧИТАННОЙ результативности курса по диапазонам.
  * @returns {Promise<object>} - Объект с данными расчета по диапазонам.
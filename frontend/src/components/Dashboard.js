@@ -336,6 +336,7 @@ function Dashboard() {
           courseIdForLocalStorage={courseIdForLocalStorage}
           modulesForTitle={modules}
           isLoading={loading && filteredStepsData.length === 0 && allStepsDataFromApi.length > 0}
+          exportCourseId={currentNumericCourseId}
         />
       }
 
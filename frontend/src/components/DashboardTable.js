@@ -12,6 +12,7 @@ import {
 import { DataGrid } from "@mui/x-data-grid";
 // Импортируем утилиту для определения общего статуса шага
 import { getStepOverallStatus } from "./dashboardUtils"; // Убедись, что путь правильный и функция экспортируется
+import { getExportUrl } from "../api/apiService";
 
 // Функции форматирования (предполагается, что они в dashboardUtils.js и используются через metric.format)
 
@@ -24,6 +25,7 @@ function DashboardTable({
   courseIdForLocalStorage,
   modulesForTitle,
   isLoading,
+  exportCourseId, // Числовой ID курса для выгрузки в файл (null — кнопки выгрузки скрыты)
 }) {
   if (isLoading && (!dataForGrid || dataForGrid.length === 0)) {
     return (
@@ -164,6 +166,15 @@ function DashboardTable({
     },
   ];
 
+  // Выгружаются те же колонки, что показаны в таблице
+  const exportColumns = [
+    "step_id",
+    "step_title_full",
+    "step_title_short",
+    "module_title",
+    ...availableMetrics.map((metric) => metric.dataKey),
+  ];
+
   return (
     <>
       <Paper sx={{ height: 600, width: "100%", mb: 2 }}>
@@ -223,6 +234,25 @@ function DashboardTable({
         >
           Сравнить выбранные шаги ({selectedStepIds.length})
         </Button>
+        {exportCourseId != null && !isNaN(exportCourseId) && (
+          <Box sx={{ mt: 1.5, display: "flex", justifyContent: "center", gap: 1 }}>
+            {["csv", "xlsx"].map((format) => (
+              <Button
+                key={format}
+                variant="outlined"
+                size="small"
+                component="a"
+                href={getExportUrl("structure", {
+                  courseId: exportCourseId,
+                  format,
+                  columns: exportColumns,
+                })}
+              >
+                Скачать {format.toUpperCase()}
+              </Button>
+            ))}
+          </Box>
+        )}
       </Box>
     </>
   );
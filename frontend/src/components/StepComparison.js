@@ -19,7 +19,7 @@ import CheckCircleOutlineIcon from '@mui/icons-material/CheckCircleOutline';
 import ReportProblemOutlinedIcon from '@mui/icons-material/ReportProblemOutlined';
 import HelpOutlineIcon from '@mui/icons-material/HelpOutline'; // Для "нейтральных" или общих заметок
 
-import { getStepsStructure } from "../api/apiService";
+import { compareSteps } from "../api/apiService";
 import {
     getStepInsights,
     availableMetrics as allMetricDefinitions,
@@ -27,6 +27,30 @@ import {
     // formatPercentage, formatNumber, formatTime, formatIntegerWithZero 
 } from './dashboardUtils';
 
+// Подпись интервала гистограммы времени решения ("1–2 мин", "> 180 мин")
+const formatTimeBin = (bin) => {
+  const toLabel = (seconds) => (seconds < 60 ? `${seconds} с` : `${Math.round(seconds / 60)} мин`);
+  return bin.to_seconds === null ? `> ${toLabel(bin.from_seconds)}` : `${toLabel(bin.from_seconds)}–${toLabel(bin.to_seconds)}`;
+};
+
+// Компактная горизонтальная гистограмма (доля от максимума)
+function DistributionBars({ items, labelKey, valueKey }) {
+  const maxValue = Math.max(1, ...items.map(item => item[valueKey]));
+  return (
+    <Box>
+      {items.map(item => (
+        <Box key={item[labelKey]} sx={{ display: 'flex', alignItems: 'center', fontSize: '0.7rem', mb: 0.2 }}>
+          <Box component="span" sx={{ width: 80, flexShrink: 0, color: 'text.secondary' }}>{item[labelKey]}</Box>
+          <Box sx={{ flexGrow: 1, mr: 1 }}>
+            <Box sx={{ height: 8, width: `${(100 * item[valueKey]) / maxValue}%`, bgcolor: 'primary.light', borderRadius: 0.5 }} />
+          </Box>
+          <Box component="span" sx={{ width: 36, textAlign: 'right' }}>{item[valueKey]}</Box>
+        </Box>
+      ))}
+    </Box>
+  );
+}
+
 function StepComparison() {
   const location = useLocation();
   const [comparisonData, setComparisonData] = useState([]);
@@ -68,15 +92,15 @@ function StepComparison() {
 
     const fetchComparisonData = async () => {
       try {
-        const allStepsInCourse = await getStepsStructure(numericCourseId);
-        if (!allStepsInCourse || allStepsInCourse.error || !Array.isArray(allStepsInCourse)) {
-          throw new Error(allStepsInCourse?.details || allStepsInCourse?.error || `Ошибка API при загрузке структуры курса ${numericCourseId}`);
+        // Сервер возвращает только запрошенные шаги (с распределениями попыток и времени решения)
+        const comparison = await compareSteps(idsForComparison);
+        if (!comparison || comparison.error || !Array.isArray(comparison.steps)) {
+          throw new Error(comparison?.details || comparison?.error || `Ошибка API при сравнении шагов курса ${numericCourseId}`);
         }
-        const selectedStepsData = allStepsInCourse.filter(step => idsForComparison.includes(step.step_id));
+        const selectedStepsData = comparison.steps;
         
-        if (selectedStepsData.length !== idsForComparison.length) {
-            const foundIds = selectedStepsData.map(s => s.step_id);
-            const missingIds = idsForComparison.filter(id => !foundIds.includes(id));
+        if (comparison.missing_step_ids && comparison.missing_step_ids.length > 0) {
+            const missingIds = comparison.missing_step_ids;
             console.warn(`Не все шаги для сравнения найдены. Отсутствуют ID: [${missingIds.join(", ")}].`);
              if(selectedStepsData.length === 0){ setError(`Ни один из запрошенных шагов не найден (ID: [${missingIds.join(", ")}]).`); }
              else { setError(`Некоторые шаги не найдены (ID: [${missingIds.join(", ")}]). Показывается сравнение для найденных.`); }
@@ -156,6 +180,23 @@ function StepComparison() {
                   })}
                 </Box>
 
+                {step.attempt_distribution && (
+                  <Box sx={{ mb: 1.5 }}>
+                    <Typography variant="subtitle2" sx={{ mb: 0.5, fontWeight: 'medium', fontSize: '0.85rem' }}>Попыток на учащегося:</Typography>
+                    <DistributionBars items={step.attempt_distribution} labelKey="attempts" valueKey="users" />
+                  </Box>
+                )}
+                {step.solve_time_histogram && (
+                  <Box sx={{ mb: 1.5 }}>
+                    <Typography variant="subtitle2" sx={{ mb: 0.5, fontWeight: 'medium', fontSize: '0.85rem' }}>Время решения:</Typography>
+                    <DistributionBars
+                      items={step.solve_time_histogram.map(bin => ({ ...bin, label: formatTimeBin(bin) }))}
+                      labelKey="label"
+                      valueKey="solved"
+                    />
+                  </Box>
+                )}
+
                 <Box sx={{ mt: 'auto', pt: 1.5, borderTop: '1px solid rgba(0,0,0,0.08)' }}>
                   <Typography variant="subtitle2" sx={{ mb: 0.5, fontWeight: 'medium', fontSize: '0.85rem' }}>Ключевые моменты:</Typography>
                   